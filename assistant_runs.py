@@ -0,0 +1,235 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+import retry
+from scheduler import percentile
+
+# Statuses after which a run will not change any more
+TERMINAL_STATUSES = ("completed", "failed", "cancelled", "expired", "incomplete", "requires_action")
+
+# Use the streaming run API so completion is reported by the server as it happens
+RUN_STREAMING = os.getenv("RUN_STREAMING", "1") == "1"
+
+# Bounds (in seconds) of the backoff used when the run has to be polled instead
+RUN_POLL_FLOOR = float(os.getenv("RUN_POLL_FLOOR", "0.25"))
+RUN_POLL_CEILING = float(os.getenv("RUN_POLL_CEILING", "3"))
+
+# Run timings kept for the per-prompt latency breakdown (see stats())
+RUN_TIMINGS_WINDOW = int(os.getenv("RUN_TIMINGS_WINDOW", "1000"))
+
+_recorded = deque(maxlen=RUN_TIMINGS_WINDOW)
+_recorded_lock = threading.Lock()
+
+
+def record(prompt, timings, deal=None):
+    """
+    Keeps the timings of a finished run for the latency breakdown.
+
+    Args:
+        prompt: Name of the prompt the run answered, e.g. "income_statement.json"
+        timings: The timings returned by run_and_wait()
+        deal: Folder of the deal the run belongs to (optional)
+    """
+    with _recorded_lock:
+        _recorded.append(dict(timings, prompt=prompt, deal=deal))
+
+
+def timings_for(deal):
+    """Returns the recorded run timings of one deal, oldest first."""
+    with _recorded_lock:
+        return [entry for entry in _recorded if entry["deal"] == deal]
+
+
+def stats():
+    """
+    Queued and in-progress time per prompt over the last RUN_TIMINGS_WINDOW runs.
+
+    Returns:
+        dict: prompt -> {"runs", "queued_p50", "queued_p95", "in_progress_p50", "in_progress_p95", "total_p95"}
+    """
+    with _recorded_lock:
+        entries = list(_recorded)
+    by_prompt = {}
+    for entry in entries:
+        by_prompt.setdefault(entry["prompt"], []).append(entry)
+    return {
+        prompt: {
+            "runs": len(runs),
+            "queued_p50": percentile([run["queued"] for run in runs], 0.5),
+            "queued_p95": percentile([run["queued"] for run in runs], 0.95),
+            "in_progress_p50": percentile([run["in_progress"] for run in runs], 0.5),
+            "in_progress_p95": percentile([run["in_progress"] for run in runs], 0.95),
+            "total_p95": percentile([run["total"] for run in runs], 0.95),
+        }
+        for prompt, runs in by_prompt.items()
+    }
+
+
+def log_stats():
+    """Logs the per-prompt latency breakdown of the runs made so far."""
+    for prompt, values in sorted(stats().items()):
+        logging.info(
+            f"⏱️ {prompt}: {values['runs']} runs, queued p50 {values['queued_p50']:.1f}s "
+            f"p95 {values['queued_p95']:.1f}s, in progress p50 {values['in_progress_p50']:.1f}s "
+            f"p95 {values['in_progress_p95']:.1f}s, total p95 {values['total_p95']:.1f}s"
+        )
+
+
+class RunTimer:
+    """Records when a run was first seen in each status."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.seen = {}
+        self.status_checks = 0
+
+    def mark(self, status):
+        self.seen.setdefault(status, time.monotonic())
+
+    def timings(self, final_status):
+        """
+        Summarize where the time went.
+
+        Returns:
+            dict: seconds spent queued, in progress and in total, plus the
+            final status and the number of status checks made.
+        """
+        end = self.seen.get(final_status, time.monotonic())
+        in_progress_at = self.seen.get("in_progress", end)
+        return {
+            "status": final_status,
+            "queued": round(in_progress_at - self.started, 3),
+            "in_progress": round(end - in_progress_at, 3),
+            "total": round(end - self.started, 3),
+            "status_checks": self.status_checks,
+        }
+
+
+def _stream_run(client, assistant_id, thread_id, timer, on_text=None, **run_options):
+    """
+    Create the run through the streaming API and consume its events.
+
+    Text deltas are passed to on_text as they arrive; if it returns False the
+    run is cancelled right away.
+    """
+    with client.beta.threads.runs.stream(
+        thread_id=thread_id,
+        assistant_id=assistant_id,
+        **run_options
+    ) as stream:
+        for event in stream:
+            # Run lifecycle events look like "thread.run.in_progress"
+            if event.event.startswith("thread.run.") and not event.event.startswith("thread.run.step"):
+                timer.mark(event.event[len("thread.run."):])
+            elif on_text and event.event == "thread.message.delta":
+                for block in event.data.delta.content or []:
+                    text = getattr(getattr(block, "text", None), "value", None)
+                    if text and on_text(text) is False:
+                        run = stream.current_run
+                        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                        timer.mark("cancelled")
+                        return client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        return stream.current_run
+
+
+def _active_run(client, thread_id):
+    """
+    Returns the run still going on a thread, or None.
+
+    A thread has at most one active run, so after a failed create this is the
+    run the server accepted without its response arriving.
+    """
+    runs = client.beta.threads.runs.list(thread_id=thread_id, order="desc", limit=1)
+    for run in runs.data:
+        if run.status not in TERMINAL_STATUSES:
+            return run
+    return None
+
+
+def _create_run(client, assistant_id, thread_id, **run_options):
+    """Create a run, retrying failures only once the thread shows no run was started."""
+    def created_run():
+        run = _active_run(client, thread_id)
+        if run is not None:
+            logging.info(f"↩️ Run {run.id} was created despite the error, using it")
+        return run
+
+    return retry.call(
+        client.beta.threads.runs.create,
+        assistant_id=assistant_id,
+        thread_id=thread_id,
+        name="openai.runs.create",
+        # Rate limits were already retried by the client's transport
+        retry_if=lambda error: retry.is_retryable(error) and retry.status_of(error) != 429,
+        before_retry=created_run,
+        **run_options
+    )
+
+
+def _poll_run(client, assistant_id, thread_id, timer, poll_floor, poll_ceiling, run=None, **run_options):
+    """Create the run, unless given one, and poll it with exponential backoff between the floor and ceiling."""
+    if run is None:
+        run = _create_run(client, assistant_id, thread_id, **run_options)
+    timer.mark(run.status)
+
+    delay = poll_floor
+    while run.status not in TERMINAL_STATUSES:
+        time.sleep(delay)
+        delay = min(delay * 2, poll_ceiling)
+        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        timer.status_checks += 1
+        timer.mark(run.status)
+    return run
+
+
+def run_and_wait(client, assistant_id, thread_id, stream=RUN_STREAMING, on_text=None,
+                 poll_floor=RUN_POLL_FLOOR, poll_ceiling=RUN_POLL_CEILING, **run_options):
+    """
+    Start a run on a thread and block until it reaches a terminal status.
+
+    Streams the run when possible and falls back to backoff polling when the
+    streaming API is unavailable or fails before the run is created.
+
+    Args:
+        client: OpenAI client
+        assistant_id: Assistant to run
+        thread_id: Thread to run on
+        stream: Use the streaming run API
+        on_text: Called with each chunk of reply text while streaming; returning
+            False cancels the run. Not called when the run had to be polled.
+        poll_floor: First delay between status checks when polling
+        poll_ceiling: Largest delay between status checks when polling
+        **run_options: Extra arguments passed to the run creation call
+
+    Returns:
+        tuple: (run, timings) where timings also carries the run's token usage
+    """
+    timer = RunTimer()
+    run = None
+
+    if stream and hasattr(client.beta.threads.runs, "stream"):
+        try:
+            run = _stream_run(client, assistant_id, thread_id, timer, on_text, **run_options)
+        except Exception as e:
+            if timer.seen:
+                # The run exists already; starting another one would duplicate the work
+                raise
+            logging.warning(f"Streaming run failed, falling back to polling: {e}")
+            # The server may have accepted the run before the stream broke
+            run = _poll_run(client, assistant_id, thread_id, timer, poll_floor, poll_ceiling,
+                            run=_active_run(client, thread_id), **run_options)
+
+    if run is None:
+        run = _poll_run(client, assistant_id, thread_id, timer, poll_floor, poll_ceiling, **run_options)
+
+    timings = timer.timings(run.status)
+    usage = getattr(run, "usage", None)
+    timings["prompt_tokens"] = getattr(usage, "prompt_tokens", None)
+    timings["completion_tokens"] = getattr(usage, "completion_tokens", None)
+    print(f"⏱️ Run {run.id} {run.status}: queued {timings['queued']:.2f}s, "
+          f"in progress {timings['in_progress']:.2f}s, total {timings['total']:.2f}s, "
+          f"{timings['status_checks']} status checks, "
+          f"{timings['prompt_tokens']} prompt tokens, {timings['completion_tokens']} completion tokens")
+    return run, timings
@@ -0,0 +1,208 @@
+import os
+import time
+import signal
+import logging
+import threading
+import mailer
+import retry
+import assistant_runs
+import email_fetcher
+from jobs import JobStore, reached, gave_up
+from scheduler import DealScheduler
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s'
+)
+# Reduce verbosity of Google API client logging
+logging.getLogger('googleapiclient').setLevel(logging.WARNING)
+logging.getLogger('google_auth_oauthlib').setLevel(logging.WARNING)
+logging.getLogger('urllib3').setLevel(logging.WARNING)
+logging.getLogger('openai').setLevel(logging.WARNING)
+logging.getLogger('httpx').setLevel(logging.WARNING)
+logging.getLogger('httpcore').setLevel(logging.WARNING)
+
+# Deals processed at the same time; each worker holds its own Gmail service
+DAEMON_WORKERS = int(os.getenv("DAEMON_WORKERS", "4"))
+
+# Seconds between two mailbox checks
+DAEMON_POLL_SECONDS = float(os.getenv("DAEMON_POLL_SECONDS", "30"))
+
+# Deals waiting for a worker before the fetcher stops taking new ones
+DAEMON_QUEUE_SIZE = int(os.getenv("DAEMON_QUEUE_SIZE", "100"))
+
+
+class DealDaemon:
+    """
+    Long-running mailbox processor.
+
+    A fetcher thread checks the mailbox every DAEMON_POLL_SECONDS, sends the
+    acknowledgment of each new deal and hands it to the DealScheduler. A pool
+    of worker threads takes deals from the scheduler, which shares them fairly
+    between senders within their concurrency quotas, and runs extraction, the
+    Excel file and the reply, so one slow deal or one busy sender no longer
+    holds up every other sender.
+    An email is only marked as read once its deal has been replied to; until
+    then it is tracked as in flight so the next poll does not pick it up again.
+    Progress is kept in the job store, so emails a previous run left part way
+    through are resumed at their first incomplete stage on start.
+
+    On stop() the fetcher stops polling and the workers finish every deal
+    already queued or running before exiting.
+    """
+
+    def __init__(self, workers=DAEMON_WORKERS, poll_seconds=DAEMON_POLL_SECONDS, queue_size=DAEMON_QUEUE_SIZE):
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.deals = DealScheduler(email_fetcher.load_registered_users(), max_pending=queue_size)
+        self.store = JobStore()
+        self.stopping = threading.Event()
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        """Starts the worker pool and the fetcher thread."""
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"worker-{number + 1}")
+            thread.start()
+            self.threads.append(thread)
+        self.fetcher = threading.Thread(target=self._fetch_loop, name="fetcher")
+        self.fetcher.start()
+        logging.info(f"🚀 Daemon started with {self.workers} workers, polling every {self.poll_seconds:.0f}s")
+
+    def stop(self):
+        """Stops polling; queued and running deals are still finished."""
+        if not self.stopping.is_set():
+            logging.info("🛑 Shutting down, draining queued deals...")
+            self.stopping.set()
+
+    def join(self):
+        """Waits for the fetcher and then for every worker to drain the queue."""
+        self.fetcher.join()
+        # Workers exit once every deal already queued has been handed out
+        self.deals.close()
+        for thread in self.threads:
+            thread.join()
+        self.deals.log_metrics()
+        retry.log_stats()
+        assistant_runs.log_stats()
+        logging.info(f"✅ Daemon stopped: {self.processed} deals processed, {self.failed} failed")
+
+    def _fetch_loop(self):
+        service = mailer.get_gmail_service()
+        try:
+            self._resume(service)
+        except Exception as e:
+            logging.error(f"❌ Could not resume unfinished emails: {e}")
+        while not self.stopping.is_set():
+            try:
+                self._fetch(service)
+            except Exception as e:
+                logging.error(f"❌ Mailbox check failed: {e}")
+            self.stopping.wait(self.poll_seconds)
+
+    def _resume(self, service):
+        unfinished = self.store.unfinished()
+        if unfinished:
+            logging.info(f"🔁 Resuming {len(unfinished)} unfinished emails")
+        with mailer.LabelBuffer(service) as labels:
+            for job in unfinished:
+                email_message = mailer.get_email_by_id(service, job["message_id"])
+                if not email_message:
+                    self.store.fail(job["message_id"], "message could not be fetched")
+                    continue
+                self._acknowledge(service, labels, job["message_id"], email_message, job["sender_email"])
+
+    def _fetch(self, service):
+        registered_users = email_fetcher.load_registered_users()
+        with mailer.LabelBuffer(service) as labels:
+            for page in mailer.iter_message_pages(service):
+                with self.lock:
+                    message_ids = [message['id'] for message in page if message['id'] not in self.in_flight]
+                if not message_ids:
+                    continue
+                logging.info(f"📧 Found {len(message_ids)} new emails.")
+                for msg_id, email_message, sender_email in email_fetcher.registered_messages(
+                    service, message_ids, registered_users, labels
+                ):
+                    job = self.store.get(msg_id)
+                    if reached(job, "marked_read"):
+                        labels.mark_as_read(msg_id)
+                        continue
+                    if gave_up(job):
+                        # Failed JOB_MAX_ATTEMPTS times; not acknowledged and queued again on every poll
+                        continue
+                    self._acknowledge(service, labels, msg_id, email_message, sender_email)
+                    # _acknowledge blocks while the queue is full; do not hold label changes that long
+                    labels.flush_if_due()
+                if self.stopping.is_set():
+                    return
+
+    def _acknowledge(self, service, labels, msg_id, email_message, sender_email):
+        try:
+            deal = email_fetcher.acknowledge_email(service, email_message, sender_email, self.store)
+            if deal is None:
+                email_fetcher.mark_done(labels, self.store, msg_id)
+                return
+        except Exception as e:
+            self.store.fail(msg_id, e)
+            logging.error(f"⚠ Skipping email ID {msg_id}, could not acknowledge email. Error: {e}")
+            return
+
+        with self.lock:
+            self.in_flight.add(msg_id)
+        # Blocks while the queue is full, which holds back the fetcher instead of growing without bound
+        self.deals.put(sender_email, deal)
+        logging.info(f"📥 Queued deal from {sender_email} ({self.deals.pending} waiting)")
+
+    def _work(self):
+        service = None
+        labels = None
+        while True:
+            ticket = self.deals.get()
+            if ticket is None:
+                if labels is not None:
+                    labels.flush()
+                return
+            deal = ticket.item
+            msg_id = deal["msg_id"]
+            start = time.monotonic()
+            try:
+                # googleapiclient services are not thread-safe, so every worker builds its own
+                if service is None:
+                    service = mailer.get_gmail_service()
+                    labels = mailer.LabelBuffer(service)
+                email_fetcher.process_deal(service, deal, self.store)
+                email_fetcher.mark_done(labels, self.store, msg_id)
+                with self.lock:
+                    self.processed += 1
+                logging.info(f"✅ Deal from {deal['sender_email']} done in {time.monotonic() - start:.1f}s")
+            except (Exception, SystemExit) as e:
+                # SystemExit too: a library calling sys.exit() must not take the worker thread down with it
+                self.store.fail(msg_id, e)
+                with self.lock:
+                    self.failed += 1
+                logging.error(f"⚠ Could not process deal in email ID {msg_id}. Error: {e!r}")
+            finally:
+                self.deals.done(ticket)
+                with self.lock:
+                    self.in_flight.discard(msg_id)
+
+
+def run():
+    """Runs the daemon until SIGINT or SIGTERM, then drains the in-flight deals."""
+    daemon = DealDaemon()
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.start()
+    while not daemon.stopping.is_set():
+        daemon.stopping.wait(1)
+    daemon.join()
+
+
+if __name__ == "__main__":
+    run()
@@ -3,8 +3,11 @@ from email.utils import parseaddr
 import logging
 import base64
 import mailer
-import extract_data
-import json_to_excel 
+import retry
+import assistant_runs
+from jobs import JobStore, reached, gave_up, delivered
+import user_registry
+from scheduler import DealScheduler
 from config import BASE_DIR
 
 
@@ -23,15 +26,13 @@ logging.getLogger('httpcore').setLevel(logging.WARNING)
       
 # load the list of registered users
 def load_registered_users():
-    """Loads registered user emails from a file."""
-    registered_users = set()
-    if os.path.exists("registered_users.txt"):
-        with open("registered_users.txt", "r") as f:
-            for line in f:
-                email_address = line.strip().lower()
-                if email_address:
-                    registered_users.add(email_address)
-    return registered_users
+    """
+    Returns the registered users.
+
+    The registry is shared by the whole process and reloads registered_users.txt
+    only when it changes, so calling this for every check costs nothing.
+    """
+    return user_registry.get_registry()
         
 # Rest of your functions (process_attachments, send_acknowledgment) remain the same
 
@@ -73,104 +74,346 @@ def convert_to_mime_message(email_message):
         logging.error(f"Error converting message to MIME format: {e}")
         return None
 
-def process_all_emails():
-    """Fetches and processes unread emails from Gmail."""
-    logging.info("📥 Checking for unread emails...")
-    service = mailer.get_gmail_service()
-    messages = mailer.list_unread_messages(service)
+def acknowledge_email(service, email_message, sender_email, jobs):
+    """
+    Saves a registered sender's attachments and sends the acknowledgment reply.
+
+    Stages the job already completed are skipped, so a resumed email does not
+    get its attachments saved twice or a second acknowledgment.
+
+    Args:
+        service: Gmail API service instance
+        email_message: Full Gmail API message
+        sender_email: Address of the registered sender
+        jobs: jobs.JobStore recording the email's progress
+
+    Returns:
+        dict or None: The deal to process ({msg_id, sender_email, folder_count, message_id_reply, subject,
+        email_message}), or None when the email had no attachments
+    """
+    msg_id = email_message['id']
+    _, subject, message_id = mailer.extract_email_details(email_message)
+    job = jobs.start(msg_id, sender_email)
+    logging.info(f"📨 Processing email from: {sender_email} (job at stage {job['stage']})")
+
+    if not reached(job, "attachments_saved"):
+        # Process attachments using mailer's function
+        # A retry reuses the submission folder allocated by the first attempt
+        has_attachment, user_history_count, failed_attachments = mailer.process_email_attachments(
+            service,
+            email_message, 
+            sender_email, 
+            BASE_DIR,
+            folder_count=job["folder_count"],
+            on_allocate=lambda number: jobs.advance(msg_id, "fetched", folder_count=str(number))
+        )
+        artifacts = {}
+        if has_attachment:
+            artifacts["attachments"] = os.path.join(BASE_DIR, "users", sender_email, str(user_history_count), "attachments")
+        if failed_attachments:
+            artifacts["failed_attachments"] = failed_attachments
+        job = jobs.advance(msg_id, "attachments_saved", artifacts, folder_count=str(user_history_count), has_attachments=has_attachment)
+
+    has_attachment = job["has_attachments"]
+    user_history_count = job["folder_count"]
+
+    if reached(job, "ack_sent"):
+        logging.info(f"⏭️ Acknowledgment already sent to {sender_email} for email ID {msg_id}")
+    else:
+        # Prepare the reply text based on whether there's an attachment
+        random_salutation = mailer.get_salutation()
+        if has_attachment:
+            reply_text = f"{random_salutation}\n\nWe've received your email and attachments. Our 🤖 robots are working hard 🏗️ and will get back to you soon with the results. ✅🚀\n\nBest,\nDealosophy 🎯"
+            failed_attachments = job["artifacts"].get("failed_attachments")
+            if failed_attachments:
+                reply_text += f"\n\nP.S. We couldn't open {', '.join(failed_attachments)}, so the results won't include them. 📎⚠️"
+        else:
+            reply_text = f"{random_salutation}\n\nWe received an email from you but couldn't find any attachments. 📂❌ Could you please check and resend them? 🔄\n\nBest,\nDealosophy"
+            
+        # Send the reply
+        success = mailer.send_reply(service, email_message, reply_text, idempotency_key=f"{msg_id}:ack")
+
+        if success:
+            logging.info(f"✅ Acknowledgment email successfully sent to {sender_email}")
+            job = jobs.advance(msg_id, "ack_sent")
+        else:
+            logging.error(f"❌ ERROR: Failed to send acknowledgment email to {sender_email}")
+
+    if not has_attachment:
+        return None
+
+    logging.info(f"📨 Email from: {sender_email}, Subject: {subject}, Received: {email_message['internalDate']}, Attachments: True, History: {user_history_count}")
+    return {
+        "msg_id": msg_id,
+        "sender_email": sender_email,
+        "folder_count": user_history_count,
+        "message_id_reply": message_id.strip('<>').replace('\n',''),
+        "subject": subject.replace('\n',''),
+        "email_message": email_message,
+    }
 
-    if not messages:
-        logging.info("✅ No unread emails found.")
+def process_deal(service, deal, jobs):
+    """
+    Extracts a deal's data, builds the Excel file and replies with it.
+
+    Each step is recorded in the job store and skipped when it already
+    completed, so a resumed deal does not repeat its LLM extraction.
+
+    Args:
+        service: Gmail API service instance
+        deal: Deal returned by acknowledge_email
+        jobs: jobs.JobStore recording the email's progress
+    """
+    # Heavy (openai, pandas, openpyxl); only imported once a deal actually needs them
+    import extract_data
+    import json_to_excel
+
+    msg_id = deal["msg_id"]
+    sender_email = deal["sender_email"]
+    user_history_count = deal["folder_count"]
+    message_id_reply = deal["message_id_reply"]
+    subject = deal["subject"]
+    print(f"{message_id_reply=}")
+    print(f"{subject=}")
+
+    job = jobs.get(msg_id)
+    submission_folder = os.path.join(BASE_DIR, "users", sender_email, user_history_count)
+    json_folder = os.path.join(submission_folder, "json_files")
+
+    if not reached(job, "extracted"):
+        # Start extracting data from all files in the attachment folder            
+        print(f"Attempting to run extract_data.py with: {sender_email}, {user_history_count}, {message_id_reply}, {subject}")
+        extract_data.extractor(sender_email, user_history_count, message_id_reply, analyze=False)
+        print("\n extract_data ran successfully")
+        artifacts = {"json_folder": json_folder}
+        run_timings = os.path.join(submission_folder, extract_data.RUN_TIMINGS_FILE)
+        if os.path.exists(run_timings):
+            artifacts["run_timings"] = run_timings
+        job = jobs.advance(msg_id, "extracted", artifacts)
+
+    if not reached(job, "analyzed"):
+        extract_data.analyze_statements(json_folder)
+        job = jobs.advance(msg_id, "analyzed")
+
+    if not reached(job, "excel_built"):
+        # Create an Excel file from the JSON files
+        excel_file = json_to_excel.create_excel_file(submission_folder)
+        print(f"📊 Excel file created: {excel_file}")
+        job = jobs.advance(msg_id, "excel_built", {"excel_file": excel_file})
+    excel_file = job["artifacts"].get("excel_file")
+
+    if reached(job, "replied"):
+        logging.info(f"⏭️ Results already sent to {sender_email} for email ID {msg_id}")
         return
 
-    logging.info(f"📧 Found {len(messages)} unread emails.")
+    # Send the Excel file as an attachment
+    random_salutation = mailer.get_salutation()
+    reply_text = f"{random_salutation}\n\nGreat news! 🎉 Your data has been processed 🏗️🔍, and the results are ready! 📊✅\n\nWe've attached the results 📎📂—take a look and let us know if you have any questions! 💡🤓\n\nBest,\nDealosophy 🤖✨"
     
-    for message in messages:
-        email_message = mailer.get_email_by_id(service, message['id'])
+    # Only try to send with attachment if we have a valid file
+    if excel_file and os.path.exists(excel_file):
+        success = mailer.send_reply(service, deal["email_message"], reply_text, [excel_file], idempotency_key=f"{msg_id}:results")
+    else:
+        print("Warning: No Excel file was created. Sending email without attachment.")
+        success = mailer.send_reply(service, deal["email_message"], reply_text, idempotency_key=f"{msg_id}:results")
+    if not success:
+        raise RuntimeError(f"Could not send the results to {sender_email}")
+    jobs.advance(msg_id, "replied")
+
+    logging.info(f"🚣‍♀️ Message info sent to extract_data.py {sender_email} {user_history_count} {message_id_reply} {subject}")
+
+def process_email(service, email_message, sender_email, jobs):
+    """
+    Acknowledges a registered sender's email, extracts the attached deal and replies with the Excel file.
+
+    Args:
+        service: Gmail API service instance
+        email_message: Full Gmail API message
+        sender_email: Address of the registered sender
+        jobs: jobs.JobStore recording the email's progress
+    """
+    deal = acknowledge_email(service, email_message, sender_email, jobs)
+    if deal:
+        process_deal(service, deal, jobs)
+
+def mark_done(labels, jobs, msg_id):
+    """
+    Marks a processed email as read right away and closes its job.
+
+    Raises:
+        RuntimeError: If the sender has not been sent what the job owes them,
+            so the email stays unread and the job is tried again
+    """
+    if not delivered(jobs.get(msg_id)):
+        raise RuntimeError(f"Email ID {msg_id} has not been answered yet, leaving it open")
+    labels.mark_as_read(msg_id)
+    labels.flush()
+    jobs.advance(msg_id, "marked_read")
+
+def resume_jobs(service, jobs, labels):
+    """
+    Finishes the emails a previous run left part way through.
+
+    Args:
+        service: Gmail API service instance
+        jobs: jobs.JobStore recording the emails' progress
+        labels: mailer.LabelBuffer collecting the emails to mark as read
+
+    Returns:
+        set: Message ids of the jobs attempted
+    """
+    unfinished = jobs.unfinished()
+    if unfinished:
+        logging.info(f"🔁 Resuming {len(unfinished)} unfinished emails")
+    for job in unfinished:
+        msg_id = job["message_id"]
+        email_message = mailer.get_email_by_id(service, msg_id)
         if not email_message:
-            logging.error(f"⚠ Could not retrieve email ID {message['id']}")
+            jobs.fail(msg_id, "message could not be fetched")
+            continue
+        try:
+            process_email(service, email_message, job["sender_email"], jobs)
+            mark_done(labels, jobs, msg_id)
+        except Exception as e:
+            jobs.fail(msg_id, e)
+            logging.error(f"⚠ Could not resume email ID {msg_id}. Error: {e}")
+        labels.flush_if_due()
+    return {job["message_id"] for job in unfinished}
+
+def registered_messages(service, message_ids, registered_users, labels):
+    """
+    Fetches the emails of registered senders, marking the others as read.
+
+    Args:
+        service: Gmail API service instance
+        message_ids: IDs of the new messages
+        registered_users: user_registry.UserRegistry (or set) of registered sender addresses
+        labels: mailer.LabelBuffer collecting the emails to mark as read
+
+    Returns:
+        list: (msg_id, full Gmail API message, sender email) of registered senders
+    """
+    # Fetch headers only, so unregistered senders are skipped before any full payload is downloaded
+    headers = mailer.batch_get_messages(
+        service, message_ids, format='metadata', metadata_headers=['From', 'Subject', 'Message-ID']
+    )
+
+    senders = {}
+    for msg_id in message_ids:
+        if msg_id not in headers:
+            logging.error(f"⚠ Could not retrieve email ID {msg_id}")
+            continue
+
+        sender, _, _ = mailer.extract_email_details(headers[msg_id])
+        if not sender:
+            logging.error("❌ Could not extract sender from email")
             continue
 
+        sender_email = parseaddr(sender)[1]
+        print(f"\nsender_from: {sender_email}")
+        
+        if sender_email.lower() not in registered_users:
+            logging.info(f"⛔ Skipping email from unregistered user: {sender_email}")
+            labels.mark_as_read(msg_id)
+            continue
+        senders[msg_id] = sender_email
+
+    # Download full messages for registered senders only
+    full_messages = mailer.batch_get_messages(service, list(senders), format='full')
+
+    emails = []
+    for msg_id, sender_email in senders.items():
+        if msg_id not in full_messages:
+            logging.error(f"⚠ Could not retrieve email ID {msg_id}")
+            continue
+        emails.append((msg_id, full_messages[msg_id], sender_email))
+    return emails
+
+def process_messages(service, message_ids, registered_users, labels, jobs, skip=()):
+    """
+    Processes one page of new emails.
+
+    Every email is acknowledged first; the deals are then run in the order
+    the scheduler picks, so senders take turns instead of the first one to
+    send many deals going first.
+
+    Args:
+        service: Gmail API service instance
+        message_ids: IDs of the new messages
+        registered_users: user_registry.UserRegistry (or set) of registered sender addresses
+        labels: mailer.LabelBuffer collecting the emails to mark as read
+        jobs: jobs.JobStore recording the emails' progress
+        skip: Message ids already attempted in this run
+    """
+    deals = DealScheduler(load_registered_users())
+    message_ids = [msg_id for msg_id in message_ids if msg_id not in skip]
+    for msg_id, email_message, sender_email in registered_messages(service, message_ids, registered_users, labels):
+        job = jobs.get(msg_id)
+        if reached(job, "marked_read"):
+            logging.info(f"⏭️ Email ID {msg_id} was already processed")
+            labels.mark_as_read(msg_id)
+            continue
+        if gave_up(job):
+            logging.info(f"⏭️ Email ID {msg_id} was given up after {job['attempts']} attempts: {job['error']}")
+            continue
         try:
-            # Extract email details
-            sender, subject, message_id = mailer.extract_email_details(email_message)
-            if not sender:
-                logging.error("❌ Could not extract sender from email")
-                continue
-
-            sender_email = parseaddr(sender)[1]
-            print(f"\nsender_from: {sender_email}")
-            
-            registered_users = load_registered_users()
-            if sender_email.lower() not in registered_users:
-                logging.info(f"⛔ Skipping email from unregistered user: {sender_email}")
-                mailer.mark_as_read(service, 'me', message['id'])
-                continue
-            
-            logging.info(f"📨 Processing email from: {sender_email}")
-
-            # Process attachments using mailer's function
-            has_attachment, user_history_count = mailer.process_email_attachments(
-                service,
-                email_message, 
-                sender_email, 
-                BASE_DIR
-            )
-            
-            # Prepare the reply text based on whether there's an attachment
-            random_salutation = mailer.get_salutation()
-            if has_attachment:
-                reply_text = f"{random_salutation}\n\nWe've received your email and attachments. Our 🤖 robots are working hard 🏗️ and will get back to you soon with the results. ✅🚀\n\nBest,\nDealosophy 🎯"
+            deal = acknowledge_email(service, email_message, sender_email, jobs)
+            if deal is None:
+                mark_done(labels, jobs, msg_id)
             else:
-                reply_text = f"{random_salutation}\n\nWe received an email from you but couldn't find any attachments. 📂❌ Could you please check and resend them? 🔄\n\nBest,\nDealosophy"
-                
-            # Send the reply
-            success = mailer.send_reply(service, email_message, reply_text)
+                deals.put(sender_email, deal)
 
-            if success:
-                logging.info(f"✅ Acknowledgment email successfully sent to {sender_email}")
-            else:
-                logging.error(f"❌ ERROR: Failed to send acknowledgment email to {sender_email}")
-
-            if has_attachment:
-                logging.info(f"📨 Email from: {sender_email}, Subject: {subject}, Received: {email_message['internalDate']}, Attachments: True, History: {user_history_count}")
-
-                message_id_reply = message_id.strip('<>').replace('\n','')
-                subject = subject.replace('\n','')
-                print(f"{message_id_reply=}")
-                print(f"{subject=}")
-
-                # Start extracting data from all files in the attachment folder            
-                print(f"Attempting to run extract_data.py with: {sender_email}, {user_history_count}, {message_id}, {subject}")
-                extract_data.extractor(sender_email, str(user_history_count), message_id_reply)
-                print("\n extract_data ran successfully")
-                
-                # Create an Excel file from the JSON files
-                excel_file = json_to_excel.create_excel_file(os.path.join(BASE_DIR, "users", sender_email, str(user_history_count)))
-                print(f"📊 Excel file created: {excel_file}")
-                
-                # Send the Excel file as an attachment
-                random_salutation = mailer.get_salutation()
-                reply_text = f"{random_salutation}\n\nGreat news! 🎉 Your data has been processed 🏗️🔍, and the results are ready! 📊✅\n\nWe've attached the results 📎📂—take a look and let us know if you have any questions! 💡🤓\n\nBest,\nDealosophy 🤖✨"
-                
-                # Only try to send with attachment if we have a valid file
-                if excel_file:
-                    mailer.send_reply(service, email_message, reply_text, [excel_file])
-                else:
-                    print("Warning: No Excel file was created. Sending email without attachment.")
-                    mailer.send_reply(service, email_message, reply_text)
-
-                logging.info(f"🚣‍♀️ Message info sent to extract_data.py {sender_email} {user_history_count} {message_id_reply} {subject}")
-            
-            # Mark the processed email as read    
-            mailer.mark_as_read(service, 'me', message['id'])
+        except Exception as e:
+            jobs.fail(msg_id, e)
+            print(f"message_id: {msg_id}")
+            print(f"Exception: {e}")
+            logging.error(f"⚠ Skipping email ID {msg_id}, could not process email. Error: {e}")
+        # Acknowledging can take a while; do not hold buffered label changes past their interval
+        labels.flush_if_due()
+
+    deals.close()
+    while True:
+        ticket = deals.get()
+        if ticket is None:
+            break
+        msg_id = ticket.item["msg_id"]
+        try:
+            process_deal(service, ticket.item, jobs)
+            mark_done(labels, jobs, msg_id)
 
         except Exception as e:
-            print(f"message_id: {message['id']}")
+            jobs.fail(msg_id, e)
+            print(f"message_id: {msg_id}")
             print(f"Exception: {e}")
-            logging.error(f"⚠ Skipping email ID {message['id']}, could not process email. Error: {e}")
+            logging.error(f"⚠ Skipping email ID {msg_id}, could not process email. Error: {e}")
+        finally:
+            deals.done(ticket)
+            labels.flush_if_due()
+    deals.log_metrics()
+
+def process_all_emails():
+    """Fetches and processes unread emails from Gmail."""
+    logging.info(f"📥 Checking for new emails ({mailer.GMAIL_SYNC_MODE} sync)...")
+    service = mailer.get_gmail_service()
+    registered_users = load_registered_users()
+    jobs = JobStore()
+
+    # Each page is processed as soon as it arrives, while the next one is being listed
+    total = 0
+    with mailer.LabelBuffer(service) as labels:
+        resumed = resume_jobs(service, jobs, labels)
+        for page in mailer.iter_message_pages(service):
+            total += len(page)
+            logging.info(f"📧 Found {len(page)} new emails ({total} so far).")
+            process_messages(service, [message['id'] for message in page], registered_users, labels, jobs, resumed)
+
+    retry.log_stats()
+    assistant_runs.log_stats()
+    if not total:
+        logging.info("✅ No new emails found.")
+        return
 
-    logging.info("✅ Finished processing all unread emails.")
+    logging.info("✅ Finished processing all new emails.")
 
 if __name__ == '__main__':
     process_all_emails()
\ No newline at end of file
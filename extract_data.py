@@ -1,111 +1,142 @@
 import time
 import json
-import re
-import sys
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from prompts import *
-from openai import OpenAI
 from dotenv import load_dotenv
+import assistant_runs
+from assistant_runs import run_and_wait
+from json_stream import StreamingJSONParser
+from openai_cache import OpenAIFileCache, sha256_file
+import rate_limiter
+import result_cache
+import structured_extraction
+import summarizer
+import tabular_extraction
+import page_locator
 from config import BASE_DIR
 from financial_analysis import analyze_json_file
 from vertical_analysis import analyze_vertical
 load_dotenv()
 
-def setup_openai_resources(file_paths):
-    client = OpenAI()
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo")
+
+# Number of extraction prompts dispatched at once. 1 keeps the original
+# behaviour of running every prompt one after another on a shared thread.
+EXTRACTION_CONCURRENCY = int(os.getenv("EXTRACTION_CONCURRENCY", "5"))
+
+# "assistants" runs one Assistants/file_search call per prompt, "structured"
+# extracts every section in a single structured-output call
+EXTRACTION_ENGINE = os.getenv("EXTRACTION_ENGINE", "assistants")
+
+# "per_prompt" gives every prompt its own thread so a run's input does not grow
+# with the prompts before it; "shared" runs them all on one thread. Concurrent
+# extraction always uses one thread per prompt.
+EXTRACTION_THREAD_MODE = os.getenv("EXTRACTION_THREAD_MODE", "per_prompt")
+
+# How many times a prompt is re-run when its reply is not valid JSON
+JSON_RETRIES = int(os.getenv("JSON_RETRIES", "2"))
+
+# Prompts run for every deal, paired with the JSON file each one produces
+EXTRACTION_JOBS = [
+    (COMPANY_INFO_PROMPT, "company_info.json"),
+    (INCOME_STATEMENT_PROMPT, "income_statement.json"),
+    (BALANCE_SHEET_PROMPT, "balance_sheet.json"),
+    (ADJUSTMENTS_PROMPT, "adjustments.json"),
+    (SUMMARY_PROMPT, "summary.json"),
+]
+SUMMARY_JOB = EXTRACTION_JOBS[-1]
+
+# Compute summary.json from the extracted statements instead of asking the
+# model, falling back to SUMMARY_PROMPT when the line items cannot be mapped
+LOCAL_SUMMARY = os.getenv("LOCAL_SUMMARY", "1") == "1"
+
+# Per-run latency breakdown written next to the deal's json_files folder
+RUN_TIMINGS_FILE = "run_timings.json"
+
+def setup_openai_resources(file_paths, client=None):
+    client = client or rate_limiter.openai_client()
     
     # Create the assistant
     assistant = client.beta.assistants.create(
         name="Data Extractor",
         instructions="You are great at extracting data from files and and a master CFO.",
         tools = [{'type':'file_search'}],
-        model = 'gpt-4-turbo'
-    )
-
-    # Create a vector store 
-    vector_store = client.beta.vector_stores.create(name="Company Data")
-    
-    # Open all valid files for uploading
-    file_streams = [open(path, "rb") for path in file_paths]
-
-    # Upload files and poll status
-    file_batch = client.beta.vector_stores.file_batches.upload_and_poll(
-        vector_store_id=vector_store.id, files=file_streams
+        model = OPENAI_MODEL
     )
 
-    print(f"✅ Uploaded {len(file_streams)} files to OpenAI")
+    # Reuse uploads and vector stores for content OpenAI has already seen
+    vector_store_id = OpenAIFileCache(client).vector_store_for(file_paths)
+    print(f"✅ {len(file_paths)} files available to the assistant in vector store {vector_store_id}")
 
     # Update the assistant with the vector store id(s)
     assistant = client.beta.assistants.update(
         assistant_id=assistant.id,
-        tool_resources={"file_search": {"vector_store_ids": [vector_store.id]}},
+        tool_resources={"file_search": {"vector_store_ids": [vector_store_id]}},
     )
 
     # Create a thread
     thread = client.beta.threads.create()
     
     # Return the resources needed for other functions
-    return client, assistant.id, thread.id, vector_store.id
-
+    return client, assistant.id, thread.id, vector_store_id
 
-def extract_and_save(client, assistant_id, thread_id, prompt, filename):
-    """Function to extract financial data and save as JSON"""
-    os.makedirs(os.path.dirname(filename), exist_ok=True)  # ✅ Ensure json_files/ is created before saving
-    
-    # Create the message
-    message = client.beta.threads.messages.create(
-        thread_id=thread_id,
-        role='user',
-        content=prompt
-    )
-    
-    # Create a run for the thread
-    run = client.beta.threads.runs.create(
-        assistant_id=assistant_id,
-        thread_id=thread_id
-    )
 
-    # Wait for the assistant to complete the run
-    while run.status not in ["completed", "failed", "cancelled"]:
-        print(f"Waiting for completion... Current status: {run.status}")
-        time.sleep(3) # Wait for 3 seconds before checking again
-        run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-
-    # Now fetch messages
+def latest_reply(client, thread_id, run_id):
+    """Returns the text of the newest assistant message written by a run, or None."""
     messages = client.beta.threads.messages.list(
         thread_id=thread_id,
-        order='asc'
+        run_id=run_id,
+        order='desc',
+        limit=1
     )
-
-    # Extract only the last assistant response
-    assistant_response = None
     for message in messages:
         if message.role == "assistant" and hasattr(message, "content") and message.content:
-            assistant_response = message.content[0].text.value
-            #print(assistant_response)
-    print("Raw Assistant Response:", assistant_response)
+            return message.content[0].text.value
+        break
+    return None
+
+def extract_and_save(client, assistant_id, thread_id, prompt, filename, retries=JSON_RETRIES, **run_options):
+    """Function to extract financial data and save as JSON"""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)  # ✅ Ensure json_files/ is created before saving
 
-        # Ensure valid JSON response
     parsed_json = None
-    if assistant_response:
-        try:
-            # Remove Markdown JSON formatting artifacts
-            cleaned_response = assistant_response.strip("```json").strip("```").strip()
-
-            # Try regex to remove unexpected text before/after JSON
-            cleaned_response = re.sub(r"^[^{]*|[^}]*$", "", cleaned_response).strip()
-
-            # Fix keys that may have unnecessary spaces
-            parsed_json = json.loads(cleaned_response)
-            #parsed_json = {key.strip(): value for key, value in parsed_json.items()}  # Trim spaces in keys
-            
-            #print(json.dumps(parsed_json, indent=4))  # Pretty-print JSON
-        except json.JSONDecodeError:
-            print("Received response is not valid JSON. Attempting cleanup...")
-            print("Error Content:", assistant_response)
-    else:
-        print("No valid response received.")
+    for attempt in range(retries + 1):
+        if attempt:
+            # Start over on a fresh thread so the broken reply is not part of the context
+            print(f"🔁 Retrying {os.path.basename(filename)} (attempt {attempt + 1} of {retries + 1})")
+            thread_id = client.beta.threads.create().id
+
+        # Create the message
+        client.beta.threads.messages.create(
+            thread_id=thread_id,
+            role='user',
+            content=prompt
+        )
+
+        # Run the assistant, validating the reply as it streams in
+        parser = StreamingJSONParser()
+        file_search = run_options.get("tool_choice") != "none"
+        with rate_limiter.expect_tokens(rate_limiter.estimate_prompt_tokens(prompt, file_search)):
+            run, timings = run_and_wait(client, assistant_id, thread_id, on_text=parser.feed, **run_options)
+        assistant_runs.record(os.path.basename(filename), timings, deal=os.path.dirname(filename))
+        if parser.failed:
+            print(f"❌ Reply for {os.path.basename(filename)} can no longer become valid JSON, run aborted: {parser.error}")
+            continue
+        if run.status != "completed":
+            print(f"❌ Run {run.id} ended with status {run.status}")
+            continue
+
+        if not parser.received:
+            # The run was polled rather than streamed; fetch the reply it wrote
+            parser.feed(latest_reply(client, thread_id, run.id) or "")
+        print("Raw Assistant Response:", parser.raw_text())
 
+        # Ensure valid JSON response
+        parsed_json = parser.result()
+        if parsed_json is not None:
+            break
+        print(f"Received response is not valid JSON: {parser.error}")
 
     # Write to a file
     if parsed_json:
@@ -115,7 +146,195 @@ def extract_and_save(client, assistant_id, thread_id, prompt, filename):
     else:
         print("No valid JSON received. Skipping file write.")
 
-def extractor(sender_email, folder_count, message_id_reply):
+    return parsed_json
+
+def section_job(prompt, filename, excerpts):
+    """
+    Returns the prompt and run options for one job.
+
+    When the page locator found the pages for this job, they are inlined into
+    the prompt and file search is switched off for the run.
+    """
+    if filename not in excerpts:
+        return prompt, {}
+    return SECTION_EXCERPT_PROMPT.format(prompt=prompt, excerpt=excerpts[filename]), {"tool_choice": "none"}
+
+def extract_concurrently(client, assistant_id, jobs, json_folder, max_workers=EXTRACTION_CONCURRENCY, excerpts=None):
+    """
+    Run several extraction prompts at the same time.
+
+    Every prompt gets its own thread against the assistant's vector store, so the
+    runs do not queue behind each other. Each JSON file is written by
+    extract_and_save as soon as its own run finishes.
+
+    Args:
+        client: OpenAI client (or any object exposing the same beta.threads API)
+        assistant_id: Assistant that has the deal's vector store attached
+        jobs: List of (prompt, filename) tuples
+        json_folder: Folder the JSON files are written to
+        max_workers: Maximum number of runs in flight
+        excerpts: filename -> page excerpt from the page locator
+
+    Returns:
+        dict: filename -> parsed JSON (None when the prompt produced nothing)
+    """
+    def run_job(prompt, filename):
+        thread = client.beta.threads.create()
+        prompt, run_options = section_job(prompt, filename, excerpts or {})
+        return extract_and_save(client, assistant_id, thread.id, prompt, os.path.join(json_folder, filename), **run_options)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(run_job, prompt, filename): filename for prompt, filename in jobs}
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                results[filename] = future.result()
+            except Exception as e:
+                print(f"❌ Extraction of {filename} failed: {e}")
+                results[filename] = None
+    return results
+
+def run_extraction_jobs(file_paths, jobs, json_folder, excerpts=None):
+    """
+    Runs extraction prompts against the given files with the configured engine.
+
+    Args:
+        file_paths: Attachments the model reads
+        jobs: List of (prompt, filename) tuples
+        json_folder: Folder the JSON files are written to
+        excerpts: filename -> page excerpt from the page locator
+
+    Returns:
+        dict: filename -> parsed JSON (None when the prompt produced nothing)
+    """
+    start_time = time.time()
+    if uses_structured_engine(file_paths):
+        results = structured_extraction.extract_all(rate_limiter.openai_client(), file_paths, json_folder,
+                                                    filenames={filename for _, filename in jobs})
+    else:
+        if EXTRACTION_ENGINE == "structured":
+            print("⚠️ Some attachments cannot be sent in a single structured call, using the Assistants engine")
+        results = run_assistant_jobs(file_paths, jobs, json_folder, excerpts)
+    print(f"⏱️ {EXTRACTION_ENGINE} extraction of {len(jobs)} prompts took {time.time() - start_time:.2f} seconds")
+    return results
+
+def uses_structured_engine(file_paths):
+    """Returns True if these files go through the single structured-output call."""
+    return EXTRACTION_ENGINE == "structured" and structured_extraction.is_supported(file_paths)
+
+def extraction_model(file_paths):
+    """Returns the label of the engine and model that will extract these files, used in cache keys."""
+    if uses_structured_engine(file_paths):
+        return f"structured:{structured_extraction.STRUCTURED_MODEL}"
+    return OPENAI_MODEL
+
+def extraction_context(file_paths, filename, excerpts):
+    """
+    Returns the text, besides the job's own prompt, that the model gets for this job; part of its cache key.
+
+    The page excerpt itself is included, so changing the page locator's
+    keywords or page budget changes the key of every job it inlines pages for.
+    """
+    if uses_structured_engine(file_paths):
+        return [structured_extraction.build_prompt(), json.dumps(structured_extraction.DEAL_SCHEMA, sort_keys=True)]
+    if filename in excerpts:
+        return [SECTION_EXCERPT_PROMPT, excerpts[filename]]
+    return []
+
+def run_assistant_jobs(file_paths, jobs, json_folder, excerpts=None):
+    """
+    Runs extraction prompts against the given files with the Assistants API, one run per prompt.
+
+    Args:
+        file_paths: Attachments the assistant searches
+        jobs: List of (prompt, filename) tuples
+        json_folder: Folder the JSON files are written to
+        excerpts: filename -> page excerpt from the page locator
+
+    Returns:
+        dict: filename -> parsed JSON (None when the prompt produced nothing)
+    """
+    # Set up OpenAI resources
+    client, assistant_id, thread_id, vector_store_id = setup_openai_resources(file_paths)
+    
+    # Locate Income Statement(s)
+    #check_data_existence(INCOME_STATEMENT_LOCATE, file_paths, "income statement")
+
+    if EXTRACTION_CONCURRENCY > 1:
+        # Dispatch all prompts together, one thread per prompt
+        return extract_concurrently(client, assistant_id, jobs, json_folder, excerpts=excerpts)
+
+    # Company info, income statement, balance sheet, adjustments and summary in turn
+    results = {}
+    for prompt, filename in jobs:
+        if EXTRACTION_THREAD_MODE == "per_prompt":
+            # A fresh thread keeps earlier prompts and replies out of this run's input
+            thread_id = client.beta.threads.create().id
+        job_prompt, run_options = section_job(prompt, filename, excerpts or {})
+        results[filename] = extract_and_save(client, assistant_id, thread_id, job_prompt, os.path.join(json_folder, filename), **run_options)
+    return results
+
+def extract_with_cache(file_paths, jobs, json_folder, attachment_hashes, excerpts=None):
+    """
+    Runs extraction prompts, serving those whose inputs are unchanged from the result cache.
+
+    Args:
+        file_paths: Attachments the model reads
+        jobs: List of (prompt, filename) tuples
+        json_folder: Folder the JSON files are written to
+        attachment_hashes: SHA-256 of each attachment
+        excerpts: filename -> page excerpt from the page locator
+
+    Returns:
+        dict: filename -> parsed JSON for the prompts that had to be run
+    """
+    model = extraction_model(file_paths)
+    cache_keys = {
+        filename: result_cache.cache_key(attachment_hashes, prompt, model,
+                                         extraction_context(file_paths, filename, excerpts or {}))
+        for prompt, filename in jobs
+    }
+    pending_jobs = [(prompt, filename) for prompt, filename in jobs
+                    if result_cache.load_into(cache_keys[filename], os.path.join(json_folder, filename)) is None]
+
+    if not pending_jobs:
+        print("♻️ All extraction results served from the cache, no OpenAI calls needed")
+        return {}
+
+    results = run_extraction_jobs(file_paths, pending_jobs, json_folder, excerpts)
+    for prompt, filename in pending_jobs:
+        if results.get(filename):
+            result_cache.store(cache_keys[filename], results[filename], prompt, model)
+    return results
+
+def analyze_statements(json_folder):
+    """
+    Runs the financial and vertical analyses on the extracted statements.
+
+    Args:
+        json_folder: The deal's json_files folder
+
+    Returns:
+        The financial analysis result, or None when summary.json is missing
+    """
+    # Send json.summary file to financial_analysis.py
+    summary_path = os.path.join(json_folder, "summary.json")
+    if os.path.exists(summary_path):
+        print(f"✅ Found summary.json file at: {summary_path}")
+        # Analyze the file
+        financial_analysis_result = analyze_json_file(summary_path)
+        
+        # Perform vertical analysis on the same folder
+        vertical_analysis_result = analyze_vertical(json_folder)
+        
+        return financial_analysis_result
+    else:
+        print(f"❌ summary.json not found in: {json_folder}")
+        return None
+
+
+def extractor(sender_email, folder_count, message_id_reply, analyze=True):
         
     user_email = sender_email
     user_history_count = str(folder_count)
@@ -140,8 +359,7 @@ def extractor(sender_email, folder_count, message_id_reply):
 
     # ✅ Verify attachments folder exists
     if not os.path.exists(attachments_folder):
-        print(f"❌ ERROR: Attachments folder does not exist: {attachments_folder}")
-        sys.exit(1)
+        raise FileNotFoundError(f"❌ ERROR: Attachments folder does not exist: {attachments_folder}")
 
     # ✅ Define acceptable file formats for OpenAI processing
     ACCEPTABLE_FORMATS = (".pdf", ".docx", ".xlsx", ".csv", ".txt")  
@@ -152,52 +370,39 @@ def extractor(sender_email, folder_count, message_id_reply):
                 if file.lower().endswith(ACCEPTABLE_FORMATS)]
 
     if not file_paths:
-        print(f"❌ No valid files found in {attachments_folder}")
-        sys.exit(1)
+        raise ValueError(f"❌ No valid files found in {attachments_folder}")
 
     print(f"\n📂 Files found for processing: {file_paths}")  # Debugging log
 
-    if not file_paths:
-        print(f"❌ No valid files found in {attachments_folder}")
-        sys.exit(1)
-
-    
-     # Set up OpenAI resources
-    client, assistant_id, thread_id, vector_store_id = setup_openai_resources(file_paths)
-    
-    # Locate Income Statement(s)
-    #check_data_existence(INCOME_STATEMENT_LOCATE, file_paths, "income statement")
-
-    # # Extract Company Info
-    extract_and_save(client, assistant_id, thread_id, COMPANY_INFO_PROMPT, os.path.join(json_folder, "company_info.json"))
-
-    # # Extract Income Statement
-    extract_and_save(client, assistant_id, thread_id, INCOME_STATEMENT_PROMPT, os.path.join(json_folder, "income_statement.json"))
-
-    # # Extract Balance Sheet
-    extract_and_save(client, assistant_id, thread_id, BALANCE_SHEET_PROMPT, os.path.join(json_folder, "balance_sheet.json"))
-
-    # # Extract Adjustments
-    extract_and_save(client, assistant_id, thread_id, ADJUSTMENTS_PROMPT, os.path.join(json_folder, "adjustments.json"))
-
-    # # Extract Summary
-    extract_and_save(client, assistant_id, thread_id, SUMMARY_PROMPT, os.path.join(json_folder, "summary.json"))
+    # Spreadsheets and CSVs are parsed locally; only sheets that cannot be classified go to the model
+    local_files, file_paths = tabular_extraction.extract_tables(file_paths, json_folder)
+    attachment_hashes = [sha256_file(path) for path in file_paths]
+
+    jobs = [job for job in EXTRACTION_JOBS if job[1] not in local_files]
+    if local_files or (LOCAL_SUMMARY and not uses_structured_engine(file_paths)):
+        # The summary is derived locally from the statements once they are extracted
+        jobs = [job for job in jobs if job != SUMMARY_JOB]
+    # Send each prompt only the PDF pages that hold its section, when they can be located
+    excerpts = {}
+    if file_paths and not uses_structured_engine(file_paths):
+        excerpts = page_locator.locate_sections(file_paths, os.path.join(USER_FOLDER_PATH, user_history_count))
+
+    if file_paths and jobs:
+        extract_with_cache(file_paths, jobs, json_folder, attachment_hashes, excerpts)
+
+    if SUMMARY_JOB not in jobs and not summarizer.write_summary(json_folder) and file_paths:
+        print("🤖 Falling back to the LLM summary")
+        extract_with_cache(file_paths, [SUMMARY_JOB], json_folder, attachment_hashes, excerpts)
+
+    # Queued and in-progress time of every run, kept with the deal
+    run_timings = assistant_runs.timings_for(json_folder)
+    if run_timings:
+        with open(os.path.join(USER_FOLDER_PATH, user_history_count, RUN_TIMINGS_FILE), "w") as f:
+            json.dump(run_timings, f, indent=4)
     
-    # Send json.summary file to financial_analysis.py
-    summary_path = os.path.join(json_folder, "summary.json")
-    if os.path.exists(summary_path):
-        print(f"✅ Found summary.json file at: {summary_path}")
-        # Analyze the file
-        financial_analysis_result = analyze_json_file(summary_path)
-        
-        # Perform vertical analysis on the same folder
-        vertical_analysis_result = analyze_vertical(json_folder)
-        
-        return financial_analysis_result
-    else:
-        print(f"❌ summary.json not found in: {json_folder}")
-        return None
-
+    if not analyze:
+        return json_folder
+    return analyze_statements(json_folder)
 
     # # Extract Cash Flow Statement
     # #extract_and_save(CASH_FLOW_STATEMENT_PROMPT, "cash_flow_statement.json")
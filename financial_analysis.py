@@ -1,6 +1,7 @@
 import json
 import os
 import logging
+import numpy as np
 from uncertainties import ufloat
 
 # Configure detailed logging
@@ -38,224 +39,241 @@ def format_value(value, is_percentage=False):
         logging.error(f"Error formatting value {value}: {e}")
         return ""
 
-def calculate_financial_metrics(summary_data):
-    """Calculates financial metrics from summary data."""
+# Summary lines the metrics are computed from, one row of the value matrix each
+METRIC_INPUTS = [
+    "Revenue", "COGS", "Gross Margin", "Operating Expenses", "EBIT", "Interest Paid", "Taxes",
+    "Net Income", "Cash", "Accounts Receivable", "Inventory", "Current Assets", "Accounts Payable",
+    "Current Liabilities", "Total Liabilities", "Total Assets", "Total Shareholders' Equity",
+    "Number of Employees", "SDE",
+]
+ROW = {key: row for row, key in enumerate(METRIC_INPUTS)}
+
+# From this metric on, years whose pretax income cannot be looked up are left out (see pretax_years())
+PRETAX_DEPENDENT_FROM = "Effective Tax Rate (%)"
+
+def add_balance_sheet_totals(summary_data, num_years):
+    """Adds Non-current Assets and Long-term Liabilities to the summary data."""
+    summary_data["Non-current Assets"] = []
+    summary_data["Long-term Liabilities"] = []
+
+    for i in range(num_years):
+        current_assets = float(summary_data["Current Assets"][i]) if summary_data["Current Assets"][i] not in ["", None] else 0
+        total_assets = float(summary_data["Total Assets"][i]) if summary_data["Total Assets"][i] not in ["", None] else 0
+        summary_data["Non-current Assets"].append(total_assets - current_assets if total_assets != 0 else "")
+
+        current_liabilities = float(summary_data["Current Liabilities"][i]) if summary_data["Current Liabilities"][i] not in ["", None] else 0
+        total_liabilities = float(summary_data["Total Liabilities"][i]) if summary_data["Total Liabilities"][i] not in ["", None] else 0
+        summary_data["Long-term Liabilities"].append(total_liabilities - current_liabilities if total_liabilities != 0 else "")
+
+def parse_values(key, values):
+    """
+    Converts one line of the summary to numbers.
+
+    Blanks count as 0. If any entry is not a number, the line is kept as
+    given and only its int and float entries are usable.
+
+    Returns:
+        tuple: (list of floats, list of bools marking the usable entries)
+    """
     try:
-        # Sort years in ascending order
-        years = sorted(summary_data["Years"])
-        num_years = len(years)
-        results = {"Years": years}
-        logging.info(f"Processing {num_years} years of data: {years}")
-        
-        # Add Non-current Assets and Long-term Liabilities calculations
-        summary_data["Non-current Assets"] = []
-        summary_data["Long-term Liabilities"] = []
-        
-        for i in range(num_years):
-            # Calculate Non-current Assets
-            current_assets = float(summary_data["Current Assets"][i]) if summary_data["Current Assets"][i] not in ["", None] else 0
-            total_assets = float(summary_data["Total Assets"][i]) if summary_data["Total Assets"][i] not in ["", None] else 0
-            non_current_assets = total_assets - current_assets if total_assets != 0 else ""
-            summary_data["Non-current Assets"].append(non_current_assets)
-            
-            # Calculate Long-term Liabilities
-            current_liabilities = float(summary_data["Current Liabilities"][i]) if summary_data["Current Liabilities"][i] not in ["", None] else 0
-            total_liabilities = float(summary_data["Total Liabilities"][i]) if summary_data["Total Liabilities"][i] not in ["", None] else 0
-            long_term_liabilities = total_liabilities - current_liabilities if total_liabilities != 0 else ""
-            summary_data["Long-term Liabilities"].append(long_term_liabilities)
-        
-        # Log the raw input data
-        logging.info(f"Input summary data: {json.dumps(summary_data, indent=2)}")
-
-        # Helper function to get values, handling missing keys and blank values
-        def get_values(key):
-            values = summary_data.get(key, [""] * num_years)
-            # Add detailed logging for each metric's raw values
-            logging.info(f"Raw values for {key}: {values}")
-            # Convert string numbers to float if possible
-            try:
-                # Convert empty strings or None to 0, otherwise convert to float
-                values = [float(v) if v not in ["", None] else 0 for v in values]
-            except ValueError:
-                logging.error(f"Could not convert values for {key} to float: {values}")
-            logging.info(f"Processed values for {key}: {values}")
-            return values
-
-        # Get all required values with detailed logging
-        metrics = {
-            "Revenue": get_values("Revenue"),
-            "COGS": get_values("COGS"),
-            "Gross Margin": get_values("Gross Margin"),
-            "Operating Expenses": get_values("Operating Expenses"),
-            "EBIT": get_values("EBIT"),
-            "Interest Paid": get_values("Interest Paid"),
-            "Taxes": get_values("Taxes"),  # This will now convert empty strings to 0
-            "Net Income": get_values("Net Income"),
-            "Cash": get_values("Cash"),
-            "Accounts Receivable": get_values("Accounts Receivable"),
-            "Inventory": get_values("Inventory"),
-            "Current Assets": get_values("Current Assets"),
-            "Accounts Payable": get_values("Accounts Payable"),
-            "Current Liabilities": get_values("Current Liabilities"),
-            "Total Liabilities": get_values("Total Liabilities"),  # Fixed typo here
-            "Total Assets": get_values("Total Assets"),
-            "Total Shareholders' Equity": get_values("Total Shareholders' Equity"),
-            "Number of Employees": get_values("Number of Employees"),
-            "SDE": get_values("SDE")
-        }
-
-        logging.info("Processed metrics data:")
-        for key, value in metrics.items():
-            logging.info(f"{key}: {value}")
-
-        for i in range(num_years):
-            logging.info(f"\nProcessing year {years[i]}")
-            try:
-                # Process each metric with error handling
-                def safe_calculate(metric_name, calculation, is_percentage=False):
-                    try:
-                        result = calculation()
-                        if result is None:
-                            logging.warning(f"{metric_name} calculation returned None")
-                            results.setdefault(metric_name, []).append("")
-                            return
-                            
-                        formatted_result = format_value(result, is_percentage)
-                        results.setdefault(metric_name, []).append(formatted_result)
-                        logging.info(f"Successfully calculated {metric_name} for {years[i]}: {formatted_result}")
-                    except Exception as e:
-                        logging.error(f"Error calculating {metric_name} for {years[i]}: {e}")
-                        logging.error(f"Values used in calculation: {[metrics[k][i] if k in metrics else 'Missing' for k in calculation.__code__.co_names if k in metrics]}")
-                        results.setdefault(metric_name, []).append("")
-
-                # Revenue Growth Rate
-                safe_calculate(
-                    "Revenue Growth Rate (%)",
-                    lambda: ((metrics["Revenue"][i] - metrics["Revenue"][i-1]) / metrics["Revenue"][i-1] * 100) if i > 0 and isinstance(metrics["Revenue"][i], (int, float)) and isinstance(metrics["Revenue"][i-1], (int, float)) and metrics["Revenue"][i-1] != 0 else None,
-                    True
-                )
-
-                # Gross Margin
-                safe_calculate(
-                    "Gross Margin (%)",
-                    lambda: ((metrics["Revenue"][i] - metrics["COGS"][i]) / metrics["Revenue"][i] * 100) if isinstance(metrics["Revenue"][i], (int, float)) and isinstance(metrics["COGS"][i], (int, float)) and metrics["Revenue"][i] != 0 else None,
-                    True
-                )
-
-                # Gross Margin Expansion
-                safe_calculate(
-                    "Gross Margin Expansion (%)",
-                    lambda: ((metrics["Gross Margin"][i] - metrics["Gross Margin"][i-1]) / metrics["Gross Margin"][i-1] * 100) if i > 0 and isinstance(metrics["Gross Margin"][i], (int, float)) and isinstance(metrics["Gross Margin"][i-1], (int, float)) and metrics["Gross Margin"][i-1] != 0 else None,
-                    True
-                )
-
-                # Net Margin
-                safe_calculate(
-                    "Net Margin (%)",
-                    lambda: ((metrics["Net Income"][i] / metrics["Revenue"][i]) * 100) if isinstance(metrics["Net Income"][i], (int, float)) and isinstance(metrics["Revenue"][i], (int, float)) and metrics["Revenue"][i] != 0 else None,
-                    True
-                )
-
-                # Net Income Growth Rate
-                safe_calculate(
-                    "Net Income Growth Rate (%)",
-                    lambda: ((metrics["Net Income"][i] - metrics["Net Income"][i-1]) / metrics["Net Income"][i-1] * 100) if i > 0 and isinstance(metrics["Net Income"][i], (int, float)) and isinstance(metrics["Net Income"][i-1], (int, float)) and metrics["Net Income"][i-1] != 0 else None,
-                    True
-                )
-
-                # Inventory Turnover Per Year
-                safe_calculate(
-                    "Inventory Turnover Per Year",
-                    lambda: (metrics["COGS"][i] / metrics["Inventory"][i]) if isinstance(metrics["COGS"][i], (int, float)) and isinstance(metrics["Inventory"][i], (int, float)) and metrics["Inventory"][i] != 0 else None
-                )
-
-                # Days to Turn Inventory
-                safe_calculate(
-                    "Days to Turn Inventory (Days)",
-                    lambda: ((metrics["Inventory"][i] / metrics["COGS"][i]) * 365) if isinstance(metrics["Inventory"][i], (int, float)) and isinstance(metrics["COGS"][i], (int, float)) and metrics["COGS"][i] != 0 else None
-                )
-
-                # Days Sales Outstanding (DSO)
-                safe_calculate(
-                    "Days Sales Outstanding (DSO) (Days)",
-                    lambda: ((metrics["Accounts Receivable"][i] / metrics["Revenue"][i]) * 365) if isinstance(metrics["Accounts Receivable"][i], (int, float)) and isinstance(metrics["Revenue"][i], (int, float)) and metrics["Revenue"][i] != 0 else None
-                )
-
-                # Days in Payables
-                safe_calculate(
-                    "Days in Payables (Days)",
-                    lambda: ((metrics["Accounts Payable"][i] / metrics["COGS"][i]) * 365) if isinstance(metrics["Accounts Payable"][i], (int, float)) and isinstance(metrics["COGS"][i], (int, float)) and metrics["COGS"][i] != 0 else None
-                )
-
-                # Interest Coverage Ratio
-                safe_calculate(
-                    "Interest Coverage Ratio",
-                    lambda: (metrics["EBIT"][i] / metrics["Interest Paid"][i]) if isinstance(metrics["EBIT"][i], (int, float)) and isinstance(metrics["Interest Paid"][i], (int, float)) and metrics["Interest Paid"][i] != 0 else None
-                )
-
-                # Current Ratio
-                safe_calculate(
-                    "Current Ratio",
-                    lambda: (metrics["Current Assets"][i] / metrics["Current Liabilities"][i]) if isinstance(metrics["Current Assets"][i], (int, float)) and isinstance(metrics["Current Liabilities"][i], (int, float)) and metrics["Current Liabilities"][i] != 0 else None
-                )
-
-                # Acid Test Ratio
-                safe_calculate(
-                    "Acid Test Ratio",
-                    lambda: ((metrics["Current Assets"][i] - metrics["Inventory"][i]) / metrics["Current Liabilities"][i]) if isinstance(metrics["Current Assets"][i], (int, float)) and isinstance(metrics["Inventory"][i], (int, float)) and isinstance(metrics["Current Liabilities"][i], (int, float)) and metrics["Current Liabilities"][i] != 0 else None
-                )
-
-                # Debt-to-Equity Ratio
-                safe_calculate(
-                    "Debt-to-Equity Ratio",
-                    lambda: (metrics["Total Liabilities"][i] / metrics["Total Shareholders' Equity"][i]) if isinstance(metrics["Total Liabilities"][i], (int, float)) and isinstance(metrics["Total Shareholders' Equity"][i], (int, float)) and metrics["Total Shareholders' Equity"][i] != 0 else None
-                )
-
-                # Return on Equity (ROE)
-                safe_calculate(
-                    "Return on Equity (ROE)",
-                    lambda: ((metrics["Net Income"][i] / metrics["Total Shareholders' Equity"][i]) * 100) if isinstance(metrics["Net Income"][i], (int, float)) and isinstance(metrics["Total Shareholders' Equity"][i], (int, float)) and metrics["Total Shareholders' Equity"][i] != 0 else None,
-                    True
-                )
-
-                # RoR on Total Assets
-                safe_calculate(
-                    "RoR on Total Assets",
-                    lambda: ((metrics["Net Income"][i] / metrics["Total Assets"][i]) * 100) if isinstance(metrics["Net Income"][i], (int, float)) and isinstance(metrics["Total Assets"][i], (int, float)) and metrics["Total Assets"][i] != 0 else None,
-                    True
-                )
-
-                # Effective Tax Rate
-                pretax_income = metrics["EBIT"][i] - metrics["Interest Paid"][i] if isinstance(metrics["EBIT"][i], (int, float)) and isinstance(metrics["Interest Paid"][i], (int, float)) else None
-                safe_calculate(
-                    "Effective Tax Rate (%)",
-                    lambda: ((metrics["Taxes"][i] / pretax_income) * 100) if isinstance(metrics["Taxes"][i], (int, float)) and isinstance(pretax_income, (int, float)) and pretax_income != 0 else None,
-                    True
-                )
-
-                # Revenue per employee
-                safe_calculate(
-                    "Revenue per employee ($)",
-                    lambda: (metrics["Revenue"][i] / metrics["Number of Employees"][i]) if isinstance(metrics["Revenue"][i], (int, float)) and isinstance(metrics["Number of Employees"][i], (int, float)) and metrics["Number of Employees"][i] != 0 else None
-                )
-
-                # Net Income per employee
-                safe_calculate(
-                    "Net Income per employee ($)",
-                    lambda: (metrics["Net Income"][i] / metrics["Number of Employees"][i]) if isinstance(metrics["Net Income"][i], (int, float)) and isinstance(metrics["Number of Employees"][i], (int, float)) and metrics["Number of Employees"][i] != 0 else None
-                )
-
-                # SDE multiple
-                safe_calculate(
-                    "SDE/EBIT multiple",
-                    lambda: (metrics["SDE"][i] / metrics["EBIT"][i]) if isinstance(metrics["SDE"][i], (int, float)) and isinstance(metrics["EBIT"][i], (int, float)) and metrics["EBIT"][i] != 0 else None
-                )
-
-            except Exception as e:
-                logging.error(f"Error processing year {years[i]}: {e}")
+        return [float(v) if v not in ["", None] else 0.0 for v in values], [True] * len(values)
+    except ValueError:
+        logging.error(f"Could not convert values for {key} to float: {values}")
+        valid = [isinstance(v, (int, float)) for v in values]
+        return [float(v) if ok else 0.0 for v, ok in zip(values, valid)], valid
+
+def parse_summary(summary_data, num_years):
+    """Parses every METRIC_INPUTS line of a summary; a missing line counts as num_years blanks."""
+    return [parse_values(key, summary_data.get(key, [""] * num_years)) for key in METRIC_INPUTS]
+
+def stack_summaries(parsed, num_years):
+    """
+    Builds the value matrix of many deals.
+
+    Args:
+        parsed: parse_summary() result of each deal
+        num_years: Number of years of each deal
+
+    Returns:
+        tuple: (values, valid, lengths) where values and valid have shape
+        (deals, len(METRIC_INPUTS), years) and lengths holds the length of
+        every summary line
+    """
+    width = max(num_years, default=0)
+    values = np.zeros((len(parsed), len(METRIC_INPUTS), width))
+    valid = np.zeros(values.shape, dtype=bool)
+    lengths = np.zeros(values.shape[:2], dtype=np.int64)
+    for d, (lines, years) in enumerate(zip(parsed, num_years)):
+        for row, (numbers, usable) in enumerate(lines):
+            count = min(len(numbers), years)
+            values[d, row, :count] = numbers[:count]
+            valid[d, row, :count] = usable[:count]
+            lengths[d, row] = len(numbers)
+    return values, valid, lengths
+
+def pretax_years(valid, lengths, num_years):
+    """
+    Marks the years that get the metrics from PRETAX_DEPENDENT_FROM on.
+
+    Pretax income is looked up outside the per-metric error handling, so a
+    year missing from the EBIT line, or one whose EBIT is usable but missing
+    from the Interest Paid line, has always skipped these metrics instead of
+    giving blanks. That shortens their lists, and the output keeps it.
+    """
+    year = np.arange(valid.shape[2])
+    ebit_missing = year >= lengths[:, ROW["EBIT"], None]
+    interest_missing = year >= lengths[:, ROW["Interest Paid"], None]
+    keep = ~(ebit_missing | (valid[:, ROW["EBIT"]] & interest_missing))
+    return keep & (year < np.asarray(num_years, dtype=np.int64)[:, None])
+
+def compute_metrics(values, valid):
+    """
+    Computes every metric for a stack of deals at once.
+
+    Each metric is a ratio whose denominator must be non-zero and whose
+    inputs must all be usable; anywhere else the metric is blank. The
+    arithmetic is done in the same order as the per-year formulas, so the
+    results match them exactly.
+
+    Args:
+        values: Value matrix from stack_summaries()
+        valid: Usable entries of the value matrix
+
+    Returns:
+        list: (metric name, values, valid, is_percentage) in output order
+    """
+    def line(key):
+        return values[:, ROW[key]], valid[:, ROW[key]]
+
+    def ratio(numerator, denominator, scale=None):
+        (num, num_ok), (den, den_ok) = numerator, denominator
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            result = num / den
+            if scale is not None:
+                result = result * scale
+        return result, num_ok & den_ok & (den != 0)
+
+    def difference(a, b):
+        with np.errstate(invalid="ignore", over="ignore"):
+            return a[0] - b[0], a[1] & b[1]
+
+    def growth(key):
+        current, ok = line(key)
+        result = np.zeros_like(current)
+        usable = np.zeros_like(ok)
+        previous = (current[:, :-1], ok[:, :-1])
+        change = difference((current[:, 1:], ok[:, 1:]), previous)
+        result[:, 1:], usable[:, 1:] = ratio(change, previous, 100)
+        return result, usable
+
+    revenue, cogs, net_income = line("Revenue"), line("COGS"), line("Net Income")
+    inventory, current_liabilities = line("Inventory"), line("Current Liabilities")
+    equity, employees, ebit = line("Total Shareholders' Equity"), line("Number of Employees"), line("EBIT")
+
+    metrics = [
+        ("Revenue Growth Rate (%)", growth("Revenue"), True),
+        ("Gross Margin (%)", ratio(difference(revenue, cogs), revenue, 100), True),
+        ("Gross Margin Expansion (%)", growth("Gross Margin"), True),
+        ("Net Margin (%)", ratio(net_income, revenue, 100), True),
+        ("Net Income Growth Rate (%)", growth("Net Income"), True),
+        ("Inventory Turnover Per Year", ratio(cogs, inventory), False),
+        ("Days to Turn Inventory (Days)", ratio(inventory, cogs, 365), False),
+        ("Days Sales Outstanding (DSO) (Days)", ratio(line("Accounts Receivable"), revenue, 365), False),
+        ("Days in Payables (Days)", ratio(line("Accounts Payable"), cogs, 365), False),
+        ("Interest Coverage Ratio", ratio(ebit, line("Interest Paid")), False),
+        ("Current Ratio", ratio(line("Current Assets"), current_liabilities), False),
+        ("Acid Test Ratio", ratio(difference(line("Current Assets"), inventory), current_liabilities), False),
+        ("Debt-to-Equity Ratio", ratio(line("Total Liabilities"), equity), False),
+        ("Return on Equity (ROE)", ratio(net_income, equity, 100), True),
+        ("RoR on Total Assets", ratio(net_income, line("Total Assets"), 100), True),
+        ("Effective Tax Rate (%)", ratio(line("Taxes"), difference(ebit, line("Interest Paid")), 100), True),
+        ("Revenue per employee ($)", ratio(revenue, employees), False),
+        ("Net Income per employee ($)", ratio(net_income, employees), False),
+        ("SDE/EBIT multiple", ratio(line("SDE"), ebit), False),
+    ]
+    return [(name, result, usable, is_percentage) for name, (result, usable), is_percentage in metrics]
+
+def calculate_financial_metrics_batch(summaries, strict=False):
+    """
+    Calculates financial metrics for many deals at once.
+
+    The summaries are stacked into one matrix and every metric is computed
+    for all deals and years in a single array operation.
+
+    Args:
+        summaries: Summary dicts, as loaded from the summary JSON files
+        strict: Raise on a malformed summary instead of returning None for it
+
+    Returns:
+        list: calculate_financial_metrics() result of each summary, or None
+        for summaries that could not be analyzed
+    """
+    parsed, years_of, num_years = [], [], []
+    for summary_data in summaries:
+        try:
+            years = sorted(summary_data["Years"])
+            add_balance_sheet_totals(summary_data, len(years))
+            lines = parse_summary(summary_data, len(years))
+        except Exception as e:
+            if strict:
+                raise
+            logging.error(f"Error in calculate_financial_metrics: {e}")
+            years = None
+        years_of.append(years)
+        if years is not None:
+            parsed.append(lines)
+            num_years.append(len(years))
+
+    values, valid, lengths = stack_summaries(parsed, num_years)
+    metrics = [
+        (name, format_values(metric_values, usable, is_percentage))
+        for name, metric_values, usable, is_percentage in compute_metrics(values, valid)
+    ]
+    keep = pretax_years(valid, lengths, num_years).tolist()
+
+    results = []
+    d = 0
+    for years in years_of:
+        if years is None:
+            results.append(None)
+            continue
+        result = {"Years": years}
+        included = [True] * len(years)
+        for name, formatted in metrics:
+            if name == PRETAX_DEPENDENT_FROM:
+                included = keep[d][:len(years)]
+            if not any(included):
                 continue
+            result[name] = [text for text, include in zip(formatted[d], included) if include]
+        results.append(result)
+        d += 1
+    return results
+
+def format_values(values, usable, is_percentage=False):
+    """
+    Formats a whole matrix of metric values like format_value(), blank where not usable.
 
-        return results
+    The decimals of each value are picked with array comparisons, so only
+    the final string formatting runs per value.
+
+    Returns:
+        list: Nested lists of strings with the shape of values
+    """
+    templates = ("{:.0f}%", "{:.1f}%", "{:.2f}%") if is_percentage else ("{:,.0f}", "{:,.1f}", "{:,.2f}")
+    magnitude = np.abs(values)
+    with np.errstate(invalid="ignore"):
+        band = np.where(magnitude >= 100, 0, np.where(magnitude >= 10, 1, 2))
+    band[~usable] = -1
+    return [
+        [templates[b].format(value) if b >= 0 else "" for value, b in zip(row_values, row_bands)]
+        for row_values, row_bands in zip(values.tolist(), band.tolist())
+    ]
+
+def calculate_financial_metrics(summary_data):
+    """Calculates financial metrics from summary data."""
+    try:
+        logging.info(f"Processing {len(summary_data['Years'])} years of data: {sorted(summary_data['Years'])}")
+        return calculate_financial_metrics_batch([summary_data], strict=True)[0]
     except Exception as e:
         logging.error(f"Error in calculate_financial_metrics: {e}")
         raise
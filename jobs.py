@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import logging
+import state_db
+
+# Attempts after which a job that keeps failing is given up instead of resumed again
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+# Stages of a processed email, in order
+STAGES = [
+    "fetched",
+    "attachments_saved",
+    "ack_sent",
+    "extracted",
+    "analyzed",
+    "excel_built",
+    "replied",
+    "marked_read",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deal_jobs (
+    message_id TEXT PRIMARY KEY,
+    sender_email TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    folder_count TEXT,
+    has_attachments INTEGER,
+    artifacts TEXT NOT NULL DEFAULT '{}',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    failed_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deal_jobs_stage ON deal_jobs (stage);
+"""
+
+
+def _row_to_job(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["artifacts"] = json.loads(job["artifacts"])
+    job["has_attachments"] = None if job["has_attachments"] is None else bool(job["has_attachments"])
+    return job
+
+
+class JobStore:
+    """
+    Durable state of every processed email, keyed by Gmail message id.
+
+    Each job records the last stage it completed (see STAGES) and the paths of
+    what it produced, so a restart resumes at the first incomplete stage
+    instead of redoing LLM calls or sending a second acknowledgment.
+    """
+
+    def __init__(self, db_path=state_db.STATE_DB_PATH, max_attempts=JOB_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        with state_db.connection(self.db_path) as conn:
+            conn.executescript(SCHEMA)
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(deal_jobs)")}
+            if "failed_at" not in columns:
+                # Databases created before jobs could be given up
+                conn.execute("ALTER TABLE deal_jobs ADD COLUMN failed_at REAL")
+
+    def get(self, message_id):
+        """Returns the job of an email, or None if it was never fetched."""
+        with state_db.connection(self.db_path) as conn:
+            row = conn.execute("SELECT * FROM deal_jobs WHERE message_id = ?", (message_id,)).fetchone()
+        return _row_to_job(row)
+
+    def start(self, message_id, sender_email):
+        """Returns the job of an email, creating it at the "fetched" stage if it is new."""
+        now = time.time()
+        with state_db.connection(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO deal_jobs (message_id, sender_email, stage, created_at, updated_at) "
+                "VALUES (?, ?, 'fetched', ?, ?)",
+                (message_id, sender_email, now, now)
+            )
+            conn.execute("UPDATE deal_jobs SET attempts = attempts + 1 WHERE message_id = ?", (message_id,))
+            row = conn.execute("SELECT * FROM deal_jobs WHERE message_id = ?", (message_id,)).fetchone()
+        return _row_to_job(row)
+
+    def advance(self, message_id, stage, artifacts=None, **fields):
+        """
+        Records that a job completed a stage.
+
+        Args:
+            message_id: Gmail message id of the job
+            stage: Stage just completed
+            artifacts: Paths produced by the stage, merged into the job's artifacts
+            **fields: folder_count and/or has_attachments to store
+
+        Returns:
+            dict: The updated job
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown job stage: {stage}")
+        with state_db.connection(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM deal_jobs WHERE message_id = ?", (message_id,)).fetchone()
+            if row is None:
+                conn.execute("ROLLBACK")
+                raise KeyError(f"No job for message {message_id}")
+            job = _row_to_job(row)
+            # Stages only move forward
+            if STAGES.index(stage) > STAGES.index(job["stage"]):
+                job["stage"] = stage
+            job["artifacts"].update(artifacts or {})
+            for name in ("folder_count", "has_attachments"):
+                if name in fields:
+                    job[name] = fields[name]
+            conn.execute(
+                "UPDATE deal_jobs SET stage = ?, folder_count = ?, has_attachments = ?, artifacts = ?, "
+                "error = NULL, updated_at = ? WHERE message_id = ?",
+                (job["stage"], job["folder_count"],
+                 None if job["has_attachments"] is None else int(job["has_attachments"]),
+                 json.dumps(job["artifacts"]), time.time(), message_id)
+            )
+            conn.execute("COMMIT")
+        return job
+
+    def fail(self, message_id, error):
+        """
+        Records why a job stopped; it stays at its last completed stage.
+
+        Once the job has used max_attempts attempts it is given up: it is no
+        longer resumed or picked up again (see gave_up()).
+
+        Returns:
+            bool: True if the job was given up
+        """
+        now = time.time()
+        with state_db.connection(self.db_path) as conn:
+            conn.execute(
+                "UPDATE deal_jobs SET error = ?, updated_at = ?, "
+                "failed_at = CASE WHEN attempts >= ? THEN ? ELSE failed_at END WHERE message_id = ?",
+                (str(error), now, self.max_attempts, now, message_id)
+            )
+            row = conn.execute("SELECT failed_at FROM deal_jobs WHERE message_id = ?", (message_id,)).fetchone()
+        given_up = row is not None and row["failed_at"] is not None
+        if given_up:
+            logging.error(f"🛑 Giving up on email ID {message_id} after {self.max_attempts} attempts: {error}")
+        return given_up
+
+    def unfinished(self):
+        """
+        Returns every job that has not reached the last stage and has attempts left, oldest first.
+
+        Jobs that used up their attempts without a recorded failure (e.g. the
+        process died) are given up here.
+        """
+        now = time.time()
+        with state_db.connection(self.db_path) as conn:
+            conn.execute(
+                "UPDATE deal_jobs SET failed_at = ? WHERE stage != ? AND failed_at IS NULL AND attempts >= ?",
+                (now, STAGES[-1], self.max_attempts)
+            )
+            rows = conn.execute(
+                "SELECT * FROM deal_jobs WHERE stage != ? AND failed_at IS NULL ORDER BY created_at", (STAGES[-1],)
+            ).fetchall()
+        return [_row_to_job(row) for row in rows]
+
+
+def reached(job, stage):
+    """Returns True if the job has completed the given stage."""
+    return job is not None and STAGES.index(job["stage"]) >= STAGES.index(stage)
+
+
+def gave_up(job):
+    """Returns True if the job failed too many times to be tried again."""
+    return job is not None and job.get("failed_at") is not None
+
+
+def delivered(job):
+    """Returns True once the sender has the results, or the acknowledgment of an email without attachments."""
+    if reached(job, "replied"):
+        return True
+    return job is not None and job["has_attachments"] is False and reached(job, "ack_sent")
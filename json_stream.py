@@ -0,0 +1,259 @@
+import re
+import json
+
+# Text allowed before the JSON object starts (preamble, code fence) before giving up
+PREFIX_LIMIT = 2000
+
+NUMBER_PATTERN = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+
+# Literals accepted as values; Python spellings are repaired to JSON ones
+LITERALS = {"true": "true", "false": "false", "null": "null", "True": "true", "False": "false", "None": "null"}
+
+TOKEN_CHARS = set("0123456789+-.eE") | set("".join(LITERALS))
+WHITESPACE = set(" \t\r\n")
+
+
+class StreamingJSONParser:
+    """
+    Incremental validator and repairer for a JSON object arriving in chunks.
+
+    Feed it the assistant's text as it streams in. It skips a preamble or code
+    fence before the object, repairs trailing commas, single-quoted strings,
+    raw newlines in strings, Python literals and file_search citation markers,
+    and reports failure as soon as the text can no longer become a valid
+    object, so the run can be aborted instead of awaited.
+    """
+
+    def __init__(self):
+        self.text = []          # everything received
+        self.out = []           # repaired JSON emitted so far
+        self.stack = []         # open containers, "{" or "["
+        self.expect = "prefix"
+        self.quote = None       # quote character of the string being read
+        self.escape = False
+        self.string_is_key = False
+        self.token = ""         # number or literal being read
+        self.pending_comma = False
+        self.in_citation = False
+        self.prefix_length = 0
+        self.error = None
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def complete(self):
+        return self.expect == "done"
+
+    @property
+    def received(self):
+        return bool(self.text)
+
+    def raw_text(self):
+        return "".join(self.text)
+
+    def feed(self, chunk):
+        """
+        Consumes the next chunk of text.
+
+        Returns:
+            bool: False once the text can no longer become valid JSON
+        """
+        self.text.append(chunk)
+        for char in chunk:
+            if self.failed or self.complete:
+                break
+            self._consume(char)
+        return not self.failed
+
+    def result(self):
+        """Returns the parsed object, or None if the text was not a complete valid object."""
+        if self.failed:
+            return None
+        if not self.complete:
+            self.error = "reply ended before the JSON object was closed"
+            return None
+        try:
+            return json.loads("".join(self.out))
+        except json.JSONDecodeError as e:
+            self.error = f"repaired reply is still not valid JSON: {e}"
+            return None
+
+    def _fail(self, message):
+        self.error = message
+
+    def _emit_separator(self):
+        if self.pending_comma:
+            self.out.append(",")
+            self.pending_comma = False
+
+    def _after_value(self):
+        if not self.stack:
+            self.expect = "done"
+        else:
+            self.expect = "comma_or_end"
+
+    def _consume(self, char):
+        if self.quote:
+            self._consume_string(char)
+            return
+
+        if self.token:
+            if char in TOKEN_CHARS:
+                self.token += char
+                if self.token[0].isalpha() and not any(literal.startswith(self.token) for literal in LITERALS):
+                    self._fail(f"unexpected literal {self.token!r}")
+                return
+            if not self._finish_token():
+                return
+
+        if self.in_citation:
+            # file_search citations look like 【4:0†source】
+            if char == "】":
+                self.in_citation = False
+            return
+        if char == "【":
+            self.in_citation = True
+            return
+
+        if self.expect == "prefix":
+            if char == "{":
+                self.out.append(char)
+                self.stack.append("{")
+                self.expect = "key_or_end"
+            else:
+                self.prefix_length += 1
+                if self.prefix_length > PREFIX_LIMIT:
+                    self._fail("no JSON object in the reply")
+            return
+
+        if char in WHITESPACE:
+            return
+
+        if self.expect == "key_or_end":
+            if char in "\"'":
+                self._emit_separator()
+                self._start_string(char, is_key=True)
+            elif char == "}":
+                self._close("{")
+            else:
+                self._fail(f"expected a key, got {char!r}")
+        elif self.expect == "colon":
+            if char == ":":
+                self.out.append(char)
+                self.expect = "value"
+            else:
+                self._fail(f"expected ':', got {char!r}")
+        elif self.expect in ("value", "value_or_end"):
+            if self.expect == "value_or_end" and char == "]":
+                self._close("[")
+            else:
+                self._start_value(char)
+        elif self.expect == "comma_or_end":
+            if char == ",":
+                self.pending_comma = True
+                self.expect = "key_or_end" if self.stack[-1] == "{" else "value_or_end"
+            elif char in "}]":
+                self._close("{" if char == "}" else "[")
+            else:
+                self._fail(f"expected ',' or a closing bracket, got {char!r}")
+
+    def _start_value(self, char):
+        if char in "{[":
+            self._emit_separator()
+            self.out.append(char)
+            self.stack.append(char)
+            self.expect = "key_or_end" if char == "{" else "value_or_end"
+        elif char in "\"'":
+            self._emit_separator()
+            self._start_string(char, is_key=False)
+        elif char in TOKEN_CHARS:
+            self._emit_separator()
+            self.token = char
+            if char.isalpha() and not any(literal.startswith(char) for literal in LITERALS):
+                self._fail(f"unexpected value starting with {char!r}")
+        else:
+            self._fail(f"expected a value, got {char!r}")
+
+    def _close(self, opener):
+        if not self.stack or self.stack[-1] != opener:
+            self._fail("mismatched closing bracket")
+            return
+        # A comma right before the bracket is dropped (trailing comma repair)
+        self.pending_comma = False
+        self.stack.pop()
+        self.out.append("}" if opener == "{" else "]")
+        self._after_value()
+
+    def _finish_token(self):
+        token, self.token = self.token, ""
+        if token in LITERALS:
+            self.out.append(LITERALS[token])
+        elif NUMBER_PATTERN.fullmatch(token):
+            self.out.append(token)
+        else:
+            self._fail(f"invalid value {token!r}")
+            return False
+        self._after_value()
+        return True
+
+    def _start_string(self, quote, is_key):
+        self.quote = quote
+        self.string_is_key = is_key
+        self.out.append('"')
+
+    def _consume_string(self, char):
+        # Citations are dropped inside strings too, with the space before them
+        if self.in_citation:
+            if char == "】":
+                self.in_citation = False
+                return
+            if char != self.quote:
+                return
+            # An unclosed citation ends with its string
+            self.in_citation = False
+        elif char == "【" and not self.escape:
+            self.in_citation = True
+            while self.out and self.out[-1] == " ":
+                self.out.pop()
+            return
+        if self.escape:
+            self.escape = False
+            # \' is not a JSON escape; inside a single-quoted string it is just a quote
+            self.out.append("'" if char == "'" else "\\" + char)
+            return
+        if char == "\\":
+            self.escape = True
+            return
+        if char == self.quote:
+            self.out.append('"')
+            self.quote = None
+            if self.string_is_key:
+                self.expect = "colon"
+            else:
+                self._after_value()
+            return
+        if char == '"':
+            self.out.append('\\"')
+        elif char == "\n":
+            self.out.append("\\n")
+        elif char == "\t":
+            self.out.append("\\t")
+        elif char == "\r":
+            pass
+        else:
+            self.out.append(char)
+
+
+def parse_json_reply(text):
+    """
+    Parses a complete assistant reply, repairing the same defects as the streaming parser.
+
+    Returns:
+        tuple: (parsed object or None, error message or None)
+    """
+    parser = StreamingJSONParser()
+    parser.feed(text)
+    result = parser.result()
+    return result, parser.error
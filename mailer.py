@@ -1,15 +1,26 @@
+import io
 import os
+import re
+import json
+import uuid
 import base64
+import tempfile
+import email.message
+import email.policy
+import hashlib
 import logging
 import time
-from email.message import EmailMessage
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2 import credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 from config import TOKEN_PATH, CREDENTIALS_PATH, BASE_DIR
 import random
+import state_db
+import submissions
+import retry
 
 # Configure logging
 logging.basicConfig(
@@ -26,6 +37,44 @@ logging.getLogger('httpcore').setLevel(logging.WARNING)
 
 SCOPES = ['https://mail.google.com/']
 
+# Gmail discovery document kept on disk, so building the service needs no fetch
+DISCOVERY_CACHE_PATH = os.getenv("DISCOVERY_CACHE_PATH", os.path.join(BASE_DIR, "cache", "discovery", "gmail.v1.json"))
+_discovery_document = None
+
+# Gmail accepts at most 100 calls in one batch request
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "100"))
+
+# Unread messages listed per messages.list page (Gmail allows up to 500)
+UNREAD_PAGE_SIZE = int(os.getenv("UNREAD_PAGE_SIZE", "100"))
+
+# batchModify takes up to 1000 ids; buffered label changes are also flushed after LABEL_FLUSH_SECONDS
+LABEL_BATCH_SIZE = int(os.getenv("LABEL_BATCH_SIZE", "1000"))
+LABEL_FLUSH_SECONDS = float(os.getenv("LABEL_FLUSH_SECONDS", "10"))
+
+# Attachments downloaded at once per email, and the size of each streamed read
+ATTACHMENT_DOWNLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_DOWNLOAD_CONCURRENCY", "4"))
+ATTACHMENT_CHUNK_SIZE = int(os.getenv("ATTACHMENT_CHUNK_SIZE", str(256 * 1024)))
+
+# Raw bytes base64-encoded per read when writing outgoing attachments (a multiple of 57)
+MIME_CHUNK_SIZE = 57 * 1024
+
+# Outgoing messages larger than this are sent with a resumable upload, in SEND_CHUNK_SIZE pieces
+SEND_RESUMABLE_THRESHOLD = int(os.getenv("SEND_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024)))
+SEND_CHUNK_SIZE = int(os.getenv("SEND_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+GMAIL_API_URL = "https://gmail.googleapis.com/gmail/v1"
+
+# "unread" re-queries is:unread every run; "history" only fetches messages added since the last historyId
+GMAIL_SYNC_MODE = os.getenv("GMAIL_SYNC_MODE", "unread")
+
+SYNC_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gmail_sync (
+    user_id TEXT PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
 def get_salutation():
     salutations = [
         "Hey champ! 🏆",
@@ -83,6 +132,8 @@ def get_gmail_service():
                 if os.path.exists(TOKEN_PATH):
                     os.remove(TOKEN_PATH)
                 
+                # Only needed for an interactive login, so it is not imported on every run
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, SCOPES)
                 creds = flow.run_local_server(port=0)
                 
@@ -94,22 +145,270 @@ def get_gmail_service():
                 logging.error(f"Error getting new credentials: {e}")
                 raise
     
-    return build('gmail', 'v1', credentials=creds)
+    document = load_discovery_document()
+    if document is None:
+        return build('gmail', 'v1', credentials=creds)
+    return build_from_document(document, credentials=creds)
+
+def load_discovery_document(path=DISCOVERY_CACHE_PATH):
+    """
+    Return the Gmail discovery document, parsed once per process.
+
+    It is read from DISCOVERY_CACHE_PATH, which is filled from the copy bundled
+    with googleapiclient the first time. Delete the file to refresh it.
+
+    Returns:
+        dict or None: The discovery document, or None if no copy is available
+    """
+    global _discovery_document
+    if _discovery_document is not None:
+        return _discovery_document
+
+    try:
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                _discovery_document = json.load(f)
+        else:
+            from googleapiclient import discovery_cache
+            content = discovery_cache.get_static_doc('gmail', 'v1')
+            if content is None:
+                return None
+            _discovery_document = json.loads(content)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning(f"Could not load the cached Gmail discovery document: {e}")
+        return None
+    return _discovery_document
+
+def _page_http(service):
+    """Returns an authorized HTTP client of its own for the page prefetch thread, or None."""
+    creds = getattr(getattr(service, '_http', None), 'credentials', None)
+    if creds is None:
+        return None
+    import google_auth_httplib2
+    from googleapiclient.http import build_http
+    return google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+
+def _prefetched_pages(service, list_request, name):
+    """
+    Stream the responses of a paginated list call, following nextPageToken.
+
+    The next page is requested in a background thread before the current one
+    is yielded, so it downloads while the caller processes the current page.
+    httplib2 is not thread-safe, so the thread uses an HTTP client of its own;
+    without one the pages are fetched in turn.
+
+    Args:
+        service: Gmail API service instance
+        list_request: Function of a page token returning the list request of that page
+        name: Name of the call in retry logs
+
+    Yields:
+        dict: The response of each page
+    """
+    http = _page_http(service)
+
+    def fetch(request):
+        return retry.call(lambda: request.execute(http=http), name=name)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        results = fetch(list_request(None))
+        while True:
+            page_token = results.get('nextPageToken')
+            next_page = None
+            if page_token and http is not None:
+                # Requests are built here, only their execution runs in the thread
+                next_page = executor.submit(fetch, list_request(page_token))
+            yield results
+            if not page_token:
+                return
+            results = next_page.result() if next_page else fetch(list_request(page_token))
+
+def iter_unread_pages(service, user_id='me', page_size=UNREAD_PAGE_SIZE):
+    """
+    Stream unread email messages one page at a time, following nextPageToken.
+
+    Each next page is fetched while the caller processes the current one.
+
+    Args:
+        service: Gmail API service instance
+        user_id: Gmail user
+        page_size: maxResults of each messages.list call
+
+    Yields:
+        list: Message stubs ({'id', 'threadId'}) of one page
+    """
+    pages = _prefetched_pages(service, lambda page_token: service.users().messages().list(
+        userId=user_id, q='is:unread', maxResults=page_size, pageToken=page_token
+    ), 'gmail.messages.list')
+    try:
+        for results in pages:
+            messages = results.get('messages', [])
+            if messages:
+                yield messages
+    except Exception as e:
+        print(f"❌ Error listing unread messages: {e}")
 
 def list_unread_messages(service, user_id='me'):
     """Lists unread email messages."""
+    return [message for page in iter_unread_pages(service, user_id) for message in page]
+
+def load_history_id(user_id='me', db_path=state_db.STATE_DB_PATH):
+    """Returns the stored historyId checkpoint, or None before the first sync."""
+    with state_db.connection(db_path) as conn:
+        conn.executescript(SYNC_SCHEMA)
+        row = conn.execute("SELECT history_id FROM gmail_sync WHERE user_id = ?", (user_id,)).fetchone()
+    return row["history_id"] if row else None
+
+def save_history_id(history_id, user_id='me', db_path=state_db.STATE_DB_PATH):
+    """Stores the historyId checkpoint the next sync starts from."""
+    with state_db.connection(db_path) as conn:
+        conn.executescript(SYNC_SCHEMA)
+        conn.execute(
+            "INSERT INTO gmail_sync (user_id, history_id, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET history_id = excluded.history_id, updated_at = excluded.updated_at",
+            (user_id, str(history_id), time.time())
+        )
+
+def _full_sync_pages(service, user_id, db_path):
+    """Scans is:unread, then checkpoints the mailbox historyId read before the scan."""
+    # Read first, so messages arriving during the scan are picked up by the next history sync
+    history_id = retry.call(service.users().getProfile(userId=user_id).execute, name='gmail.getProfile')['historyId']
+    yield from iter_unread_pages(service, user_id)
+    save_history_id(history_id, user_id, db_path)
+    logging.info(f"📌 Gmail history checkpoint set to {history_id}")
+
+def iter_history_pages(service, user_id='me', db_path=state_db.STATE_DB_PATH):
+    """
+    Stream the messages added to the inbox since the last historyId checkpoint.
+
+    Without a checkpoint, or when Gmail no longer has the history for it
+    (404), the unread messages are scanned in full instead and the checkpoint
+    is set from the mailbox profile. The checkpoint only moves forward once
+    every page has been consumed, so an interrupted run is replayed.
+
+    Args:
+        service: Gmail API service instance
+        user_id: Gmail user
+        db_path: State database holding the checkpoint
+
+    Yields:
+        list: Message stubs ({'id', 'threadId'}) of one page
+    """
+    start_history_id = load_history_id(user_id, db_path)
+    if start_history_id is None:
+        logging.info("📭 No Gmail history checkpoint yet, running a full scan")
+        yield from _full_sync_pages(service, user_id, db_path)
+        return
+
+    seen = set()
+    latest_history_id = start_history_id
+    pages = _prefetched_pages(service, lambda page_token: service.users().history().list(
+        userId=user_id, startHistoryId=start_history_id, historyTypes=['messageAdded'],
+        labelId='INBOX', pageToken=page_token
+    ), 'gmail.history.list')
     try:
-        results = service.users().messages().list(userId=user_id, q='is:unread').execute()
-        messages = results.get('messages', [])
-        return messages
+        for results in pages:
+            messages = []
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message = added['message']
+                    labels = message.get('labelIds', [])
+                    # Only mail received in the inbox, not our own replies
+                    if 'INBOX' not in labels or 'SENT' in labels or message['id'] in seen:
+                        continue
+                    seen.add(message['id'])
+                    messages.append({'id': message['id'], 'threadId': message.get('threadId')})
+            latest_history_id = results.get('historyId', latest_history_id)
+
+            if messages:
+                yield messages
+    except HttpError as e:
+        if getattr(e.resp, 'status', None) == 404:
+            logging.warning(f"⚠️ Gmail history {start_history_id} has expired, running a full scan")
+            yield from _full_sync_pages(service, user_id, db_path)
+            return
+        print(f"❌ Error listing Gmail history: {e}")
+        return
     except Exception as e:
-        print(f"❌ Error listing unread messages: {e}")
-        return []
+        print(f"❌ Error listing Gmail history: {e}")
+        return
+
+    save_history_id(latest_history_id, user_id, db_path)
+    logging.info(f"📌 Gmail history checkpoint moved to {latest_history_id}")
+
+def iter_message_pages(service, user_id='me', mode=None):
+    """Stream new messages page by page using the configured GMAIL_SYNC_MODE."""
+    if (mode or GMAIL_SYNC_MODE) == 'history':
+        return iter_history_pages(service, user_id)
+    return iter_unread_pages(service, user_id)
+
+def batch_get_messages(service, message_ids, format='full', metadata_headers=None, user_id='me'):
+    """
+    Fetch many emails with Gmail batch requests instead of one HTTP round trip each.
+
+    Args:
+        service: Gmail API service instance
+        message_ids: IDs of the messages to fetch
+        format: 'metadata' for headers only, 'full' for the whole payload
+        metadata_headers: Headers to include when format is 'metadata'
+        user_id: Gmail user
+
+    Returns:
+        dict: message ID -> message; IDs that could not be fetched are left out
+    """
+    messages = {}
+    throttled = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+        elif retry.is_retryable(exception):
+            throttled.append(request_id)
+        else:
+            print(f"Error fetching email with ID {request_id}: {exception}")
+
+    def request(message_id):
+        kwargs = {'userId': user_id, 'id': message_id, 'format': format}
+        if metadata_headers:
+            kwargs['metadataHeaders'] = metadata_headers
+        return service.users().messages().get(**kwargs)
+
+    def execute(chunk):
+        batch = service.new_batch_http_request(callback=callback)
+        for message_id in chunk:
+            if message_id not in messages:
+                batch.add(request(message_id), request_id=message_id)
+        batch.execute()
+
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        try:
+            retry.call(execute, message_ids[start:start + GMAIL_BATCH_SIZE], name='gmail.batch')
+        except Exception as e:
+            print(f"❌ Error executing batch request: {e}")
+
+    # Calls rate limited inside an otherwise successful batch are retried one by one
+    for message_id in dict.fromkeys(throttled):
+        if message_id in messages:
+            continue
+        try:
+            messages[message_id] = retry.call(request(message_id).execute, name='gmail.messages.get')
+        except Exception as e:
+            print(f"Error fetching email with ID {message_id}: {e}")
+    return messages
 
 def get_email_by_id(service, message_id, user_id='me'):
     """Fetch a specific email by its ID."""
     try:
-        message = service.users().messages().get(userId=user_id, id=message_id, format='full').execute()
+        message = retry.call(
+            service.users().messages().get(userId=user_id, id=message_id, format='full').execute,
+            name='gmail.messages.get'
+        )
         return message
     except Exception as e:
         print(f"Error fetching email with ID {message_id}: {e}")
@@ -132,19 +431,275 @@ def mark_as_read(service, user_id, msg_id):
     """Marks the given message as read."""
     logging.info(f"Mark as read called with msg_id: {msg_id}")
     try:
-        response = service.users().messages().modify(
+        response = retry.call(service.users().messages().modify(
             userId=user_id,
             id=msg_id,
             body={'removeLabelIds': ['UNREAD']}
-        ).execute()
+        ).execute, name='gmail.messages.modify')
         logging.info(f"✅ Marked email ID {msg_id} as read. Full API Response: {response}")
-        time.sleep(1) #Consider exponential backoff for large volumes.
     except HttpError as e:
         logging.error(f"❌ ERROR: HTTP Error marking email ID {msg_id} as read for user {user_id}: {e}")
     except Exception as e:
         logging.error(f"❌ ERROR: Failed to mark email ID {msg_id} as read for user {user_id}: {type(e)} - {e}")        
-        
-def send_reply(service, email_message, reply_text, attachment_paths=None):
+
+class LabelBuffer:
+    """
+    Collects label changes and applies them with users.messages.batchModify.
+
+    Changes are grouped by the labels they add and remove. A group is flushed
+    once it holds LABEL_BATCH_SIZE ids, and every group is flushed when the
+    oldest buffered change is LABEL_FLUSH_SECONDS old, on flush() or when the
+    buffer is used as a context manager and the block exits.
+    """
+
+    def __init__(self, service, user_id='me', batch_size=LABEL_BATCH_SIZE, flush_seconds=LABEL_FLUSH_SECONDS):
+        self.service = service
+        self.user_id = user_id
+        self.batch_size = min(batch_size, 1000)
+        self.flush_seconds = flush_seconds
+        self.pending = {}       # (add labels, remove labels) -> list of message ids
+        self.oldest = None      # monotonic time of the oldest buffered change
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def add(self, msg_id, add_labels=(), remove_labels=()):
+        """Buffers a label change for one message."""
+        key = (tuple(sorted(add_labels)), tuple(sorted(remove_labels)))
+        ids = self.pending.setdefault(key, [])
+        ids.append(msg_id)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if len(ids) >= self.batch_size:
+            self._flush_group(key)
+        self.flush_if_due()
+
+    def mark_as_read(self, msg_id):
+        """Buffers removing the UNREAD label from a message."""
+        self.add(msg_id, remove_labels=['UNREAD'])
+
+    def flush_if_due(self):
+        """Flushes everything if the oldest buffered change has waited long enough."""
+        if self.oldest is not None and time.monotonic() - self.oldest >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Applies every buffered change."""
+        for key in list(self.pending):
+            self._flush_group(key)
+        self.oldest = None
+
+    def _flush_group(self, key):
+        ids = self.pending.pop(key, [])
+        if not self.pending:
+            self.oldest = None
+        add_labels, remove_labels = key
+        for start in range(0, len(ids), self.batch_size):
+            chunk = ids[start:start + self.batch_size]
+            body = {'ids': chunk}
+            if add_labels:
+                body['addLabelIds'] = list(add_labels)
+            if remove_labels:
+                body['removeLabelIds'] = list(remove_labels)
+            self._batch_modify(body)
+
+    def _batch_modify(self, body):
+        try:
+            retry.call(
+                self.service.users().messages().batchModify(userId=self.user_id, body=body).execute,
+                name='gmail.messages.batchModify'
+            )
+        except Exception as e:
+            logging.error(f"❌ ERROR: batchModify failed for {len(body['ids'])} emails: {type(e)} - {e}")
+            return False
+        logging.info(f"✅ Updated labels of {len(body['ids'])} emails "
+                     f"(add {body.get('addLabelIds', [])}, remove {body.get('removeLabelIds', [])})")
+        return True
+
+def attachment_mime_type(file_name):
+    """Returns (maintype, subtype) for an attachment, from its extension."""
+    # Determine MIME type (simplistic approach)
+    maintype = "application"
+    subtype = "octet-stream"  # Default
+    
+    # Simple extension-based MIME type detection
+    if file_name.endswith(".pdf"):
+        subtype = "pdf"
+    elif file_name.endswith((".jpg", ".jpeg")):
+        maintype = "image"
+        subtype = "jpeg"
+    elif file_name.endswith(".png"):
+        maintype = "image"
+        subtype = "png"
+    elif file_name.endswith((".txt", ".md")):
+        maintype = "text"
+        subtype = "plain"
+    elif file_name.endswith((".py", ".js", ".html", ".css")):
+        maintype = "text"
+        subtype = "plain"
+    return maintype, subtype
+
+def _write_headers(f, headers):
+    policy = email.policy.default
+    for name, value in headers:
+        # Parsing the value first makes non-ASCII text come out as encoded words / RFC 2231 parameters
+        f.write(policy.fold(*policy.header_store_parse(name, value)).encode("ascii"))
+    f.write(b"\n")
+
+def _attachment_disposition(file_name):
+    """Content-Disposition header for an attachment, with the filename quoted or RFC 2231 encoded as needed."""
+    message = email.message.EmailMessage()
+    message.add_header("Content-Disposition", "attachment", filename=file_name)
+    return message["Content-Disposition"]
+
+def _write_base64(f, source):
+    # 57 raw bytes make one 76 character base64 line
+    while True:
+        chunk = source.read(MIME_CHUNK_SIZE)
+        if not chunk:
+            break
+        f.write(base64.encodebytes(chunk))
+
+def write_mime_message(f, headers, body_text, attachment_paths=None):
+    """
+    Write an RFC 822 message to a binary file, streaming attachments from disk.
+
+    Attachments are base64-encoded chunk by chunk as they are copied, so memory
+    use stays constant whatever their size. Missing or unreadable files are
+    reported and left out, as before.
+
+    Args:
+        f: Binary file the message is written to
+        headers: List of (name, value) message headers
+        body_text: The text content of the email
+        attachment_paths: List of file paths to attach (optional)
+
+    Returns:
+        list: Names of the files attached
+    """
+    text_headers = [
+        ("Content-Type", 'text/plain; charset="utf-8"'),
+        ("Content-Transfer-Encoding", "base64"),
+    ]
+    body = io.BytesIO(body_text.encode("utf-8"))
+
+    if not attachment_paths:
+        _write_headers(f, list(headers) + [("MIME-Version", "1.0")] + text_headers)
+        _write_base64(f, body)
+        return []
+
+    boundary = f"===============dealosophy{uuid.uuid4().hex}=="
+    _write_headers(f, list(headers) + [
+        ("MIME-Version", "1.0"),
+        ("Content-Type", f'multipart/mixed; boundary="{boundary}"'),
+    ])
+    f.write(f"--{boundary}\n".encode())
+    _write_headers(f, text_headers)
+    _write_base64(f, body)
+
+    attached = []
+    for file_path in attachment_paths:
+        file_name = os.path.basename(file_path)
+        try:
+            source = open(file_path, "rb")
+        except FileNotFoundError:
+            print(f"❌ File not found: {file_path}. Attachment not added.")
+            continue
+        except Exception as e:
+            print(f"❌ Error attaching {file_path}: {e}")
+            continue
+        with source:
+            maintype, subtype = attachment_mime_type(file_name)
+            f.write(f"\n--{boundary}\n".encode())
+            _write_headers(f, [
+                ("Content-Type", f"{maintype}/{subtype}"),
+                ("Content-Transfer-Encoding", "base64"),
+                ("Content-Disposition", _attachment_disposition(file_name)),
+            ])
+            _write_base64(f, source)
+        attached.append(file_name)
+        print(f"✅ Added attachment: {file_name}")
+
+    f.write(f"\n--{boundary}--\n".encode())
+    return attached
+
+def idempotent_message_id(key):
+    """Returns the Message-ID header used for the send identified by key."""
+    return f"<{hashlib.sha1(key.encode()).hexdigest()}@dealosophy>"
+
+def find_sent_message(service, message_id_header, user_id='me'):
+    """Returns the stub of a message already in the mailbox with the given Message-ID header, or None."""
+    results = retry.call(service.users().messages().list(
+        userId=user_id, q=f"rfc822msgid:{message_id_header.strip('<>')}", includeSpamTrash=True, maxResults=1
+    ).execute, name='gmail.messages.list')
+    messages = results.get('messages', [])
+    return messages[0] if messages else None
+
+def send_message(service, headers, body_text, attachment_paths=None, thread_id=None, user_id='me',
+                 idempotency_key=None):
+    """
+    Build a message in a temp file and send it with a messages.send media upload.
+
+    The RFC 822 bytes are uploaded from disk as message/rfc822; messages larger
+    than SEND_RESUMABLE_THRESHOLD use a resumable upload in chunks.
+
+    Sends are only retried when they carry an idempotency_key. The key sets a
+    deterministic Message-ID, and before every attempt the mailbox is searched
+    for it, so a send that went through before its response was lost (or
+    before the process stopped) is not sent again.
+
+    Args:
+        service: Gmail API service instance
+        headers: List of (name, value) message headers
+        body_text: The text content of the email
+        attachment_paths: List of file paths to attach (optional)
+        thread_id: Gmail thread to send the message in (optional)
+        user_id: Gmail user
+        idempotency_key: Stable identifier of this send, e.g. "<message id>:ack" (optional)
+
+    Returns:
+        dict: The sent message resource, or the stub of the earlier send
+    """
+    from googleapiclient.http import MediaFileUpload
+
+    message_id_header = None
+    if idempotency_key:
+        message_id_header = idempotent_message_id(idempotency_key)
+        sent = find_sent_message(service, message_id_header, user_id)
+        if sent:
+            logging.info(f"↩️ Message {idempotency_key} was already sent, skipping")
+            return sent
+        headers = list(headers) + [('Message-ID', message_id_header)]
+
+    fd, tmp_path = tempfile.mkstemp(suffix=".eml")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_mime_message(f, headers, body_text, attachment_paths)
+        size = os.path.getsize(tmp_path)
+        resumable = size > SEND_RESUMABLE_THRESHOLD
+        body = {'threadId': thread_id} if thread_id else {}
+
+        def send():
+            # A fresh upload per attempt, so a retried resumable upload starts over
+            media = MediaFileUpload(
+                tmp_path, mimetype="message/rfc822", resumable=resumable,
+                chunksize=SEND_CHUNK_SIZE if resumable else -1
+            )
+            return service.users().messages().send(userId=user_id, body=body, media_body=media).execute()
+
+        if message_id_header is None:
+            return send()
+        return retry.call(
+            send, name='gmail.messages.send',
+            before_retry=lambda: find_sent_message(service, message_id_header, user_id)
+        )
+    finally:
+        os.remove(tmp_path)
+
+def send_reply(service, email_message, reply_text, attachment_paths=None, idempotency_key=None):
     """
     Send a reply to an email with optional attachments.
     
@@ -153,6 +708,7 @@ def send_reply(service, email_message, reply_text, attachment_paths=None):
         email_message: The full email message object to reply to
         reply_text: The text content of the reply
         attachment_paths: List of file paths to attach (optional)
+        idempotency_key: Makes the send safe to retry and never duplicated (see send_message)
     
     Returns:
         Boolean indicating success
@@ -184,58 +740,18 @@ def send_reply(service, email_message, reply_text, attachment_paths=None):
         return False
 
     # Create the reply email
-    reply_msg = EmailMessage()
-    reply_msg['To'] = sender
-    reply_msg['Subject'] = "Re: " + (subject or "No Subject")
+    reply_headers = [
+        ('To', sender),
+        ('Subject', "Re: " + (subject or "No Subject")),
+    ]
     if message_id:
-        reply_msg['In-Reply-To'] = message_id  # Helps Gmail recognize it as a reply
-        reply_msg['References'] = message_id  # Important for threading
-    reply_msg.set_content(reply_text)
-
-    # Attach files if provided
-    if attachment_paths:
-        for file_path in attachment_paths:
-            try:
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
-                    file_name = os.path.basename(file_path)
-                    
-                # Determine MIME type (simplistic approach)
-                maintype = "application"
-                subtype = "octet-stream"  # Default
-                
-                # Simple extension-based MIME type detection
-                if file_name.endswith(".pdf"):
-                    subtype = "pdf"
-                elif file_name.endswith((".jpg", ".jpeg")):
-                    maintype = "image"
-                    subtype = "jpeg"
-                elif file_name.endswith(".png"):
-                    maintype = "image"
-                    subtype = "png"
-                elif file_name.endswith((".txt", ".md")):
-                    maintype = "text"
-                    subtype = "plain"
-                elif file_name.endswith((".py", ".js", ".html", ".css")):
-                    maintype = "text"
-                    subtype = "plain"
-                
-                reply_msg.add_attachment(file_data, maintype=maintype, subtype=subtype, filename=file_name)
-                print(f"✅ Added attachment: {file_name}")
-            except FileNotFoundError:
-                print(f"❌ File not found: {file_path}. Attachment not added.")
-            except Exception as e:
-                print(f"❌ Error attaching {file_path}: {e}")
-    
-    # Encode and send the reply within the same thread
-    encoded_msg = base64.urlsafe_b64encode(reply_msg.as_bytes()).decode()
-    message = {
-        'raw': encoded_msg,
-        'threadId': thread_id  # Ensure the reply stays in the same thread
-    }
+        reply_headers.append(('In-Reply-To', message_id))  # Helps Gmail recognize it as a reply
+        reply_headers.append(('References', message_id))  # Important for threading
 
+    # Send the reply within the same thread
     try:
-        service.users().messages().send(userId='me', body=message).execute()
+        send_message(service, reply_headers, reply_text, attachment_paths, thread_id=thread_id,
+                     idempotency_key=idempotency_key)
         print(f"✅ Reply sent to {sender} in the same thread.")
         return True
     except Exception as e:
@@ -256,121 +772,224 @@ def send_new_email(service, to_address, subject, body_text, attachment_paths=Non
     Returns:
         Boolean indicating success
     """
-    # Create the email
-    msg = EmailMessage()
-    msg['To'] = to_address
-    msg['Subject'] = subject
-    msg.set_content(body_text)
-
-    # Attach files if provided
-    if attachment_paths:
-        for file_path in attachment_paths:
-            try:
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
-                    file_name = os.path.basename(file_path)
-                    
-                # Determine MIME type (simplistic approach)
-                maintype = "application"
-                subtype = "octet-stream"  # Default
-                
-                # Simple extension-based MIME type detection
-                if file_name.endswith(".pdf"):
-                    subtype = "pdf"
-                elif file_name.endswith((".jpg", ".jpeg")):
-                    maintype = "image"
-                    subtype = "jpeg"
-                elif file_name.endswith(".png"):
-                    maintype = "image"
-                    subtype = "png"
-                elif file_name.endswith((".txt", ".md")):
-                    maintype = "text"
-                    subtype = "plain"
-                elif file_name.endswith((".py", ".js", ".html", ".css")):
-                    maintype = "text"
-                    subtype = "plain"
-                
-                msg.add_attachment(file_data, maintype=maintype, subtype=subtype, filename=file_name)
-                print(f"✅ Added attachment: {file_name}")
-            except FileNotFoundError:
-                print(f"❌ File not found: {file_path}. Attachment not added.")
-            except Exception as e:
-                print(f"❌ Error attaching {file_path}: {e}")
-    
-    # Encode and send the email
-    encoded_msg = base64.urlsafe_b64encode(msg.as_bytes()).decode()
-    message = {'raw': encoded_msg}
-
     try:
-        service.users().messages().send(userId='me', body=message).execute()
+        send_message(service, [('To', to_address), ('Subject', subject)], body_text, attachment_paths)
         print(f"✅ Email sent to {to_address}.")
         return True
     except Exception as e:
         print(f"❌ Error sending email: {e}")
         return False
 
-def process_email_attachments(service, email_message, user_email, base_dir):
+def iter_attachment_parts(part):
+    """
+    Walk a message payload depth first and yield every part that is a named attachment.
+
+    Attachments nested in multipart/mixed -> multipart/alternative (or deeper)
+    are found as well as top-level ones.
+    """
+    if part.get('filename'):
+        yield part
+    for child in part.get('parts', []) or []:
+        yield from iter_attachment_parts(child)
+
+def _unique_path(folder, filename, taken):
+    """Returns a path in folder for filename that no other attachment of the email uses."""
+    filename = os.path.basename(filename.replace('\\', '/')) or "attachment"
+    stem, ext = os.path.splitext(filename)
+    candidate, number = filename, 1
+    while candidate.lower() in taken:
+        number += 1
+        candidate = f"{stem} ({number}){ext}"
+    taken.add(candidate.lower())
+    return os.path.join(folder, candidate)
+
+class _ChunkedWriter:
+    """Decodes base64url text written in pieces and writes it to a file, hashing as it goes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.pending = ""
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, text):
+        self.pending += text
+        usable = len(self.pending) - len(self.pending) % 4
+        if usable:
+            self._write_bytes(base64.urlsafe_b64decode(self.pending[:usable]))
+            self.pending = self.pending[usable:]
+
+    def close(self):
+        if self.pending:
+            self._write_bytes(base64.urlsafe_b64decode(self.pending + "=" * (-len(self.pending) % 4)))
+            self.pending = ""
+
+    def _write_bytes(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        self.digest.update(data)
+
+DATA_FIELD = re.compile(r'"data"\s*:\s*"')
+
+def _stream_attachment(session, message_id, attachment_id, writer, user_id='me'):
+    """Streams an attachment's base64url data from the Gmail API into writer without holding it in memory."""
+    url = f"{GMAIL_API_URL}/users/{user_id}/messages/{message_id}/attachments/{attachment_id}"
+    with session.get(url, params={'fields': 'data'}, stream=True, timeout=120) as response:
+        response.raise_for_status()
+        head = ""
+        in_data = False
+        for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+            text = chunk.decode('ascii')
+            if not in_data:
+                head += text
+                match = DATA_FIELD.search(head)
+                if not match:
+                    continue
+                text, in_data = head[match.end():], True
+            # base64url has no quotes, so the next quote ends the value
+            end = text.find('"')
+            if end != -1:
+                writer.write(text[:end])
+                return
+            writer.write(text)
+    raise ValueError(f"Attachment {attachment_id} response ended before its data")
+
+def _authorized_session(service):
+    """Returns a requests session using the service's credentials, one per thread, or None."""
+    creds = getattr(getattr(service, '_http', None), 'credentials', None)
+    if creds is None:
+        return None
+    from google.auth.transport.requests import AuthorizedSession
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = AuthorizedSession(creds)
+        return local.session
+    return session
+
+def download_attachment(service, session, message_id, part, filepath, user_id='me'):
+    """
+    Save one attachment to filepath through a temp file and an atomic rename.
+
+    Inline data is decoded directly; attachments stored separately are streamed
+    in chunks when an authorized session is available, so memory use does not
+    grow with the attachment size.
+
+    Returns:
+        dict: Manifest entry with filename, size and sha256
+    """
+    body = part.get('body', {})
+    tmp_path = f"{filepath}.part"
+
+    def fetch():
+        # Each attempt rewrites the temp file from the start
+        with open(tmp_path, 'wb') as f:
+            writer = _ChunkedWriter(f)
+            if 'data' in body:
+                writer.write(body['data'])
+            elif 'attachmentId' in body and session is not None:
+                _stream_attachment(session(), message_id, body['attachmentId'], writer, user_id)
+            elif 'attachmentId' in body:
+                att = service.users().messages().attachments().get(
+                    userId=user_id,
+                    messageId=message_id,
+                    id=body['attachmentId']
+                ).execute()
+                writer.write(att['data'])
+            writer.close()
+        return writer
+
+    try:
+        writer = retry.call(fetch, name='gmail.attachments.get')
+        os.replace(tmp_path, filepath)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return {
+        "filename": os.path.basename(filepath),
+        "original_filename": part['filename'],
+        "mime_type": part.get('mimeType'),
+        "size": writer.size,
+        "sha256": writer.digest.hexdigest(),
+    }
+
+def process_email_attachments(service, email_message, user_email, base_dir, folder_count=None, on_allocate=None):
     """
     Process attachments from Gmail API message format.
     
+    Every attachment in the MIME tree is downloaded, up to
+    ATTACHMENT_DOWNLOAD_CONCURRENCY at once, and its size and SHA-256 are
+    recorded in attachments_manifest.json next to the attachments folder.
+
     Args:
         service: Gmail API service instance
         email_message: Gmail API message object
         user_email: Email address of the sender
         base_dir: Base directory for saving attachments
+        folder_count: Submission folder allocated by an earlier attempt, reused
+            instead of allocating another one (optional)
+        on_allocate: Called with the number of a newly allocated submission
+            folder before anything is downloaded into it (optional)
         
     Returns:
-        tuple: (has_attachments, folder_count)
+        tuple: (has_attachments, folder_count, failed) where failed lists the
+        names of the attachments that could not be downloaded
+
+    Raises:
+        RuntimeError: If the email has attachments but none could be saved
     """
     try:
-        # Get existing folders to determine next folder number
         user_folder = os.path.join(base_dir, "users", user_email)
-        os.makedirs(user_folder, exist_ok=True)
-        
-        existing_folders = [int(f) for f in os.listdir(user_folder) if f.isdigit()]
-        folder_count = max(existing_folders, default=0) + 1
-        
+
         # Check for attachments in the message
-        if 'payload' not in email_message:
-            return False, folder_count - 1
-            
-        parts = []
-        if 'parts' in email_message['payload']:
-            parts = email_message['payload']['parts']
+        parts = list(iter_attachment_parts(email_message['payload'])) if 'payload' in email_message else []
+        if not parts:
+            return False, submissions.latest_submission(user_folder), []
+
+        if folder_count is not None:
+            # A retry overwrites what the earlier attempt saved in its folder
+            submission_folder = os.path.join(user_folder, str(folder_count))
         else:
-            parts = [email_message['payload']]
-            
-        has_attachments = False
-        
-        for part in parts:
-            if 'filename' in part and part['filename']:
-                has_attachments = True
-                # Create directories only when we find an attachment
-                attachment_dir = os.path.join(user_folder, str(folder_count), "attachments")
-                os.makedirs(attachment_dir, exist_ok=True)
-                
-                if 'body' in part and 'attachmentId' in part['body']:
-                    att_id = part['body']['attachmentId']
-                    filename = part['filename']
-                    filepath = os.path.join(attachment_dir, filename)
-                    
-                    # Get the attachment content
-                    att = service.users().messages().attachments().get(
-                        userId='me',
-                        messageId=email_message['id'],
-                        id=att_id
-                    ).execute()
-                    
-                    # Decode and save the attachment
-                    data = base64.urlsafe_b64decode(att['data'])
-                    with open(filepath, 'wb') as f:
-                        f.write(data)
-                    logging.info(f"✅ Saved attachment: {filename}")
-        
-        if has_attachments:
-            return True, folder_count
-        return False, folder_count - 1
+            # Reserve the next submission folder only when we find an attachment
+            folder_count, submission_folder = submissions.allocate_submission(user_folder)
+            if on_allocate is not None:
+                on_allocate(folder_count)
+        attachment_dir = os.path.join(submission_folder, "attachments")
+        os.makedirs(attachment_dir, exist_ok=True)
+
+        taken = set()
+        targets = [(part, _unique_path(attachment_dir, part['filename'], taken)) for part in parts]
+        session = _authorized_session(service)
+
+        def download(target):
+            part, filepath = target
+            try:
+                entry = download_attachment(service, session, email_message['id'], part, filepath)
+                logging.info(f"✅ Saved attachment: {entry['filename']} ({entry['size']} bytes)")
+                return entry
+            except Exception as e:
+                logging.error(f"❌ Could not download attachment {part['filename']}: {e}")
+                return {"filename": os.path.basename(filepath), "original_filename": part['filename'], "error": str(e)}
+
+        # Without credentials for per-thread sessions, downloads go through the shared
+        # service, whose httplib2 client is not thread-safe, so they run one at a time
+        workers = max(1, ATTACHMENT_DOWNLOAD_CONCURRENCY) if session is not None else 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            manifest = list(executor.map(download, targets))
+
+        with open(os.path.join(submission_folder, "attachments_manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
+
+        failed = [entry["original_filename"] for entry in manifest if "error" in entry]
+        if len(failed) == len(manifest):
+            raise RuntimeError(f"None of the {len(manifest)} attachments could be downloaded")
+        if failed:
+            logging.warning(f"⚠️ Saved {len(manifest) - len(failed)} of {len(manifest)} attachments, failed: {failed}")
+        return True, folder_count, failed
         
     except Exception as e:
+        # Not reported as "no attachments": the job fails and the email is tried again
         logging.error(f"Error processing attachments: {e}")
-        return False, 0
\ No newline at end of file
+        raise
@@ -1,6 +1,12 @@
 import logging
-from email_fetcher import process_all_emails
 import time
+start_time = time.time()  # Start measuring time
+
+import os
+import re
+import sys
+import subprocess
+from email_fetcher import process_all_emails
 
 # Configure logging
 logging.basicConfig(
@@ -15,10 +21,42 @@ logging.getLogger('openai').setLevel(logging.WARNING)
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('httpcore').setLevel(logging.WARNING)
 
-start_time = time.time()  # Start measuring time
+# Modules that should only be loaded once a deal has attachments
+HEAVY_MODULES = ["openai", "pandas", "openpyxl", "uncertainties", "numpy"]
+
+
+def startup_report(top=15):
+    """
+    Prints where startup time goes, in the style of python -X importtime.
+
+    The import of email_fetcher is replayed in a child interpreter with
+    -X importtime, and the slowest imports by cumulative time are listed.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import email_fetcher"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)", line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            rows.append((int(cumulative_us), int(self_us), len(indent) // 2, module))
+
+    total_us = sum(cumulative for cumulative, _, depth, _ in rows if depth == 0)
+    print(f"\n⏱️ Startup report: importing email_fetcher takes {total_us / 1e6:.3f}s")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for cumulative, self_us, depth, module in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1e3:>10.1f}ms {self_us / 1e3:>8.1f}ms  {'  ' * depth}{module}")
+    loaded = [module for module in HEAVY_MODULES if module in sys.modules]
+    print(f"Heavy modules loaded in this run: {', '.join(loaded) or 'none'}")
+
 
 if __name__ == "__main__":
     process_all_emails()
 
-end_time = time.time()  # End measuring time
-print(f"\nTotal execution time: {end_time - start_time:.2f} seconds")
+    end_time = time.time()  # End measuring time
+    print(f"\nTotal execution time: {end_time - start_time:.2f} seconds")
+
+    if "--startup-report" in sys.argv:
+        startup_report()
@@ -0,0 +1,287 @@
+import os
+import time
+import hashlib
+import logging
+import state_db
+import retry
+
+# Cached uploads and vector stores unused for this many days are dropped
+OPENAI_CACHE_TTL_DAYS = float(os.getenv("OPENAI_CACHE_TTL_DAYS", "30"))
+
+# Upper bounds on cached entries; the least recently used go first
+OPENAI_CACHE_MAX_FILES = int(os.getenv("OPENAI_CACHE_MAX_FILES", "2000"))
+OPENAI_CACHE_MAX_VECTOR_STORES = int(os.getenv("OPENAI_CACHE_MAX_VECTOR_STORES", "500"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS openai_files (
+    sha256 TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    filename TEXT,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS openai_vector_stores (
+    fileset_key TEXT PRIMARY KEY,
+    vector_store_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS openai_vector_store_files (
+    fileset_key TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (fileset_key, sha256)
+);
+"""
+
+
+def sha256_file(path, chunk_size=1024 * 1024):
+    """Returns the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fileset_key(hashes):
+    """Returns a key identifying a set of files regardless of order or duplicates."""
+    return hashlib.sha256("\n".join(sorted(set(hashes))).encode()).hexdigest()
+
+
+class OpenAIFileCache:
+    """
+    Content-addressed index of files uploaded to OpenAI and the vector stores built from them.
+
+    Files are keyed by the SHA-256 of their content, so an attachment that was
+    already uploaded for an earlier deal is never uploaded again. A deal whose
+    set of files matches an earlier deal reuses that deal's vector store as is,
+    without uploading or indexing anything.
+
+    Workers that upload the same content or build the same store at once keep
+    whichever was recorded first and delete their own copy.
+    """
+
+    def __init__(self, client, db_path=state_db.STATE_DB_PATH, ttl_days=OPENAI_CACHE_TTL_DAYS,
+                 max_files=OPENAI_CACHE_MAX_FILES, max_vector_stores=OPENAI_CACHE_MAX_VECTOR_STORES):
+        self.client = client
+        self.db_path = db_path
+        self.ttl = ttl_days * 86400
+        self.max_files = max_files
+        self.max_vector_stores = max_vector_stores
+        with state_db.connection(self.db_path) as conn:
+            conn.executescript(SCHEMA)
+
+    def file_id_for(self, path, sha256=None):
+        """
+        Returns the OpenAI file id for a local file, uploading it only if its content is new.
+
+        A cached id is checked with files.retrieve first; if the file was
+        deleted or expired on OpenAI, the stale row is dropped and the file is
+        uploaded again.
+
+        Args:
+            path: Local file path
+            sha256: Content hash if already known
+
+        Returns:
+            str: OpenAI file id
+        """
+        sha256 = sha256 or sha256_file(path)
+        now = time.time()
+        with state_db.connection(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT file_id FROM openai_files WHERE sha256 = ? AND last_used > ?",
+                (sha256, now - self.ttl)
+            ).fetchone()
+
+        if row and self._file_alive(row["file_id"]):
+            with state_db.connection(self.db_path) as conn:
+                conn.execute("UPDATE openai_files SET last_used = ? WHERE sha256 = ?", (now, sha256))
+            print(f"♻️ Reusing uploaded file {os.path.basename(path)} ({row['file_id']})")
+            return row["file_id"]
+        if row:
+            with state_db.connection(self.db_path) as conn:
+                conn.execute("DELETE FROM openai_files WHERE sha256 = ? AND file_id = ?", (sha256, row["file_id"]))
+
+        with open(path, "rb") as f:
+            uploaded = self.client.files.create(file=f, purpose="assistants")
+        print(f"✅ Uploaded {os.path.basename(path)} to OpenAI ({uploaded.id})")
+
+        with state_db.connection(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another worker may have uploaded the same content meanwhile; the first one recorded wins
+            winner = conn.execute(
+                "SELECT file_id FROM openai_files WHERE sha256 = ? AND last_used > ?",
+                (sha256, now - self.ttl)
+            ).fetchone()
+            if winner is None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO openai_files (sha256, file_id, filename, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (sha256, uploaded.id, os.path.basename(path), now, now)
+                )
+            conn.execute("COMMIT")
+
+        if winner is not None:
+            self._delete_file(uploaded.id)
+            print(f"♻️ {os.path.basename(path)} was uploaded by another worker, using {winner['file_id']}")
+            return winner["file_id"]
+        return uploaded.id
+
+    def _file_alive(self, file_id):
+        """Checks that a cached file still exists on OpenAI and was processed without error."""
+        try:
+            uploaded = self.client.files.retrieve(file_id)
+            return getattr(uploaded, "status", None) != "error"
+        except Exception as e:
+            logging.warning(f"Cached file {file_id} is no longer usable: {e}")
+            return False
+
+    def _vector_store_alive(self, vector_store_id):
+        """Checks that a cached vector store still exists on OpenAI and has not expired."""
+        try:
+            vector_store = self.client.beta.vector_stores.retrieve(vector_store_id)
+            return vector_store.status != "expired"
+        except Exception as e:
+            logging.warning(f"Cached vector store {vector_store_id} is no longer usable: {e}")
+            return False
+
+    def vector_store_for(self, file_paths, name="Company Data"):
+        """
+        Returns a vector store containing exactly the given files.
+
+        Args:
+            file_paths: Local paths of the deal's attachments
+            name: Name given to a newly created vector store
+
+        Returns:
+            str: Vector store id
+        """
+        hashes = {path: sha256_file(path) for path in file_paths}
+        key = fileset_key(hashes.values())
+        now = time.time()
+
+        with state_db.connection(self.db_path) as conn:
+            row = conn.execute(
+                "SELECT vector_store_id FROM openai_vector_stores WHERE fileset_key = ? AND last_used > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+
+        if row and self._vector_store_alive(row["vector_store_id"]):
+            with state_db.connection(self.db_path) as conn:
+                conn.execute("UPDATE openai_vector_stores SET last_used = ? WHERE fileset_key = ?", (now, key))
+                conn.executemany(
+                    "UPDATE openai_files SET last_used = ? WHERE sha256 = ?",
+                    [(now, sha256) for sha256 in set(hashes.values())]
+                )
+            print(f"♻️ Reusing vector store {row['vector_store_id']} for {len(file_paths)} files")
+            return row["vector_store_id"]
+        if row:
+            with state_db.connection(self.db_path) as conn:
+                conn.execute(
+                    "DELETE FROM openai_vector_stores WHERE fileset_key = ? AND vector_store_id = ?",
+                    (key, row["vector_store_id"])
+                )
+
+        # Upload only what OpenAI has not seen, one id per distinct content
+        file_ids = {}
+        for path, sha256 in hashes.items():
+            if sha256 not in file_ids:
+                file_ids[sha256] = self.file_id_for(path, sha256)
+
+        vector_store = self.client.beta.vector_stores.create(
+            name=name,
+            expires_after={"anchor": "last_active_at", "days": max(1, int(self.ttl // 86400))}
+        )
+        def index():
+            batch = self.client.beta.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store.id,
+                file_ids=list(file_ids.values())
+            )
+            if batch.status != "completed":
+                raise retry.TransientError(f"Indexing batch {batch.id} ended as {batch.status}")
+            return batch
+
+        # Adding the same files to the store again is harmless, so a failed batch is simply rerun
+        try:
+            retry.call(index, name="openai.file_batches")
+        except Exception:
+            self._delete_vector_store(vector_store.id)
+            raise
+        print(f"✅ Indexed {len(file_ids)} files in vector store {vector_store.id}")
+
+        with state_db.connection(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # Another worker may have built a store for the same files meanwhile; the first one recorded wins
+            winner = conn.execute(
+                "SELECT vector_store_id FROM openai_vector_stores WHERE fileset_key = ? AND last_used > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if winner is None:
+                conn.execute("DELETE FROM openai_vector_store_files WHERE fileset_key = ?", (key,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO openai_vector_stores (fileset_key, vector_store_id, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, vector_store.id, now, now)
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO openai_vector_store_files (fileset_key, sha256) VALUES (?, ?)",
+                    [(key, sha256) for sha256 in file_ids]
+                )
+            conn.execute("COMMIT")
+
+        if winner is not None:
+            self._delete_vector_store(vector_store.id)
+            print(f"♻️ Another worker built a vector store for these files, using {winner['vector_store_id']}")
+            return winner["vector_store_id"]
+
+        self.evict()
+        return vector_store.id
+
+    def _delete_file(self, file_id):
+        try:
+            self.client.files.delete(file_id)
+        except Exception as e:
+            logging.warning(f"Could not delete file {file_id}: {e}")
+
+    def _delete_vector_store(self, vector_store_id):
+        try:
+            self.client.beta.vector_stores.delete(vector_store_id)
+        except Exception as e:
+            logging.warning(f"Could not delete vector store {vector_store_id}: {e}")
+
+    def evict(self):
+        """
+        Drops expired and least recently used entries, deleting the remote objects too.
+
+        Files still referenced by a cached vector store are kept.
+        """
+        cutoff = time.time() - self.ttl
+        with state_db.connection(self.db_path) as conn:
+            stale_stores = conn.execute(
+                "SELECT fileset_key, vector_store_id FROM openai_vector_stores "
+                "WHERE last_used <= ? OR fileset_key NOT IN ("
+                "  SELECT fileset_key FROM openai_vector_stores ORDER BY last_used DESC LIMIT ?)",
+                (cutoff, self.max_vector_stores)
+            ).fetchall()
+            for row in stale_stores:
+                conn.execute("DELETE FROM openai_vector_stores WHERE fileset_key = ?", (row["fileset_key"],))
+                conn.execute("DELETE FROM openai_vector_store_files WHERE fileset_key = ?", (row["fileset_key"],))
+
+            stale_files = conn.execute(
+                "SELECT sha256, file_id FROM openai_files "
+                "WHERE sha256 NOT IN (SELECT sha256 FROM openai_vector_store_files) "
+                "AND (last_used <= ? OR sha256 NOT IN ("
+                "  SELECT sha256 FROM openai_files ORDER BY last_used DESC LIMIT ?))",
+                (cutoff, self.max_files)
+            ).fetchall()
+            for row in stale_files:
+                conn.execute("DELETE FROM openai_files WHERE sha256 = ?", (row["sha256"],))
+
+        for row in stale_stores:
+            self._delete_vector_store(row["vector_store_id"])
+        for row in stale_files:
+            self._delete_file(row["file_id"])
+
+        if stale_stores or stale_files:
+            print(f"🧹 Evicted {len(stale_stores)} vector stores and {len(stale_files)} files from the OpenAI cache")
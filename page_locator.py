@@ -0,0 +1,159 @@
+import os
+import re
+import json
+import logging
+from config import BASE_DIR
+from openai_cache import sha256_file
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # The locator is skipped and whole files are searched instead
+    PdfReader = None
+
+# Per-file page indexes, keyed by the SHA-256 of the PDF
+PAGE_INDEX_CACHE_DIR = os.getenv("PAGE_INDEX_CACHE_DIR", os.path.join(BASE_DIR, "cache", "page_index"))
+
+# A page needs at least this score to count as part of a section
+MIN_PAGE_SCORE = float(os.getenv("MIN_PAGE_SCORE", "8"))
+
+# Most pages sent for one section, and the largest excerpt worth inlining
+MAX_SECTION_PAGES = int(os.getenv("MAX_SECTION_PAGES", "4"))
+MAX_EXCERPT_CHARS = int(os.getenv("MAX_EXCERPT_CHARS", "40000"))
+
+# JSON file of each section -> (title phrases, weight), (line item words, weight)
+SECTION_KEYWORDS = {
+    "income_statement.json": (
+        ["income statement", "statement of income", "statement of operations", "statement of earnings",
+         "profit and loss", "profit & loss", "p&l"],
+        ["revenue", "sales", "cost of sales", "cost of goods", "gross profit", "gross margin", "net income",
+         "expenses", "ebitda", "wages", "rent", "utilities"],
+    ),
+    "balance_sheet.json": (
+        ["balance sheet", "statement of financial position"],
+        ["total assets", "total liabilities", "equity", "current assets", "current liabilities",
+         "accounts receivable", "accounts payable", "retained earnings", "inventory", "prepaid"],
+    ),
+    "adjustments.json": (
+        ["addbacks", "add-backs", "add backs", "ebitda adjustments", "normalization", "normalized ebitda",
+         "recast", "seller's discretionary earnings", "discretionary earnings"],
+        ["addback", "add-back", "adjustment", "normalized", "sde", "owner's salary", "owner compensation",
+         "one-time", "non-recurring", "personal"],
+    ),
+    "company_info.json": (
+        ["executive summary", "business overview", "company overview", "asking price", "listing price"],
+        ["years in business", "established", "founded", "employees", "lease", "square feet", "sq ft",
+         "location", "broker", "owner", "facility", "industry"],
+    ),
+}
+TITLE_WEIGHT = 5
+
+# Financial statements are number-heavy; pages with few figures are scored down
+STATEMENT_SECTIONS = ("income_statement.json", "balance_sheet.json", "adjustments.json")
+NUMBER_PATTERN = re.compile(r"\(?-?\$?\d[\d,]*(\.\d+)?\)?")
+
+
+def score_page(text):
+    """Scores one page's text for every section."""
+    lower = text.lower()
+    number_density = min(1.0, len(NUMBER_PATTERN.findall(text)) / 20)
+    scores = {}
+    for section, (titles, words) in SECTION_KEYWORDS.items():
+        score = TITLE_WEIGHT * sum(lower.count(title) for title in titles)
+        score += sum(lower.count(word) for word in words)
+        if section in STATEMENT_SECTIONS:
+            score *= number_density
+        scores[section] = round(score, 2)
+    return scores
+
+
+def index_pdf(path, sha256=None, cache_dir=PAGE_INDEX_CACHE_DIR):
+    """
+    Extracts and scores the text of every page of a PDF.
+
+    The index is cached per file hash, so a CIM sent again is not re-read.
+
+    Returns:
+        dict: {"sha256", "texts": [...], "scores": [{section: score}, ...]} or None
+    """
+    if PdfReader is None:
+        return None
+    sha256 = sha256 or sha256_file(path)
+    cache_path = os.path.join(cache_dir, f"{sha256}.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+
+    try:
+        reader = PdfReader(path)
+        texts = [page.extract_text() or "" for page in reader.pages]
+    except Exception as e:
+        logging.warning(f"Could not read the pages of {path}: {e}")
+        return None
+
+    index = {"sha256": sha256, "texts": texts, "scores": [score_page(text) for text in texts]}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def select_pages(scores, section):
+    """Returns the page numbers (0-based, in order) that make up a section."""
+    ranked = sorted(range(len(scores)), key=lambda page: scores[page][section], reverse=True)
+    selected = {page for page in ranked[:MAX_SECTION_PAGES] if scores[page][section] >= MIN_PAGE_SCORE}
+    # Tables often run onto the next page
+    for page in list(selected):
+        following = page + 1
+        if following < len(scores) and scores[following][section] >= MIN_PAGE_SCORE / 2:
+            selected.add(following)
+    return sorted(selected)
+
+
+def locate_sections(file_paths, submission_folder):
+    """
+    Builds text excerpts of the pages relevant to each extraction prompt.
+
+    The page index of the deal is written to page_index.json next to the
+    attachments folder. A section only gets an excerpt when every PDF was
+    indexed and the selected pages stay under MAX_EXCERPT_CHARS; otherwise
+    its prompt searches the whole files as before.
+
+    Args:
+        file_paths: Attachments the model would read
+        submission_folder: The deal's users/<email>/<n> folder
+
+    Returns:
+        dict: JSON filename -> excerpt text
+    """
+    pdf_paths = [path for path in file_paths if path.lower().endswith(".pdf")]
+    if not pdf_paths or len(pdf_paths) != len(file_paths):
+        # Other formats are not indexed, so the whole files still need searching
+        return {}
+
+    indexes = {}
+    for path in pdf_paths:
+        index = index_pdf(path)
+        if index is None:
+            return {}
+        indexes[path] = index
+
+    excerpts = {}
+    page_index = {}
+    for section in SECTION_KEYWORDS:
+        parts = []
+        for path, index in indexes.items():
+            pages = select_pages(index["scores"], section)
+            page_index.setdefault(os.path.basename(path), {"sha256": index["sha256"], "sections": {}})
+            page_index[os.path.basename(path)]["sections"][section] = [page + 1 for page in pages]
+            for page in pages:
+                parts.append(f"--- {os.path.basename(path)}, page {page + 1} ---\n{index['texts'][page]}")
+        excerpt = "\n\n".join(parts)
+        if parts and len(excerpt) <= MAX_EXCERPT_CHARS:
+            excerpts[section] = excerpt
+
+    with open(os.path.join(submission_folder, "page_index.json"), "w") as f:
+        json.dump(page_index, f, indent=4)
+
+    if excerpts:
+        print(f"📑 Page excerpts built for {', '.join(sorted(excerpts))}")
+    return excerpts
@@ -332,3 +332,22 @@ If any information is unknown, insert `null`:
 - **Do not include any explanations, extra text, or prefixes.**  
 - **Ensure valid JSON formatting.**
 """
+
+STRUCTURED_EXTRACTION_PROMPT = """
+You are given the documents of a business for sale. Extract all of the following sections
+in one pass and return them together in the JSON structure you have been given.
+Follow the instructions of each section below. Where a section asks for a JSON layout,
+use the fields of the given structure instead: every financial table becomes "years" plus
+a list of "line_items", each with the account "name" (keeping the leading spaces that mark
+subcategories) and its "values" in the same order as "years".
+If a table cannot be found, set its "found" field to false and leave its lists empty.
+"""
+
+SECTION_EXCERPT_PROMPT = """
+{prompt}
+
+The pages of the documents that contain this information are reproduced below.
+Work from these pages only; you do not need to search the files.
+
+{excerpt}
+"""
@@ -0,0 +1,330 @@
+import os
+import re
+import json
+import base64
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+import state_db
+import retry
+
+# Account limits used until the first response reports the real ones
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "30000"))
+
+# "memory" shares the limits between the threads of one process, "sqlite" between processes too
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+# Retries of a failed OpenAI request (see retry.RetryTransport); each attempt waits for the limiter first
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "6"))
+
+# Token estimates: prompt characters per token, context file_search adds, and reply allowance
+CHARS_PER_TOKEN = 4
+FILE_SEARCH_TOKENS = int(os.getenv("FILE_SEARCH_TOKENS", "16000"))
+COMPLETION_TOKENS = int(os.getenv("COMPLETION_TOKENS", "2000"))
+
+# Tokens charged per page of an inlined PDF (file_data) and per inlined image
+FILE_PAGE_TOKENS = int(os.getenv("FILE_PAGE_TOKENS", "1500"))
+
+# Longest single wait before the buckets are checked again
+MAX_SLEEP_SECONDS = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+    name TEXT PRIMARY KEY,
+    capacity REAL NOT NULL,
+    available REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Tokens the next run-creating request is expected to use, set by expect_tokens()
+_expected_tokens = contextvars.ContextVar("expected_tokens", default=None)
+
+
+def parse_reset(value):
+    """Converts an x-ratelimit-reset-* value such as "6m0s", "1.5s" or "120ms" to seconds."""
+    if not value:
+        return None
+    total = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def estimate_prompt_tokens(prompt, file_search=True):
+    """Estimates the tokens a run of the given prompt uses, including retrieved context and the reply."""
+    tokens = len(prompt) / CHARS_PER_TOKEN + COMPLETION_TOKENS
+    if file_search:
+        tokens += FILE_SEARCH_TOKENS
+    return int(tokens)
+
+
+def count_pdf_pages(data_url):
+    """Counts the pages of a base64 data: URL PDF, at least 1."""
+    try:
+        pdf = base64.b64decode(data_url.split(",", 1)[-1])
+    except ValueError:
+        return 1
+    return max(1, len(re.findall(rb"/Type\s*/Page(?!s)", pdf)))
+
+
+def estimate_chat_tokens(body):
+    """
+    Estimates the prompt tokens of a chat completions request body.
+
+    Only text counts by length. Inlined files and images are charged a fixed
+    amount per page or image, since their base64 size says little about the
+    tokens they use; the x-ratelimit-remaining-tokens header corrects the
+    bucket afterwards.
+    """
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return int(len(body) / CHARS_PER_TOKEN)
+    chars = 0
+    tokens = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                chars += len(part.get("text", ""))
+            elif part.get("type") == "file":
+                tokens += FILE_PAGE_TOKENS * count_pdf_pages(part.get("file", {}).get("file_data", ""))
+            else:
+                tokens += FILE_PAGE_TOKENS
+    return int(chars / CHARS_PER_TOKEN) + tokens
+
+
+@contextmanager
+def expect_tokens(tokens):
+    """Tells the limiter how many tokens the run created inside this block will use."""
+    token = _expected_tokens.set(tokens)
+    try:
+        yield
+    finally:
+        _expected_tokens.reset(token)
+
+
+class TokenBucket:
+    """Token bucket refilling its full capacity every period, shared by the threads of a process."""
+
+    def __init__(self, name, capacity, period=60.0):
+        self.name = name
+        self.period = period
+        self.capacity = float(capacity)
+        self.available = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated_at) * self.capacity / self.period)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        """
+        Takes amount from the bucket if it is there.
+
+        A request larger than the whole capacity goes through once the bucket
+        is full and empties it, so it is delayed rather than refused, without
+        leaving a debt that would stall every later request.
+
+        Returns:
+            float: 0 if taken, otherwise the seconds until it could be
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            needed = min(amount, self.capacity)
+            if self.available >= needed:
+                self.available -= needed
+                return 0.0
+            return (needed - self.available) * self.period / self.capacity
+
+    def release(self, amount):
+        with self.lock:
+            self.available = min(self.capacity, self.available + amount)
+
+    def sync(self, limit=None, remaining=None):
+        """Adopts the limit and remaining amount reported by the API."""
+        with self.lock:
+            self._refill(time.monotonic())
+            if limit:
+                self.capacity = float(limit)
+            if remaining is not None:
+                self.available = min(self.available, float(remaining))
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """Token bucket whose state lives in the state database, shared by every process using it."""
+
+    def __init__(self, name, capacity, period=60.0, db_path=state_db.STATE_DB_PATH):
+        self.name = name
+        self.period = period
+        self.capacity = float(capacity)
+        self.db_path = db_path
+        with state_db.connection(self.db_path) as conn:
+            conn.executescript(SCHEMA)
+            conn.execute(
+                "INSERT OR IGNORE INTO rate_limit_buckets (name, capacity, available, updated_at) VALUES (?, ?, ?, ?)",
+                (name, self.capacity, self.capacity, time.time())
+            )
+
+    def _update(self, change):
+        with state_db.connection(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT * FROM rate_limit_buckets WHERE name = ?", (self.name,)).fetchone()
+                now = time.time()
+                capacity = row["capacity"]
+                available = min(capacity, row["available"] + (now - row["updated_at"]) * capacity / self.period)
+                capacity, available, result = change(capacity, available)
+                conn.execute(
+                    "UPDATE rate_limit_buckets SET capacity = ?, available = ?, updated_at = ? WHERE name = ?",
+                    (capacity, available, now, self.name)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self.capacity = capacity
+        return result
+
+    def reserve(self, amount):
+        def change(capacity, available):
+            needed = min(amount, capacity)
+            if available >= needed:
+                return capacity, available - needed, 0.0
+            return capacity, available, (needed - available) * self.period / capacity
+        return self._update(change)
+
+    def release(self, amount):
+        self._update(lambda capacity, available: (capacity, min(capacity, available + amount), None))
+
+    def sync(self, limit=None, remaining=None):
+        def change(capacity, available):
+            capacity = float(limit) if limit else capacity
+            if remaining is not None:
+                available = min(available, float(remaining))
+            return capacity, available, None
+        self._update(change)
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute governor for OpenAI calls.
+
+    Every request waits until both buckets can cover it, so calls queue at
+    the quota ceiling instead of failing with 429s. The buckets adopt the
+    limits and remaining amounts of the x-ratelimit-* response headers, and a
+    429 pauses every caller until the reported reset time.
+    """
+
+    def __init__(self, rpm=OPENAI_RPM_LIMIT, tpm=OPENAI_TPM_LIMIT, backend=RATE_LIMIT_BACKEND):
+        bucket = SQLiteTokenBucket if backend == "sqlite" else TokenBucket
+        self.requests = bucket("openai_requests", rpm)
+        self.tokens = bucket("openai_tokens", tpm)
+        self.cooldown_until = 0.0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        """
+        Blocks until one request and the given tokens are available, then takes them.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        start = time.monotonic()
+        while True:
+            wait = self.cooldown_until - time.monotonic()
+            if wait <= 0:
+                wait = self.requests.reserve(1)
+                if wait <= 0 and tokens:
+                    wait = self.tokens.reserve(tokens)
+                    if wait > 0:
+                        self.requests.release(1)
+            if wait <= 0:
+                waited = time.monotonic() - start
+                with self.lock:
+                    self.waited += waited
+                return waited
+            time.sleep(min(wait, MAX_SLEEP_SECONDS))
+
+    def update_from_headers(self, headers, status_code=200):
+        """Syncs the buckets with an OpenAI response's rate limit headers."""
+        def number(name):
+            try:
+                return float(headers[name])
+            except (KeyError, TypeError, ValueError):
+                return None
+
+        self.requests.sync(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"))
+        self.tokens.sync(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"))
+
+        if status_code == 429:
+            pause = number("retry-after") or max(
+                parse_reset(headers.get("x-ratelimit-reset-requests")) or 0,
+                parse_reset(headers.get("x-ratelimit-reset-tokens")) or 0,
+            ) or 1.0
+            with self.lock:
+                self.cooldown_until = max(self.cooldown_until, time.monotonic() + pause)
+            logging.warning(f"⏳ OpenAI rate limit hit, pausing requests for {pause:.1f}s")
+
+    def estimate_request_tokens(self, request):
+        """Estimates the tokens an HTTP request to the OpenAI API will use."""
+        if request.method != "POST":
+            return 0
+        path = request.url.path
+        if path.endswith("/runs"):
+            expected = _expected_tokens.get()
+            return expected if expected is not None else FILE_SEARCH_TOKENS + COMPLETION_TOKENS
+        if path.endswith("/chat/completions"):
+            return estimate_chat_tokens(request.content) + COMPLETION_TOKENS
+        return 0
+
+    def on_request(self, request):
+        waited = self.acquire(self.estimate_request_tokens(request))
+        if waited > 1:
+            logging.info(f"⏳ Waited {waited:.1f}s for OpenAI rate limit ({request.method} {request.url.path})")
+
+    def on_response(self, response):
+        self.update_from_headers(response.headers, response.status_code)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Returns the process-wide rate limiter, created on first use."""
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+        return _limiter
+
+
+def openai_client(**kwargs):
+    """
+    Returns an OpenAI client whose every request goes through the shared rate limiter.
+
+    The limiter and the retry policy are attached at the httpx transport, so
+    assistants, threads, runs, files, vector stores and chat completions are
+    all governed, and every retry waits for the limiter again. The SDK's own
+    retries are turned off so failures are retried in one place.
+    """
+    import httpx
+    from openai import OpenAI
+
+    limiter = get_limiter()
+    transport = retry.RetryTransport(
+        httpx.HTTPTransport(), name="openai", attempts=OPENAI_MAX_RETRIES + 1,
+        before_attempt=limiter.on_request, after_attempt=limiter.on_response,
+    )
+    http_client = httpx.Client(timeout=httpx.Timeout(600.0, connect=10.0), transport=transport)
+    return OpenAI(http_client=http_client, max_retries=0, **kwargs)
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import prompts
+from config import BASE_DIR
+
+# Folder holding one JSON file per cached extraction result
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(BASE_DIR, "cache", "results"))
+
+# Least recently used results are evicted once the cache grows past this size
+RESULT_CACHE_MAX_BYTES = int(float(os.getenv("RESULT_CACHE_MAX_MB", "200")) * 1024 * 1024)
+
+
+def prompt_hash(prompt):
+    """Returns the SHA-256 of a prompt's text."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def prompt_name(prompt):
+    """Returns the name of the prompts.py constant holding this prompt text, if any."""
+    for name, value in vars(prompts).items():
+        if name.isupper() and value == prompt:
+            return name
+    return None
+
+
+def cache_key(attachment_hashes, prompt, model, context_prompts=()):
+    """
+    Builds the key of an extraction result.
+
+    Args:
+        attachment_hashes: SHA-256 of each attachment sent to the model
+        prompt: Prompt text
+        model: Model name
+        context_prompts: Other text sent with the prompt that shapes the result,
+            e.g. the structured extraction instructions, or the excerpt
+            template and the page excerpt inlined into the prompt
+
+    Returns:
+        str: Hex key
+    """
+    material = "\n".join(
+        sorted(set(attachment_hashes)) + [prompt_hash(prompt), model]
+        + [prompt_hash(context) for context in context_prompts]
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def _entry_path(key, cache_dir):
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def load_into(key, filename, cache_dir=RESULT_CACHE_DIR):
+    """
+    Writes a cached result straight to its JSON file.
+
+    Args:
+        key: Result key from cache_key
+        filename: JSON file to write, e.g. json_files/balance_sheet.json
+        cache_dir: Cache folder
+
+    Returns:
+        The cached JSON data, or None on a miss
+    """
+    path = _entry_path(key, cache_dir)
+    try:
+        with open(path, "r") as f:
+            entry = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    # Touch the entry so eviction sees it as recently used
+    os.utime(path, None)
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "w") as f:
+        json.dump(entry["data"], f, indent=4)
+    print(f"♻️ {os.path.basename(filename)} served from the result cache")
+    return entry["data"]
+
+
+def store(key, data, prompt, model, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES):
+    """
+    Saves an extraction result, then evicts old entries if the cache is over its size limit.
+
+    Args:
+        key: Result key from cache_key
+        data: Parsed JSON returned by the model
+        prompt: Prompt text that produced it
+        model: Model that produced it
+        cache_dir: Cache folder
+        max_bytes: Size limit of the cache folder
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = {
+        "prompt_name": prompt_name(prompt),
+        "prompt_sha256": prompt_hash(prompt),
+        "model": model,
+        "created_at": time.time(),
+        "data": data,
+    }
+    path = _entry_path(key, cache_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, path)
+    evict(max_bytes, cache_dir)
+
+
+def _entries(cache_dir):
+    """Yields (path, stat) for every cached result."""
+    if not os.path.isdir(cache_dir):
+        return
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".json"):
+            yield entry.path, entry.stat()
+
+
+def evict(max_bytes=RESULT_CACHE_MAX_BYTES, cache_dir=RESULT_CACHE_DIR):
+    """Deletes the least recently used results until the cache fits in max_bytes."""
+    entries = sorted(_entries(cache_dir), key=lambda item: item[1].st_mtime)
+    total = sum(stat.st_size for _, stat in entries)
+    removed = 0
+    for path, stat in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= stat.st_size
+        removed += 1
+    if removed:
+        logging.info(f"🧹 Evicted {removed} entries from the result cache")
+    return removed
+
+
+def invalidate(prompt_names=None, stale=False, everything=False, cache_dir=RESULT_CACHE_DIR):
+    """
+    Deletes cached results.
+
+    Args:
+        prompt_names: Delete results produced by these prompts.py constants
+        stale: Delete results whose prompt text no longer matches prompts.py
+        everything: Delete all results
+        cache_dir: Cache folder
+
+    Returns:
+        int: Number of entries deleted
+    """
+    prompt_names = set(prompt_names or [])
+    current_hashes = {
+        name: prompt_hash(value)
+        for name, value in vars(prompts).items()
+        if name.isupper() and isinstance(value, str)
+    }
+
+    removed = 0
+    for path, _ in list(_entries(cache_dir)):
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            entry = {}
+        name = entry.get("prompt_name")
+        is_stale = current_hashes.get(name) != entry.get("prompt_sha256")
+        if everything or name in prompt_names or (stale and is_stale):
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the extraction result cache.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    invalidate_parser = subparsers.add_parser("invalidate", help="Delete cached results")
+    invalidate_parser.add_argument("prompts", nargs="*", help="prompts.py constants, e.g. BALANCE_SHEET_PROMPT")
+    invalidate_parser.add_argument("--stale", action="store_true", help="Delete results whose prompt text has changed")
+    invalidate_parser.add_argument("--all", action="store_true", help="Delete every cached result")
+    args = parser.parse_args()
+
+    if not (args.prompts or args.stale or args.all):
+        parser.error("name at least one prompt, or pass --stale or --all")
+
+    unknown = [name for name in args.prompts if not isinstance(getattr(prompts, name, None), str)]
+    if unknown:
+        print(f"❌ Unknown prompt(s): {', '.join(unknown)}")
+        sys.exit(1)
+
+    count = invalidate(args.prompts, stale=args.stale, everything=args.all)
+    print(f"✅ Deleted {count} cached results")
@@ -0,0 +1,245 @@
+import os
+import time
+import random
+import socket
+import logging
+import threading
+from collections import defaultdict
+
+# Attempts per call, including the first one
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+
+# Exponential backoff with full jitter between RETRY_BASE_SECONDS and RETRY_MAX_SECONDS
+RETRY_BASE_SECONDS = float(os.getenv("RETRY_BASE_SECONDS", "1"))
+RETRY_MAX_SECONDS = float(os.getenv("RETRY_MAX_SECONDS", "32"))
+
+# A call is not retried once this many seconds have passed since its first attempt
+RETRY_DEADLINE_SECONDS = float(os.getenv("RETRY_DEADLINE_SECONDS", "300"))
+
+# HTTP statuses worth retrying: rate limits and server errors
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Gmail reports some rate limits as 403 with one of these reasons
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# Exceptions raised for network trouble rather than a bad request
+TRANSIENT_EXCEPTIONS = (ConnectionError, TimeoutError, socket.timeout)
+
+
+class TransientError(Exception):
+    """Raised by a call whose result says it should be tried again, e.g. a failed upload batch."""
+
+
+_counters = defaultdict(lambda: {"calls": 0, "retries": 0, "giveups": 0})
+_counters_lock = threading.Lock()
+
+
+def _count(name, counter):
+    with _counters_lock:
+        _counters[name][counter] += 1
+
+
+def stats():
+    """
+    Returns the retry counters of every named call.
+
+    Returns:
+        dict: name -> {"calls", "retries", "giveups"}
+    """
+    with _counters_lock:
+        return {name: dict(values) for name, values in _counters.items()}
+
+
+def log_stats():
+    """Logs the counters of the calls that needed retries."""
+    for name, values in sorted(stats().items()):
+        if values["retries"] or values["giveups"]:
+            logging.info(f"🔁 {name}: {values['calls']} calls, {values['retries']} retries, {values['giveups']} giveups")
+
+
+def status_of(error):
+    """Returns the HTTP status of a Gmail or OpenAI error, or None."""
+    # googleapiclient HttpError
+    status = getattr(getattr(error, "resp", None), "status", None)
+    if status is None:
+        # openai.APIStatusError, requests and httpx errors
+        status = getattr(error, "status_code", None)
+        response = getattr(error, "response", None)
+        if status is None and response is not None:
+            status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    try:
+        return int(status) if status is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """
+    Decides whether an error is transient.
+
+    Rate limits, server errors, timeouts and dropped connections are retried;
+    anything else (bad requests, auth failures, missing objects) is not.
+    """
+    if isinstance(error, TransientError):
+        return True
+    status = status_of(error)
+    if status is not None:
+        if status in RETRYABLE_STATUSES:
+            return True
+        if status == 403:
+            content = getattr(error, "content", b"") or b""
+            text = content.decode(errors="replace") if isinstance(content, bytes) else str(content)
+            return any(reason in text for reason in RATE_LIMIT_REASONS)
+        return False
+    if isinstance(error, TRANSIENT_EXCEPTIONS):
+        return True
+    # Client libraries wrap network errors in their own types
+    names = {cls.__name__ for cls in type(error).__mro__}
+    return bool(names & {
+        "APIConnectionError", "APITimeoutError", "TransportError", "ServerNotFoundError",
+        "RequestException", "SSLError", "IncompleteRead", "RemoteDisconnected",
+    }) and "InvalidURL" not in names
+
+
+def backoff_delay(attempt, base=RETRY_BASE_SECONDS, ceiling=RETRY_MAX_SECONDS):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)."""
+    return random.uniform(0, min(ceiling, base * 2 ** attempt))
+
+
+def call(fn, *args, name=None, attempts=RETRY_MAX_ATTEMPTS, deadline=RETRY_DEADLINE_SECONDS,
+         retry_if=is_retryable, before_retry=None, **kwargs):
+    """
+    Calls fn(*args, **kwargs), retrying transient failures.
+
+    Args:
+        fn: Function to call
+        name: Name the counters are kept under (defaults to the function's name)
+        attempts: Attempts including the first one
+        deadline: Seconds after which no further attempt is started
+        retry_if: Decides whether an exception is worth retrying
+        before_retry: Called before each retry; if it returns something other
+            than None, that is returned instead of calling fn again. Sends use
+            it to check whether an attempt that failed actually went through.
+
+    Returns:
+        Whatever fn returns
+
+    Raises:
+        The last exception once the attempts or the deadline run out, or
+        straight away if it is not retryable
+    """
+    name = name or getattr(fn, "__name__", "call")
+    _count(name, "calls")
+    start = time.monotonic()
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not retry_if(e):
+                raise
+            delay = backoff_delay(attempt)
+            out_of_time = time.monotonic() - start + delay > deadline
+            if attempt == attempts - 1 or out_of_time:
+                _count(name, "giveups")
+                logging.error(f"❌ {name} failed after {attempt + 1} attempts: {e}")
+                raise
+            _count(name, "retries")
+            logging.warning(f"⏳ {name} failed ({status_of(e) or type(e).__name__}), retry {attempt + 1} in {delay:.1f}s")
+            time.sleep(delay)
+            if before_retry is not None:
+                result = before_retry()
+                if result is not None:
+                    return result
+
+
+# Request methods that can be repeated without side effects
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "DELETE"}
+
+# httpx errors raised before a request reached the server
+NOT_SENT_ERRORS = {"ConnectError", "ConnectTimeout", "PoolTimeout"}
+
+
+class RetryableResponse(TransientError):
+    """An HTTP response whose status is worth retrying."""
+
+    def __init__(self, response):
+        super().__init__(f"HTTP {response.status_code}")
+        self.response = response
+        self.status_code = response.status_code
+
+
+def is_retryable_request(request, error):
+    """
+    Decides whether an HTTP request may be sent again after error.
+
+    Idempotent methods are retried on any transient error. A POST could have
+    been carried out even though its response never arrived, so it is only
+    retried when the server certainly did not act on it: a 429, or a failure
+    to connect. Callers that can check whether a POST went through retry it
+    themselves (see call()'s before_retry).
+    """
+    if request.method in IDEMPOTENT_METHODS:
+        return is_retryable(error)
+    if status_of(error) == 429:
+        return True
+    return bool({cls.__name__ for cls in type(error).__mro__} & NOT_SENT_ERRORS)
+
+
+class RetryTransport:
+    """
+    httpx transport applying the retry policy to every request of a client.
+
+    Args:
+        transport: The httpx transport that sends the requests
+        name: Name the counters are kept under
+        attempts: Attempts per request, including the first one
+        before_attempt: Called with the request before every attempt
+        after_attempt: Called with the response after every attempt
+    """
+
+    def __init__(self, transport, name="http", attempts=RETRY_MAX_ATTEMPTS, before_attempt=None, after_attempt=None):
+        self.transport = transport
+        self.name = name
+        self.attempts = attempts
+        self.before_attempt = before_attempt
+        self.after_attempt = after_attempt
+
+    def handle_request(self, request):
+        def attempt():
+            if self.before_attempt is not None:
+                self.before_attempt(request)
+            response = self.transport.handle_request(request)
+            if self.after_attempt is not None:
+                self.after_attempt(response)
+            if response.status_code in RETRYABLE_STATUSES:
+                response.read()
+                response.close()
+                raise RetryableResponse(response)
+            return response
+
+        try:
+            return call(attempt, name=self.name, attempts=self.attempts,
+                        retry_if=lambda error: is_retryable_request(request, error))
+        except RetryableResponse as e:
+            # Out of attempts: hand the last response back so the client raises its own error for it
+            return e.response
+
+    def close(self):
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def retrying(name=None, **options):
+    """Decorator form of call()."""
+    def decorate(fn):
+        def wrapper(*args, **kwargs):
+            return call(fn, *args, name=name or fn.__name__, **options, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorate
@@ -0,0 +1,225 @@
+import os
+import math
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+
+
+def parse_plan_weights(text):
+    """
+    Parses "tier:weight,..." into a dict of positive weights.
+
+    Raises:
+        ValueError: If a weight is zero or negative, which would never earn a turn
+    """
+    weights = {}
+    for pair in text.split(","):
+        if not pair:
+            continue
+        tier, weight = pair.split(":")
+        weights[tier] = float(weight)
+        if weights[tier] <= 0:
+            raise ValueError(f"Plan weight of {tier} must be positive, got {weight}")
+    return weights
+
+
+# Plan tier -> share of the workers a sender gets relative to the others, "tier:weight,..."
+PLAN_WEIGHTS = parse_plan_weights(os.getenv("PLAN_WEIGHTS", "standard:1,pro:2"))
+
+# Plan tiers served before every other tier whenever they have a deal waiting
+PRIORITY_TIERS = {tier for tier in os.getenv("PRIORITY_TIERS", "priority").split(",") if tier}
+
+# Deficit credited to a sender of weight 1 on each round robin pass
+SCHEDULER_QUANTUM = float(os.getenv("SCHEDULER_QUANTUM", "1"))
+
+# Wait and service times kept per sender for the metrics
+METRICS_WINDOW = int(os.getenv("SCHEDULER_METRICS_WINDOW", "1000"))
+
+
+def percentile(values, fraction):
+    """Returns the given percentile (0 to 1) of a list of numbers, interpolating linearly."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * fraction
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class Ticket:
+    """A deal handed out by the scheduler; pass it back to done() when finished."""
+
+    def __init__(self, sender, item, cost, enqueued_at):
+        self.sender = sender
+        self.item = item
+        self.cost = cost
+        self.enqueued_at = enqueued_at
+        self.started_at = None
+
+
+class DealScheduler:
+    """
+    Fair scheduler for deals across senders.
+
+    Each sender has their own queue. Deals are handed out with deficit round
+    robin: every pass credits a sender SCHEDULER_QUANTUM times the weight of
+    their plan tier, and a deal is served once the sender's credit covers its
+    cost. Senders in PRIORITY_TIERS are served first, and a sender never has
+    more deals running than their concurrency quota. A broker who sends 40
+    deals therefore takes turns with everyone else instead of going first.
+
+    Queue wait and service time are recorded per sender (see metrics()).
+    """
+
+    def __init__(self, registry=None, quantum=SCHEDULER_QUANTUM, max_pending=None):
+        if quantum <= 0:
+            raise ValueError(f"Scheduler quantum must be positive, got {quantum}")
+        self.registry = registry
+        self.quantum = quantum
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.queues = defaultdict(deque)   # sender -> deque of Ticket
+        self.active = deque()              # senders with waiting deals, in round robin order
+        self.deficit = defaultdict(float)
+        self.running = defaultdict(int)
+        self.pending = 0
+        self.closed = False
+        self.wait_times = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+        self.service_times = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+
+    def _attributes(self, sender):
+        user = self.registry.get(sender) if self.registry is not None else None
+        return user or {}
+
+    def weight(self, sender):
+        return PLAN_WEIGHTS.get(self._attributes(sender).get("plan_tier"), 1.0)
+
+    def concurrency_cap(self, sender):
+        return max(1, int(self._attributes(sender).get("concurrency_quota") or 1))
+
+    def is_priority(self, sender):
+        return self._attributes(sender).get("plan_tier") in PRIORITY_TIERS
+
+    def put(self, sender, item, cost=1.0):
+        """Queues a deal for a sender; blocks while max_pending deals are already waiting."""
+        with self.condition:
+            while self.max_pending and self.pending >= self.max_pending and not self.closed:
+                self.condition.wait()
+            self.queues[sender].append(Ticket(sender, item, cost, time.monotonic()))
+            if sender not in self.active:
+                self.active.append(sender)
+            self.pending += 1
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Returns the next Ticket to run, waiting for one if needed.
+
+        Returns:
+            Ticket or None: None once the scheduler is closed and drained, or on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                ticket = self._pick()
+                if ticket is not None:
+                    ticket.started_at = time.monotonic()
+                    self.wait_times[ticket.sender].append(ticket.started_at - ticket.enqueued_at)
+                    self.condition.notify_all()
+                    return ticket
+                if self.closed and not self.pending:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def done(self, ticket):
+        """Records that a ticket finished, freeing its sender's concurrency slot."""
+        with self.condition:
+            self.running[ticket.sender] -= 1
+            self.service_times[ticket.sender].append(time.monotonic() - ticket.started_at)
+            self.condition.notify_all()
+
+    def close(self):
+        """Marks the end of new deals; get() returns None once everything queued has been handed out."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _pick(self):
+        eligible = [sender for sender in self.active if self.running[sender] < self.concurrency_cap(sender)]
+        if not eligible:
+            return None
+        if any(self.is_priority(sender) for sender in eligible):
+            eligible = [sender for sender in eligible if self.is_priority(sender)]
+        eligible = set(eligible)
+
+        # Every eligible sender gains credit each pass, so this ends within a bounded number of passes
+        for _ in range(len(self.active) * (int(self._max_passes(eligible)) + 1)):
+            sender = self.active[0]
+            if sender not in eligible:
+                # A sender skipped at its cap earns nothing and keeps at most one turn's credit
+                self.deficit[sender] = min(self.deficit[sender], self.quantum * self.weight(sender))
+                self.active.rotate(-1)
+                continue
+            ticket = self.queues[sender][0]
+            credit = self.quantum * self.weight(sender)
+            if self.deficit[sender] < ticket.cost:
+                # Credit is earned once per turn at the head of the round robin
+                self.deficit[sender] += credit
+                if self.deficit[sender] < ticket.cost:
+                    self.active.rotate(-1)
+                    continue
+
+            self.deficit[sender] -= ticket.cost
+            self.queues[sender].popleft()
+            self.pending -= 1
+            self.running[sender] += 1
+            if not self.queues[sender]:
+                # Idle senders do not bank credit
+                self.active.popleft()
+                del self.queues[sender]
+                self.deficit[sender] = 0.0
+            elif self.deficit[sender] < self.queues[sender][0].cost:
+                self.active.rotate(-1)
+            # Otherwise the turn goes on: the sender stays at the head for the next get()
+            return ticket
+        return None
+
+    def _max_passes(self, eligible):
+        passes = 1.0
+        for sender in eligible:
+            credit = self.quantum * self.weight(sender)
+            passes = max(passes, math.ceil(self.queues[sender][0].cost / credit))
+        return passes
+
+    def metrics(self):
+        """
+        Queue wait and service time per sender over the last METRICS_WINDOW deals.
+
+        Returns:
+            dict: sender -> {"deals", "wait_p50", "wait_p95", "service_p50", "service_p95"} in seconds
+        """
+        with self.condition:
+            return {
+                sender: {
+                    "deals": len(self.wait_times[sender]),
+                    "wait_p50": percentile(list(self.wait_times[sender]), 0.5),
+                    "wait_p95": percentile(list(self.wait_times[sender]), 0.95),
+                    "service_p50": percentile(list(self.service_times[sender]), 0.5),
+                    "service_p95": percentile(list(self.service_times[sender]), 0.95),
+                }
+                for sender in list(self.wait_times)
+            }
+
+    def log_metrics(self):
+        """Logs the per-sender metrics, slowest p95 wait first."""
+        metrics = self.metrics()
+        for sender, values in sorted(metrics.items(), key=lambda item: -(item[1]["wait_p95"] or 0)):
+            line = f"📊 {sender}: {values['deals']} deals, wait p50 {values['wait_p50']:.1f}s p95 {values['wait_p95']:.1f}s"
+            if values["service_p95"] is not None:
+                line += f", service p50 {values['service_p50']:.1f}s p95 {values['service_p95']:.1f}s"
+            logging.info(line)
@@ -0,0 +1,39 @@
+import os
+import sqlite3
+from contextlib import contextmanager
+from config import BASE_DIR
+
+# Local SQLite database holding state that must survive between runs
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(BASE_DIR, "state", "dealosophy.sqlite3"))
+
+
+def connect(db_path=STATE_DB_PATH):
+    """
+    Open a connection to the state database.
+
+    The connection is in autocommit mode; callers that need several statements
+    to apply together open a transaction with "BEGIN IMMEDIATE". WAL mode lets
+    readers carry on while another thread or process writes.
+
+    Args:
+        db_path: Path to the SQLite file (created if missing)
+
+    Returns:
+        sqlite3.Connection
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+@contextmanager
+def connection(db_path=STATE_DB_PATH):
+    """Context manager yielding a state database connection that is closed afterwards."""
+    conn = connect(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
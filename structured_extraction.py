@@ -0,0 +1,232 @@
+import os
+import io
+import json
+import time
+import base64
+from prompts import (
+    STRUCTURED_EXTRACTION_PROMPT, COMPANY_INFO_PROMPT, INCOME_STATEMENT_PROMPT,
+    BALANCE_SHEET_PROMPT, ADJUSTMENTS_PROMPT, SUMMARY_PROMPT
+)
+
+# Structured outputs need a model that supports json_schema response formats
+STRUCTURED_MODEL = os.getenv("STRUCTURED_MODEL", "gpt-4o")
+
+# Attachment types that can be passed to the model in a single call
+SUPPORTED_FORMATS = (".pdf", ".csv", ".txt", ".xlsx")
+
+# Company info schema field -> key used in company_info.json
+COMPANY_INFO_FIELDS = {
+    "name": ("Name", "string"),
+    "asking_price": ("Asking price", "number"),
+    "years_in_business": ("Years in business", "number"),
+    "owners": ("Owner(s)", "string"),
+    "number_of_employees": ("Number of employees", "number"),
+    "employees": ("Employees", "string"),
+    "business_info": ("Business info", "string"),
+    "industry": ("Industry", "string"),
+    "address": ("Address", "string"),
+    "facilities_ownership_type": ("Facilities ownership type", "string"),
+    "lease_per_month_rent": ("Lease per month rent", "number"),
+    "lease_expiry_and_renewal_status": ("Lease expiry and renewal status", "string"),
+    "location_size_in_square_feet": ("Location size in Square feet", "number"),
+    "brokerage_firm": ("Brokerage firm", "string"),
+    "broker_agent": ("Broker Agent", "string"),
+    "broker_phone": ("Broker phone", "string"),
+    "broker_email": ("Broker email", "string"),
+}
+
+# Summary schema field -> key used in summary.json
+SUMMARY_FIELDS = {
+    "revenue": "Revenue",
+    "cogs": "COGS",
+    "gross_margin": "Gross Margin",
+    "operating_expenses": "Operating Expenses",
+    "ebit": "EBIT",
+    "interest_paid": "Interest Paid",
+    "taxes": "Taxes",
+    "net_income": "Net Income",
+    "sde": "SDE",
+    "number_of_employees": "Number of Employees",
+    "cash": "Cash",
+    "accounts_receivable": "Accounts Receivable",
+    "inventory": "Inventory",
+    "current_assets": "Current Assets",
+    "total_assets": "Total Assets",
+    "accounts_payable": "Accounts Payable",
+    "current_liabilities": "Current Liabilities",
+    "total_liabilities": "Total Liabilities",
+    "total_shareholders_equity": "Total Shareholders' Equity",
+}
+
+# Financial table sections: schema field, JSON file, prompt, label used when not found
+STATEMENT_SECTIONS = [
+    ("income_statement", "income_statement.json", INCOME_STATEMENT_PROMPT, "Income Statement"),
+    ("balance_sheet", "balance_sheet.json", BALANCE_SHEET_PROMPT, "Balance Sheet"),
+    ("adjustments", "adjustments.json", ADJUSTMENTS_PROMPT, "Adjustments"),
+]
+
+CELL = {"anyOf": [{"type": "number"}, {"type": "string"}]}
+
+
+def _object(properties):
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+STATEMENT_SCHEMA = _object({
+    "found": {"type": "boolean"},
+    "years": {"type": "array", "items": CELL},
+    "line_items": {
+        "type": "array",
+        "items": _object({
+            "name": {"type": "string"},
+            "values": {"type": "array", "items": CELL},
+        }),
+    },
+})
+
+DEAL_SCHEMA = _object({
+    "company_info": _object({
+        field: {"type": [kind, "null"]} for field, (_, kind) in COMPANY_INFO_FIELDS.items()
+    }),
+    **{field: STATEMENT_SCHEMA for field, _, _, _ in STATEMENT_SECTIONS},
+    "summary": _object({
+        "years": {"type": "array", "items": CELL},
+        **{field: {"type": "array", "items": CELL} for field in SUMMARY_FIELDS},
+    }),
+})
+
+
+def is_supported(file_paths):
+    """Returns True if every attachment can be sent to the model in a single call."""
+    return all(path.lower().endswith(SUPPORTED_FORMATS) for path in file_paths)
+
+
+def _file_content(path):
+    """Converts an attachment into chat message content parts."""
+    name = os.path.basename(path)
+    lower = name.lower()
+
+    if lower.endswith(".pdf"):
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode()
+        return [{"type": "file", "file": {"filename": name, "file_data": f"data:application/pdf;base64,{data}"}}]
+
+    if lower.endswith(".xlsx"):
+        import pandas as pd
+        parts = []
+        for sheet_name, df in pd.read_excel(path, sheet_name=None, header=None).items():
+            buffer = io.StringIO()
+            df.to_csv(buffer, index=False, header=False)
+            parts.append({"type": "text", "text": f"File {name}, sheet {sheet_name}:\n{buffer.getvalue()}"})
+        return parts
+
+    with open(path, "r", errors="replace") as f:
+        return [{"type": "text", "text": f"File {name}:\n{f.read()}"}]
+
+
+def build_prompt():
+    """Combines the per-section prompts into the instructions of the single call."""
+    sections = [
+        ("company_info", COMPANY_INFO_PROMPT),
+        *[(field, prompt) for field, _, prompt, _ in STATEMENT_SECTIONS],
+        ("summary", SUMMARY_PROMPT),
+    ]
+    return STRUCTURED_EXTRACTION_PROMPT + "".join(
+        f"\n### Section \"{field}\"\n{prompt}" for field, prompt in sections
+    )
+
+
+def split_result(result):
+    """
+    Converts the structured reply into the contents of the usual json_files/*.json files.
+
+    Args:
+        result: Parsed reply following DEAL_SCHEMA
+
+    Returns:
+        dict: filename -> JSON data, laid out exactly as the per-prompt extraction writes it
+    """
+    files = {
+        "company_info.json": {
+            key: result["company_info"].get(field) for field, (key, _) in COMPANY_INFO_FIELDS.items()
+        }
+    }
+
+    for field, filename, _, label in STATEMENT_SECTIONS:
+        statement = result[field]
+        if not statement["found"] or not statement["line_items"]:
+            files[filename] = {"Not Found": label}
+            continue
+        num_years = len(statement["years"])
+        data = {"Years": statement["years"]}
+        for item in statement["line_items"]:
+            # Pad or trim every row to the number of years, as the prompts ask
+            data[item["name"]] = (item["values"] + [""] * num_years)[:num_years]
+        files[filename] = data
+
+    summary = result["summary"]
+    num_years = len(summary["years"])
+    files["summary.json"] = {"Years": summary["years"]}
+    for field, key in SUMMARY_FIELDS.items():
+        files["summary.json"][key] = (summary[field] + [""] * num_years)[:num_years]
+
+    return files
+
+
+def extract_all(client, file_paths, json_folder, filenames=None, model=STRUCTURED_MODEL):
+    """
+    Extracts every section of a deal with one structured-output call.
+
+    Args:
+        client: OpenAI client
+        file_paths: Attachments to read
+        json_folder: Folder the JSON files are written to
+        filenames: Only write these JSON files (all of them when None)
+        model: Model to call
+
+    Returns:
+        dict: filename -> JSON data written
+    """
+    content = [{"type": "text", "text": build_prompt()}]
+    for path in file_paths:
+        content.extend(_file_content(path))
+
+    start = time.monotonic()
+    response = client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": "You are great at extracting data from files and and a master CFO."},
+            {"role": "user", "content": content},
+        ],
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "deal_extraction", "strict": True, "schema": DEAL_SCHEMA},
+        },
+    )
+    elapsed = time.monotonic() - start
+
+    usage = response.usage
+    print(f"📏 Structured extraction with {model}: {elapsed:.2f}s, "
+          f"{usage.prompt_tokens} prompt tokens, {usage.completion_tokens} completion tokens")
+
+    message = response.choices[0].message
+    if getattr(message, "refusal", None):
+        print(f"❌ Model refused the extraction: {message.refusal}")
+        return {}
+
+    files = split_result(json.loads(message.content))
+    os.makedirs(json_folder, exist_ok=True)
+    written = {}
+    for filename, data in files.items():
+        if filenames is not None and filename not in filenames:
+            continue
+        with open(os.path.join(json_folder, filename), "w") as f:
+            json.dump(data, f, indent=4)
+        print(f"{os.path.join(json_folder, filename)} saved successfully.")
+        written[filename] = data
+    return written
@@ -0,0 +1,91 @@
+import os
+import time
+import state_db
+
+# Attempts to find a free folder when numbers were taken outside the allocator
+MAX_ALLOCATION_ATTEMPTS = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS submission_counters (
+    user_folder TEXT PRIMARY KEY,
+    last_number INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+def _existing_max(user_folder):
+    """Highest numbered submission folder on disk; only read once per user to seed the counter."""
+    try:
+        return max((int(name) for name in os.listdir(user_folder) if name.isdigit()), default=0)
+    except FileNotFoundError:
+        return 0
+
+
+def _counter(conn, user_folder):
+    row = conn.execute(
+        "SELECT last_number FROM submission_counters WHERE user_folder = ?", (user_folder,)
+    ).fetchone()
+    return row["last_number"] if row else None
+
+
+def latest_submission(user_folder, db_path=state_db.STATE_DB_PATH):
+    """
+    Returns the number of the user's latest submission, 0 if there is none.
+
+    Args:
+        user_folder: The users/<email> folder
+        db_path: State database holding the counters
+    """
+    user_folder = os.path.abspath(user_folder)
+    with state_db.connection(db_path) as conn:
+        conn.executescript(SCHEMA)
+        number = _counter(conn, user_folder)
+    return _existing_max(user_folder) if number is None else number
+
+
+def allocate_submission(user_folder, db_path=state_db.STATE_DB_PATH):
+    """
+    Reserves the next users/<email>/<n> folder and creates it.
+
+    The number comes from a per-user counter incremented inside a SQLite
+    write transaction, so threads and processes never get the same one, and
+    the folder is created with mkdir, which fails if it already exists. If a
+    folder was made outside the allocator, the next number is tried.
+
+    Args:
+        user_folder: The users/<email> folder
+        db_path: State database holding the counters
+
+    Returns:
+        tuple: (submission number, path of the new folder)
+    """
+    user_folder = os.path.abspath(user_folder)
+    os.makedirs(user_folder, exist_ok=True)
+    with state_db.connection(db_path) as conn:
+        conn.executescript(SCHEMA)
+        for _ in range(MAX_ALLOCATION_ATTEMPTS):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                number = _counter(conn, user_folder)
+                if number is None:
+                    number = _existing_max(user_folder)
+                number += 1
+                conn.execute(
+                    "INSERT INTO submission_counters (user_folder, last_number, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_folder) DO UPDATE SET last_number = excluded.last_number, "
+                    "updated_at = excluded.updated_at",
+                    (user_folder, number, time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            folder = os.path.join(user_folder, str(number))
+            try:
+                os.mkdir(folder)
+            except FileExistsError:
+                continue
+            return number, folder
+    raise RuntimeError(f"Could not allocate a submission folder in {user_folder}")
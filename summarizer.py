@@ -0,0 +1,296 @@
+import os
+import re
+import json
+import difflib
+import logging
+import numpy as np
+
+# Below this confidence the summary is left to the LLM SUMMARY_PROMPT
+SUMMARY_CONFIDENCE_THRESHOLD = float(os.getenv("SUMMARY_CONFIDENCE_THRESHOLD", "0.75"))
+
+# Fuzzy matches scoring below this ratio are ignored
+FUZZY_CUTOFF = 0.85
+
+# Summary keys in the order SUMMARY_PROMPT lays them out
+SUMMARY_KEYS = [
+    "Revenue", "COGS", "Gross Margin", "Operating Expenses", "EBIT", "Interest Paid", "Taxes",
+    "Net Income", "SDE", "Number of Employees", "Cash", "Accounts Receivable", "Inventory",
+    "Current Assets", "Total Assets", "Accounts Payable", "Current Liabilities",
+    "Total Liabilities", "Total Shareholders' Equity",
+]
+
+# Summary key -> (statement files to search in order, line item names seen in broker packages)
+SYNONYMS = {
+    "Revenue": (("income_statement.json",), [
+        "revenue", "revenues", "total revenue", "total revenues", "sales", "net sales", "total sales",
+        "gross sales", "sales revenue", "net revenue", "net revenues", "total net revenue",
+    ]),
+    "COGS": (("income_statement.json",), [
+        "cogs", "cost of goods sold", "total cost of goods sold", "cost of sales", "total cost of sales",
+        "cost of revenue", "cost of revenues", "direct costs", "total direct costs", "cost of goods",
+    ]),
+    "Gross Margin": (("income_statement.json",), [
+        "gross margin", "gross profit", "total gross profit", "gross income",
+    ]),
+    "Operating Expenses": (("income_statement.json",), [
+        "operating expenses", "total operating expenses", "expenses", "total expenses", "overhead",
+        "total overhead", "overhead expenses", "general and administrative expenses",
+        "selling general and administrative expenses", "total general and administrative expenses",
+    ]),
+    "EBIT": (("income_statement.json",), [
+        "ebit", "operating income", "income from operations", "operating profit",
+        "earnings before interest and taxes", "net operating income",
+    ]),
+    "Interest Paid": (("income_statement.json",), [
+        "interest", "interest expense", "interest paid", "bank interest", "interest on long term debt",
+        "interest and bank charges",
+    ]),
+    "Taxes": (("income_statement.json",), [
+        "taxes", "income taxes", "income tax", "income tax expense", "provision for income taxes",
+        "current income taxes",
+    ]),
+    "Net Income": (("income_statement.json",), [
+        "net income", "net profit", "net earnings", "net income loss", "net income after taxes",
+        "net profit after tax", "net loss",
+    ]),
+    "SDE": (("adjustments.json", "income_statement.json"), [
+        "sde", "sellers discretionary earnings", "seller discretionary earnings",
+        "sellers discretionary earnings sde", "total sde", "adjusted sde",
+    ]),
+    "Cash": (("balance_sheet.json",), [
+        "cash", "cash and cash equivalents", "cash in bank", "cash and equivalents", "bank",
+    ]),
+    "Accounts Receivable": (("balance_sheet.json",), [
+        "accounts receivable", "trade receivables", "receivables", "trade accounts receivable",
+        "accounts receivable net",
+    ]),
+    "Inventory": (("balance_sheet.json",), [
+        "inventory", "inventories", "total inventory",
+    ]),
+    "Current Assets": (("balance_sheet.json",), [
+        "current assets", "total current assets",
+    ]),
+    "Total Assets": (("balance_sheet.json",), [
+        "total assets", "assets total",
+    ]),
+    "Accounts Payable": (("balance_sheet.json",), [
+        "accounts payable", "accounts payable and accrued liabilities", "trade payables",
+        "trade accounts payable", "accounts payable and accrued charges",
+    ]),
+    "Current Liabilities": (("balance_sheet.json",), [
+        "current liabilities", "total current liabilities",
+    ]),
+    "Total Liabilities": (("balance_sheet.json",), [
+        "total liabilities", "liabilities total",
+    ]),
+    "Total Shareholders' Equity": (("balance_sheet.json",), [
+        "total shareholders equity", "shareholders equity", "total equity", "equity",
+        "total stockholders equity", "stockholders equity", "owners equity", "total owners equity",
+        "shareholders deficiency", "total shareholders deficiency",
+    ]),
+}
+
+# Keys whose absence makes the summary unreliable, used for the confidence score
+CORE_KEYS = [
+    "Revenue", "Gross Margin", "Operating Expenses", "EBIT", "Net Income",
+    "Current Assets", "Total Assets", "Current Liabilities", "Total Liabilities",
+    "Total Shareholders' Equity",
+]
+
+
+def normalize_label(label):
+    """Lowercases a line item name and strips punctuation and extra spaces."""
+    label = re.sub(r"[^a-z0-9 ]+", " ", label.lower().replace("'", ""))
+    return re.sub(r"\s+", " ", label).strip()
+
+
+def to_number(value):
+    """Converts a statement cell to float, NaN when blank or not a number."""
+    if isinstance(value, bool):
+        return np.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        text = value.strip().replace(",", "").replace("$", "")
+        negative = text.startswith("(") and text.endswith(")")
+        text = text.strip("()")
+        try:
+            number = float(text)
+        except ValueError:
+            return np.nan
+        return -number if negative else number
+    return np.nan
+
+
+def statement_rows(statement):
+    """
+    Turns an extracted statement into rows with their indentation level and values.
+
+    Category headings have no numbers of their own; their values are the sum of
+    the rows directly underneath them (one level deeper).
+
+    Args:
+        statement: Parsed income_statement.json / balance_sheet.json data
+
+    Returns:
+        tuple: (years, list of (label, values array, computed flag))
+    """
+    years = statement.get("Years", [])
+    raw_rows = []
+    for label, values in statement.items():
+        if label == "Years" or not isinstance(values, list) or re.fullmatch(r"Gap\d*", label.strip()):
+            continue
+        level = (len(label) - len(label.lstrip(" "))) // 3
+        numbers = np.array([to_number(v) for v in (values + [""] * len(years))[:len(years)]], dtype=float)
+        raw_rows.append((label.strip(), level, numbers))
+
+    rows = []
+    for index, (label, level, numbers) in enumerate(raw_rows):
+        computed = False
+        if np.isnan(numbers).all():
+            children = []
+            for child_label, child_level, child_numbers in raw_rows[index + 1:]:
+                if child_level <= level:
+                    break
+                if child_level == level + 1:
+                    children.append(child_numbers)
+            if children:
+                stacked = np.vstack(children)
+                numbers = np.where(np.isnan(stacked).all(axis=0), np.nan, np.nansum(stacked, axis=0))
+                computed = True
+        rows.append((label, numbers, computed))
+    return years, rows
+
+
+def match_score(label, synonyms):
+    """Scores how well a line item name matches a summary key's synonyms (0 to 1)."""
+    normalized = normalize_label(label)
+    if not normalized:
+        return 0.0
+    if normalized in synonyms:
+        return 1.0
+    best = max(difflib.SequenceMatcher(None, normalized, synonym).ratio() for synonym in synonyms)
+    return best if best >= FUZZY_CUTOFF else 0.0
+
+
+def align(values, source_years, years):
+    """Reorders a row's values from its statement's years onto the summary years."""
+    positions = {str(year).strip(): i for i, year in enumerate(source_years)}
+    return np.array([values[positions[str(year).strip()]] if str(year).strip() in positions else np.nan
+                     for year in years], dtype=float)
+
+
+def derive_totals(summary):
+    """Fills summary totals that can be computed from the others, in place."""
+    def fill(key, computed):
+        summary[key] = np.where(np.isnan(summary[key]), computed, summary[key])
+
+    # Repeat so totals derived in one pass can feed the next
+    for _ in range(2):
+        fill("Gross Margin", summary["Revenue"] - summary["COGS"])
+        fill("COGS", summary["Revenue"] - summary["Gross Margin"])
+        fill("Operating Expenses", summary["Gross Margin"] - summary["EBIT"])
+        fill("EBIT", summary["Gross Margin"] - summary["Operating Expenses"])
+        fill("Net Income", summary["EBIT"] - summary["Interest Paid"] - summary["Taxes"])
+        fill("Current Assets", summary["Cash"] + summary["Accounts Receivable"] + summary["Inventory"])
+        fill("Total Assets", summary["Total Liabilities"] + summary["Total Shareholders' Equity"])
+        fill("Total Liabilities", summary["Total Assets"] - summary["Total Shareholders' Equity"])
+        fill("Total Shareholders' Equity", summary["Total Assets"] - summary["Total Liabilities"])
+
+
+def summarize(json_folder):
+    """
+    Builds summary data from the statements already extracted into json_folder.
+
+    Args:
+        json_folder: Folder containing income_statement.json, balance_sheet.json, etc.
+
+    Returns:
+        tuple: (summary dict in the summary.json layout, confidence between 0 and 1)
+    """
+    statements = {}
+    for filename in ("income_statement.json", "balance_sheet.json", "adjustments.json", "company_info.json"):
+        path = os.path.join(json_folder, filename)
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            continue
+        if isinstance(data, dict) and "Not Found" not in data:
+            statements[filename] = data
+
+    parsed = {filename: statement_rows(data) for filename, data in statements.items()
+              if filename != "company_info.json" and data.get("Years")}
+    if not parsed:
+        return None, 0.0
+
+    years = (parsed.get("income_statement.json") or parsed.get("balance_sheet.json") or next(iter(parsed.values())))[0]
+    summary = {key: np.full(len(years), np.nan) for key in SUMMARY_KEYS}
+    scores = {}
+
+    for key, (sources, synonyms) in SYNONYMS.items():
+        for filename in sources:
+            if filename not in parsed:
+                continue
+            source_years, rows = parsed[filename]
+            best = None
+            for label, values, computed in rows:
+                score = match_score(label, synonyms)
+                if computed:
+                    # Prefer reported totals over totals added up from their sub-items
+                    score *= 0.95
+                if score and (best is None or score > best[0]) and not np.isnan(values).all():
+                    best = (score, values)
+            if best:
+                scores[key] = best[0]
+                summary[key] = align(best[1], source_years, years)
+                break
+
+    company_info = statements.get("company_info.json", {})
+    employees = to_number(company_info.get("Number of employees"))
+    if not np.isnan(employees) and len(years):
+        # The headcount is reported once, for the latest year
+        latest = max(range(len(years)), key=lambda i: str(years[i]))
+        summary["Number of Employees"][latest] = employees
+
+    derive_totals(summary)
+
+    # Core keys matched directly score their match, derived ones half, missing ones nothing
+    confidence = float(np.mean([
+        scores.get(key, 0.5 if not np.isnan(summary[key]).all() else 0.0) for key in CORE_KEYS
+    ]))
+
+    result = {"Years": years}
+    for key in SUMMARY_KEYS:
+        result[key] = [
+            "" if np.isnan(value) else (int(value) if float(value).is_integer() else round(float(value), 2))
+            for value in summary[key]
+        ]
+    return result, confidence
+
+
+def write_summary(json_folder, threshold=SUMMARY_CONFIDENCE_THRESHOLD):
+    """
+    Writes summary.json computed locally when the mapping is confident enough.
+
+    Args:
+        json_folder: Folder containing the extracted statements
+        threshold: Minimum confidence needed to write the file
+
+    Returns:
+        bool: True if summary.json was written
+    """
+    try:
+        summary, confidence = summarize(json_folder)
+    except Exception as e:
+        logging.error(f"❌ Local summary failed: {e}")
+        return False
+
+    if summary is None or confidence < threshold:
+        print(f"⚠️ Local summary confidence {confidence:.2f} is below {threshold:.2f}")
+        return False
+
+    with open(os.path.join(json_folder, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=4)
+    print(f"✅ summary.json computed locally (confidence {confidence:.2f})")
+    return True
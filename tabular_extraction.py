@@ -0,0 +1,228 @@
+import os
+import re
+import csv
+import json
+import logging
+
+# Spreadsheet formats parsed locally instead of being sent to the model
+TABULAR_FORMATS = (".xlsx", ".csv")
+
+# How far down a sheet to look for the row of years
+HEADER_SCAN_ROWS = 20
+
+# A calendar year, or a fiscal year label such as FY22 or FY 2023
+YEAR_PATTERN = re.compile(r"(?<!\d)(19[5-9]\d|20\d\d)(?!\d)|\bFY\s?'?(\d{4}|\d{2})\b", re.IGNORECASE)
+
+# Statement JSON file -> words that show up in its line items
+KEYWORDS = {
+    "income_statement.json": [
+        "revenue", "sales", "cost of sales", "cost of goods", "cogs", "gross profit", "gross margin",
+        "expenses", "wages", "salaries", "rent", "utilities", "advertising", "depreciation",
+        "net income", "net profit", "operating income", "ebitda", "income taxes", "interest",
+    ],
+    "balance_sheet.json": [
+        "assets", "liabilities", "equity", "receivable", "payable", "inventory", "cash",
+        "retained earnings", "current", "prepaid", "accrued", "share capital", "long-term debt",
+        "property", "equipment",
+    ],
+    "adjustments.json": [
+        "addback", "add back", "add-back", "adjustment", "normalization", "normalized", "sde",
+        "discretionary", "owner", "one-time", "non-recurring", "personal",
+    ],
+}
+
+# A sheet is classified when its best score reaches this and clearly beats the runner-up
+MIN_SCORE = 3
+MIN_MARGIN = 1.5
+
+
+def _cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+
+def _to_value(value):
+    """Converts a cell to the number format the prompts produce, "" when blank."""
+    if value is None or isinstance(value, bool):
+        return ""
+    if isinstance(value, (int, float)):
+        return int(value) if float(value).is_integer() else value
+    text = str(value).strip().replace(",", "").replace("$", "")
+    if not text or text in ("-", "—"):
+        return ""
+    negative = text.startswith("(") and text.endswith(")")
+    text = text.strip("()")
+    try:
+        number = float(text)
+    except ValueError:
+        return ""
+    number = -number if negative else number
+    return int(number) if number.is_integer() else number
+
+
+def read_sheets(path):
+    """
+    Reads a spreadsheet or CSV into rows of (label indent level, cell values).
+
+    Returns:
+        dict: sheet name -> list of (indent, [cell values])
+    """
+    if path.lower().endswith(".csv"):
+        with open(path, "r", newline="", errors="replace") as f:
+            rows = []
+            for row in csv.reader(f):
+                first = row[0] if row else ""
+                rows.append(((len(first) - len(first.lstrip(" ")) + 2) // 3, row))
+        return {os.path.splitext(os.path.basename(path))[0]: rows}
+
+    from openpyxl import load_workbook
+    workbook = load_workbook(path, data_only=True, read_only=False)
+    sheets = {}
+    for ws in workbook.worksheets:
+        rows = []
+        for row in ws.iter_rows():
+            values = [cell.value for cell in row]
+            indent = 0
+            for cell in row:
+                if isinstance(cell.value, str) and cell.value.strip():
+                    indent = int(cell.alignment.indent or 0) or (len(cell.value) - len(cell.value.lstrip(" ")) + 2) // 3
+                    break
+            rows.append((indent, values))
+        sheets[ws.title] = rows
+    return sheets
+
+
+def find_year_header(rows):
+    """
+    Finds the header row of years.
+
+    Returns:
+        tuple: (row index, [(column, year label)]) or (None, [])
+    """
+    for index, (_, values) in enumerate(rows[:HEADER_SCAN_ROWS]):
+        columns = []
+        for column, value in enumerate(values):
+            text = _cell_text(value).strip()
+            match = YEAR_PATTERN.search(text)
+            # Skip percentage columns such as "2023 %"
+            if match and "%" not in text and len(text) <= 20:
+                columns.append((column, int(text) if text == match.group(1) else text))
+        if columns:
+            return index, columns
+    return None, []
+
+
+def parse_table(rows):
+    """
+    Converts a sheet into the statement layout the extraction prompts produce.
+
+    Returns:
+        dict or None: {"Years": [...], line item: [values], ...}
+    """
+    header_index, year_columns = find_year_header(rows)
+    if header_index is None:
+        return None
+    first_year_column = year_columns[0][0]
+    num_years = len(year_columns)
+
+    table = {"Years": [year for _, year in year_columns]}
+    gap_count = 0
+    pending_gap = False
+    heading = None
+    for indent, values in rows[header_index + 1:]:
+        label = next((_cell_text(v).strip() for v in values[:first_year_column] if _cell_text(v).strip()), "")
+        numbers = [_to_value(values[column]) if column < len(values) else "" for column, _ in year_columns]
+        has_numbers = any(value != "" for value in numbers)
+
+        if not label and not has_numbers:
+            pending_gap = len(table) > 1
+            continue
+        if pending_gap:
+            gap_count += 1
+            table[f"Gap{gap_count}"] = [""] * num_years
+            pending_gap = False
+
+        if not label:
+            # An unlabelled row of numbers is a sum of the rows above it
+            label = f"Total {heading}" if heading else "Total"
+        if not has_numbers:
+            heading = label
+
+        key = " " * (3 * indent) + label
+        while key in table:
+            key += " "
+        table[key] = numbers
+
+    return table if len(table) > 1 else None
+
+
+def classify(sheet_name, table):
+    """Returns the statement JSON file a table belongs to, or None if it is unclear."""
+    text = " ".join([sheet_name] + list(table)).lower()
+    scores = {filename: sum(text.count(word) for word in words) for filename, words in KEYWORDS.items()}
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    (best, best_score), (_, second_score) = ranked[0], ranked[1]
+    if best_score >= MIN_SCORE and best_score >= MIN_MARGIN * second_score:
+        return best
+    return None
+
+
+def extract_tables(file_paths, json_folder):
+    """
+    Parses spreadsheet and CSV attachments locally.
+
+    Statements found are written to json_folder in the same layout as the
+    prompts produce. A file is left for the model if one of its sheets with
+    content could not be parsed or classified.
+
+    Args:
+        file_paths: All attachments of the deal
+        json_folder: Folder the JSON files are written to
+
+    Returns:
+        tuple: (set of JSON filenames written, attachments still to send to the model)
+    """
+    found = {}
+    remaining = []
+    for path in file_paths:
+        if not path.lower().endswith(TABULAR_FORMATS):
+            remaining.append(path)
+            continue
+
+        try:
+            sheets = read_sheets(path)
+        except Exception as e:
+            logging.warning(f"Could not read {path} locally: {e}")
+            remaining.append(path)
+            continue
+
+        fully_classified = True
+        for sheet_name, rows in sheets.items():
+            table = parse_table(rows)
+            if table is None:
+                # A sheet with content but no recognisable table is left to the model
+                if any(_cell_text(value).strip() for _, values in rows for value in values):
+                    fully_classified = False
+                continue
+            filename = classify(sheet_name, table)
+            if filename is None:
+                fully_classified = False
+                continue
+            # Keep the largest table when several sheets hold the same statement
+            if filename not in found or len(table) > len(found[filename]):
+                found[filename] = table
+            print(f"📊 {os.path.basename(path)} [{sheet_name}] parsed locally as {filename}")
+
+        if not fully_classified:
+            remaining.append(path)
+
+    os.makedirs(json_folder, exist_ok=True)
+    for filename, table in found.items():
+        with open(os.path.join(json_folder, filename), "w") as f:
+            json.dump(table, f, indent=4)
+        print(f"{os.path.join(json_folder, filename)} saved successfully.")
+
+    return set(found), remaining
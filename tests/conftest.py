@@ -0,0 +1,15 @@
+import os
+import sys
+import types
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# config.py holds the local paths and is not checked in; point the modules at a scratch folder
+_base_dir = tempfile.mkdtemp(prefix="dealosophy-tests-")
+config = types.ModuleType("config")
+config.BASE_DIR = _base_dir
+config.TOKEN_PATH = os.path.join(_base_dir, "token.json")
+config.CREDENTIALS_PATH = os.path.join(_base_dir, "credentials.json")
+sys.modules["config"] = config
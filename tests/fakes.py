@@ -0,0 +1,223 @@
+"""In-memory stand-ins for the external APIs used by the tests."""
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+_ids = itertools.count(1)
+
+
+def new_id(prefix):
+    return f"{prefix}_{next(_ids)}"
+
+
+class FakeRuns:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, assistant_id, thread_id, **run_options):
+        run = SimpleNamespace(id=new_id("run"), thread_id=thread_id, status="queued", usage=None)
+        with self.client.lock:
+            self.client.runs.append(run)
+        return run
+
+    def retrieve(self, thread_id, run_id):
+        run = next(run for run in self.client.runs if run.id == run_id)
+        if run.status == "queued":
+            run.status = "in_progress"
+        elif run.status == "in_progress":
+            self.client.finish(run)
+        return run
+
+    def list(self, thread_id, order="desc", limit=20):
+        runs = [run for run in reversed(self.client.runs) if run.thread_id == thread_id]
+        return SimpleNamespace(data=runs[:limit])
+
+    def cancel(self, thread_id, run_id):
+        next(run for run in self.client.runs if run.id == run_id).status = "cancelled"
+
+    def stream(self, thread_id, assistant_id, **run_options):
+        return FakeStream(self.client, self, thread_id, assistant_id, run_options)
+
+
+class FakeStream:
+    """Context manager yielding run lifecycle and message delta events, like runs.stream()."""
+
+    def __init__(self, client, runs, thread_id, assistant_id, run_options):
+        self.client = client
+        self.runs = runs
+        self.thread_id = thread_id
+        self.assistant_id = assistant_id
+        self.run_options = run_options
+        self.current_run = None
+
+    def __enter__(self):
+        if self.client.stream_error == "before_create":
+            raise ConnectionError("stream could not be opened")
+        self.current_run = self.runs.create(self.assistant_id, self.thread_id, **self.run_options)
+        if self.client.stream_error == "after_create":
+            # The server accepted the run but the response never arrived
+            raise ConnectionError("stream dropped")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def __iter__(self):
+        run = self.current_run
+        with self.client.lock:
+            self.client.active += 1
+            self.client.max_active = max(self.client.max_active, self.client.active)
+        try:
+            run.status = "in_progress"
+            yield SimpleNamespace(event="thread.run.in_progress", data=run)
+            if self.client.stream_error == "mid_stream":
+                raise ConnectionError("stream dropped")
+            time.sleep(self.client.run_seconds)
+            reply = self.client.finish(run)
+            for start in range(0, len(reply), 7):
+                delta = SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value=reply[start:start + 7]))])
+                yield SimpleNamespace(event="thread.message.delta", data=SimpleNamespace(delta=delta))
+            yield SimpleNamespace(event="thread.run.completed", data=run)
+        finally:
+            with self.client.lock:
+                self.client.active -= 1
+
+
+class FakeMessages:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, thread_id, role, content):
+        message = SimpleNamespace(id=new_id("msg"), role=role, run_id=None,
+                                  content=[SimpleNamespace(text=SimpleNamespace(value=content))])
+        self.client.threads[thread_id].append(message)
+        return message
+
+    def list(self, thread_id, run_id=None, order="desc", limit=20):
+        messages = [message for message in self.client.threads[thread_id] if run_id is None or message.run_id == run_id]
+        if order == "desc":
+            messages.reverse()
+        return messages[:limit]
+
+
+class FakeThreads:
+    def __init__(self, client):
+        self.client = client
+        self.messages = FakeMessages(client)
+        self.runs = FakeRuns(client)
+
+    def create(self):
+        thread = SimpleNamespace(id=new_id("thread"))
+        self.client.threads[thread.id] = []
+        return thread
+
+
+class FakeAssistantsClient:
+    """
+    Local mock of the Assistants API: threads, messages and runs, streamed or polled.
+
+    Args:
+        reply: Function of the last user message returning the assistant's reply
+        run_seconds: Time a streamed run takes, so overlapping runs can be observed
+        stream_error: None, "before_create", "after_create" or "mid_stream"
+    """
+
+    def __init__(self, reply=lambda prompt: '{"Years": [2023], "Revenue": [100]}', run_seconds=0.0, stream_error=None):
+        self.reply = reply
+        self.run_seconds = run_seconds
+        self.stream_error = stream_error
+        self.threads = {}
+        self.runs = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.beta = SimpleNamespace(threads=FakeThreads(self))
+
+    def finish(self, run):
+        """Completes a run, writing the assistant's reply to its thread."""
+        prompt = next(message for message in reversed(self.threads[run.thread_id]) if message.role == "user")
+        reply = self.reply(prompt.content[0].text.value)
+        self.threads[run.thread_id].append(SimpleNamespace(
+            id=new_id("msg"), role="assistant", run_id=run.id,
+            content=[SimpleNamespace(text=SimpleNamespace(value=reply))]
+        ))
+        run.status = "completed"
+        run.usage = SimpleNamespace(prompt_tokens=10, completion_tokens=5)
+        return reply
+
+
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def execute(self, http=None):
+        return self.respond()
+
+
+class FakeGmailService:
+    """
+    Local mock of the parts of the Gmail API the mailbox sync uses.
+
+    Args:
+        unread: Ids of the unread inbox messages, listed by messages.list
+        history: History records after the checkpoint, as history.list returns them
+        history_id: Current historyId of the mailbox
+        history_expired: history.list answers 404, as Gmail does for a checkpoint it no longer has
+        page_size: Records or messages per page
+    """
+
+    def __init__(self, unread=(), history=(), history_id="500", history_expired=False, page_size=2):
+        self.unread = list(unread)
+        self.records = list(history)
+        self.history_id = history_id
+        self.history_expired = history_expired
+        self.page_size = page_size
+        self.calls = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return SimpleNamespace(list=self._list_messages)
+
+    def history(self):
+        return SimpleNamespace(list=self._list_history)
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {"historyId": self.history_id})
+
+    def _page(self, items, page_token):
+        start = int(page_token or 0)
+        end = start + self.page_size
+        return items[start:end], (str(end) if end < len(items) else None)
+
+    def _list_messages(self, userId, q=None, maxResults=None, pageToken=None):
+        def respond():
+            self.calls.append(("messages.list", pageToken))
+            ids, next_token = self._page(self.unread, pageToken)
+            response = {"messages": [{"id": msg_id, "threadId": msg_id} for msg_id in ids]}
+            if next_token:
+                response["nextPageToken"] = next_token
+            return response
+        return FakeRequest(respond)
+
+    def _list_history(self, userId, startHistoryId, historyTypes=None, labelId=None, pageToken=None):
+        def respond():
+            self.calls.append(("history.list", pageToken))
+            if self.history_expired:
+                raise HttpError(httplib2.Response({"status": 404}), b'{"error": {"code": 404}}')
+            records, next_token = self._page(self.records, pageToken)
+            response = {"history": records, "historyId": self.history_id}
+            if next_token:
+                response["nextPageToken"] = next_token
+            return response
+        return FakeRequest(respond)
+
+
+def added(msg_id, labels=("INBOX", "UNREAD")):
+    """A messagesAdded history record."""
+    return {"messagesAdded": [{"message": {"id": msg_id, "threadId": msg_id, "labelIds": list(labels)}}]}
@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+import assistant_runs
+import extract_data
+from fakes import FakeAssistantsClient
+
+JOBS = [
+    ("income statement prompt", "income_statement.json"),
+    ("balance sheet prompt", "balance_sheet.json"),
+    ("adjustments prompt", "adjustments.json"),
+]
+
+
+def reply_for(prompt):
+    return json.dumps({"Years": [2023], "prompt": [prompt]})
+
+
+def test_prompts_run_concurrently_and_each_file_is_written(tmp_path):
+    client = FakeAssistantsClient(reply=reply_for, run_seconds=0.2)
+
+    results = extract_data.extract_concurrently(client, "asst_1", JOBS, str(tmp_path), max_workers=3)
+
+    assert client.max_active == 3
+    for prompt, filename in JOBS:
+        assert results[filename]["prompt"] == [prompt]
+        with open(os.path.join(tmp_path, filename)) as f:
+            assert json.load(f) == results[filename]
+
+
+def test_stream_that_cannot_be_opened_falls_back_to_polling():
+    client = FakeAssistantsClient(stream_error="before_create")
+    thread = client.beta.threads.create()
+    client.beta.threads.messages.create(thread_id=thread.id, role="user", content="prompt")
+
+    run, timings = assistant_runs.run_and_wait(client, "asst_1", thread.id, poll_floor=0, poll_ceiling=0)
+
+    assert run.status == "completed"
+    assert timings["status_checks"] == 2
+    assert len(client.runs) == 1
+
+
+def test_run_accepted_before_the_stream_broke_is_polled_not_created_again():
+    client = FakeAssistantsClient(stream_error="after_create")
+    thread = client.beta.threads.create()
+    client.beta.threads.messages.create(thread_id=thread.id, role="user", content="prompt")
+
+    run, _ = assistant_runs.run_and_wait(client, "asst_1", thread.id, poll_floor=0, poll_ceiling=0)
+
+    assert run.status == "completed"
+    assert len(client.runs) == 1
+
+
+def test_stream_broken_mid_run_is_not_restarted():
+    client = FakeAssistantsClient(stream_error="mid_stream")
+    thread = client.beta.threads.create()
+    client.beta.threads.messages.create(thread_id=thread.id, role="user", content="prompt")
+
+    with pytest.raises(ConnectionError):
+        assistant_runs.run_and_wait(client, "asst_1", thread.id, poll_floor=0, poll_ceiling=0)
+    assert len(client.runs) == 1
+
+
+def test_polled_reply_is_saved(tmp_path):
+    client = FakeAssistantsClient(reply=reply_for, stream_error="before_create")
+    thread = client.beta.threads.create()
+    filename = os.path.join(tmp_path, "income_statement.json")
+
+    parsed = extract_data.extract_and_save(client, "asst_1", thread.id, "income statement prompt", filename)
+
+    assert parsed == {"Years": [2023], "prompt": ["income statement prompt"]}
+    with open(filename) as f:
+        assert json.load(f) == parsed
@@ -0,0 +1,56 @@
+import mailer
+from fakes import FakeGmailService, added
+
+
+def message_ids(pages):
+    return [[message["id"] for message in page] for page in pages]
+
+
+def test_unread_pages_follow_next_page_token():
+    service = FakeGmailService(unread=["m1", "m2", "m3"])
+
+    assert message_ids(mailer.iter_unread_pages(service)) == [["m1", "m2"], ["m3"]]
+
+
+def test_first_sync_scans_unread_and_sets_the_checkpoint(tmp_path):
+    db_path = str(tmp_path / "state.sqlite3")
+    service = FakeGmailService(unread=["m1", "m2", "m3"], history_id="900")
+
+    assert message_ids(mailer.iter_history_pages(service, db_path=db_path)) == [["m1", "m2"], ["m3"]]
+    assert mailer.load_history_id(db_path=db_path) == "900"
+
+
+def test_history_returns_only_new_inbox_messages(tmp_path):
+    db_path = str(tmp_path / "state.sqlite3")
+    mailer.save_history_id("100", db_path=db_path)
+    service = FakeGmailService(
+        unread=["old"],
+        history=[added("m1"), added("sent", labels=("SENT",)), added("m1"), added("m2")],
+        history_id="140",
+    )
+
+    assert message_ids(mailer.iter_history_pages(service, db_path=db_path)) == [["m1"], ["m2"]]
+    assert ("messages.list", None) not in service.calls
+    assert mailer.load_history_id(db_path=db_path) == "140"
+
+
+def test_expired_history_falls_back_to_a_full_scan(tmp_path):
+    db_path = str(tmp_path / "state.sqlite3")
+    mailer.save_history_id("100", db_path=db_path)
+    service = FakeGmailService(unread=["m1", "m2", "m3"], history_id="900", history_expired=True)
+
+    assert message_ids(mailer.iter_history_pages(service, db_path=db_path)) == [["m1", "m2"], ["m3"]]
+    assert service.calls[0] == ("history.list", None)
+    assert mailer.load_history_id(db_path=db_path) == "900"
+
+
+def test_interrupted_sync_keeps_the_old_checkpoint(tmp_path):
+    db_path = str(tmp_path / "state.sqlite3")
+    mailer.save_history_id("100", db_path=db_path)
+    service = FakeGmailService(history=[added("m1"), added("m2"), added("m3")], history_id="140")
+
+    pages = mailer.iter_history_pages(service, db_path=db_path)
+    next(pages)
+    pages.close()
+
+    assert mailer.load_history_id(db_path=db_path) == "100"
@@ -0,0 +1,28 @@
+import extract_data
+import result_cache
+
+FILES = ["deal.pdf"]
+HASHES = ["a" * 64]
+PROMPT = "income statement prompt"
+
+
+def key(excerpts):
+    context = extract_data.extraction_context(FILES, "income_statement.json", excerpts)
+    return result_cache.cache_key(HASHES, PROMPT, "gpt-4-turbo", context)
+
+
+def test_key_changes_with_the_inlined_excerpt():
+    pages_1_2 = {"income_statement.json": "Page 1\nRevenue 100\nPage 2\nNet income 10"}
+    pages_1_3 = {"income_statement.json": "Page 1\nRevenue 100\nPage 3\nNet income 12"}
+
+    assert key(pages_1_2) == key(dict(pages_1_2))
+    assert key(pages_1_2) != key(pages_1_3)
+    assert key(pages_1_2) != key({})
+
+
+def test_key_changes_with_the_attachments_and_prompt():
+    base = result_cache.cache_key(HASHES, PROMPT, "gpt-4-turbo")
+
+    assert base != result_cache.cache_key(["b" * 64], PROMPT, "gpt-4-turbo")
+    assert base != result_cache.cache_key(HASHES, "another prompt", "gpt-4-turbo")
+    assert base == result_cache.cache_key(HASHES * 2, PROMPT, "gpt-4-turbo")
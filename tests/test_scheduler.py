@@ -0,0 +1,56 @@
+from collections import Counter
+
+import pytest
+
+import scheduler
+from scheduler import DealScheduler
+
+REGISTRY = {
+    "standard@example.com": {"plan_tier": "standard", "concurrency_quota": 1},
+    "pro@example.com": {"plan_tier": "pro", "concurrency_quota": 1},
+}
+
+
+def fill(deal_scheduler, deals=30):
+    for i in range(deals):
+        for sender in REGISTRY:
+            deal_scheduler.put(sender, i)
+
+
+def test_weights_are_honored_under_a_cap_of_one():
+    deal_scheduler = DealScheduler(registry=REGISTRY)
+    fill(deal_scheduler)
+
+    served = Counter()
+    for _ in range(18):
+        ticket = deal_scheduler.get(timeout=0)
+        served[ticket.sender] += 1
+        deal_scheduler.done(ticket)
+
+    assert served == {"standard@example.com": 6, "pro@example.com": 12}
+
+
+def test_capped_sender_does_not_bank_credit():
+    deal_scheduler = DealScheduler(registry=REGISTRY)
+    fill(deal_scheduler)
+
+    # Two workers: each sender always has its one deal running
+    running = [deal_scheduler.get(timeout=0), deal_scheduler.get(timeout=0)]
+    for _ in range(50):
+        ticket = running.pop(0)
+        deal_scheduler.done(ticket)
+        running.append(deal_scheduler.get(timeout=0))
+
+    for sender in REGISTRY:
+        assert deal_scheduler.deficit[sender] <= deal_scheduler.quantum * deal_scheduler.weight(sender)
+
+
+@pytest.mark.parametrize("text", ["standard:1,pro:0", "standard:-1"])
+def test_non_positive_weights_are_rejected(text):
+    with pytest.raises(ValueError):
+        scheduler.parse_plan_weights(text)
+
+
+def test_non_positive_quantum_is_rejected():
+    with pytest.raises(ValueError):
+        DealScheduler(quantum=0)
@@ -0,0 +1,54 @@
+import json
+import os
+
+import tabular_extraction
+
+
+def write_csv(folder, name, lines):
+    path = os.path.join(folder, name)
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+def test_fiscal_year_header_is_parsed(tmp_path):
+    path = write_csv(tmp_path, "is.csv", [
+        "Income Statement,FY22,FY23",
+        "Revenue,1000,1200",
+        "Cost of sales,400,450",
+        "Gross profit,600,750",
+        "Wages,200,210",
+        "Net income,300,400",
+    ])
+
+    found, remaining = tabular_extraction.extract_tables([path], str(tmp_path / "json"))
+
+    assert found == {"income_statement.json"}
+    assert remaining == []
+    with open(tmp_path / "json" / "income_statement.json") as f:
+        table = json.load(f)
+    assert table["Years"] == ["FY22", "FY23"]
+    assert table["Revenue"] == [1000, 1200]
+
+
+def test_unparseable_sheet_is_left_to_the_model(tmp_path):
+    path = write_csv(tmp_path, "notes.csv", [
+        "Income Statement,Prior,Current",
+        "Revenue,1000,1200",
+        "Net income,300,400",
+    ])
+    pdf = str(tmp_path / "cim.pdf")
+
+    found, remaining = tabular_extraction.extract_tables([path, pdf], str(tmp_path / "json"))
+
+    assert found == set()
+    assert remaining == [path, pdf]
+
+
+def test_empty_csv_is_not_sent_to_the_model(tmp_path):
+    path = write_csv(tmp_path, "blank.csv", [",,", ""])
+
+    found, remaining = tabular_extraction.extract_tables([path], str(tmp_path / "json"))
+
+    assert found == set()
+    assert remaining == []
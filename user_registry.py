@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+import threading
+import state_db
+
+# Text file of registered senders, one per line: email[, plan tier[, concurrency quota]]
+REGISTERED_USERS_PATH = os.getenv("REGISTERED_USERS_PATH", "registered_users.txt")
+
+# Attributes of users listed without them
+DEFAULT_PLAN_TIER = os.getenv("DEFAULT_PLAN_TIER", "standard")
+DEFAULT_CONCURRENCY_QUOTA = int(os.getenv("DEFAULT_CONCURRENCY_QUOTA", "1"))
+
+# How often the file and the database are checked for changes
+REGISTRY_CHECK_SECONDS = float(os.getenv("REGISTRY_CHECK_SECONDS", "2"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registered_users (
+    email TEXT PRIMARY KEY,
+    plan_tier TEXT NOT NULL,
+    concurrency_quota INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS registry_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def parse_users_file(path):
+    """
+    Reads the registered users file.
+
+    Blank lines and lines starting with # are ignored. Missing attributes are
+    left as None so values already stored in the database are kept.
+
+    Returns:
+        dict: email -> {"plan_tier", "concurrency_quota"}
+    """
+    users = {}
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split(",")]
+            email_address = fields[0].lower()
+            if not email_address:
+                continue
+            plan_tier = fields[1] if len(fields) > 1 and fields[1] else None
+            try:
+                quota = int(fields[2]) if len(fields) > 2 and fields[2] else None
+            except ValueError:
+                logging.warning(f"⚠️ Invalid concurrency quota for {email_address}: {fields[2]}")
+                quota = None
+            users[email_address] = {"plan_tier": plan_tier, "concurrency_quota": quota}
+    return users
+
+
+class UserRegistry:
+    """
+    Registered senders with their plan tier and concurrency quota.
+
+    Users live in the registered_users table of the state database, so the
+    fetcher, the workers and other processes share them. The registered users
+    file is synced into the table whenever its mtime, inode or size changes;
+    users removed from the file are removed from the table, users added
+    directly to the database (set_user) are kept. Lookups are served from an
+    in-memory dict that is reloaded when the file or the table changes.
+    """
+
+    def __init__(self, path=REGISTERED_USERS_PATH, db_path=state_db.STATE_DB_PATH,
+                 check_seconds=REGISTRY_CHECK_SECONDS):
+        self.path = path
+        self.db_path = db_path
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.users = {}
+        self.file_signature = None
+        self.version = None
+        self.checked_at = None
+        with state_db.connection(self.db_path) as conn:
+            conn.executescript(SCHEMA)
+
+    def __contains__(self, email_address):
+        return self.get(email_address) is not None
+
+    def __len__(self):
+        self.refresh()
+        return len(self.users)
+
+    def get(self, email_address):
+        """Returns a user's attributes, or None if the address is not registered."""
+        self.refresh()
+        return self.users.get(email_address.strip().lower())
+
+    def is_registered(self, email_address):
+        return email_address in self
+
+    def refresh(self, force=False):
+        """Reloads the users if the file or the table changed since the last check."""
+        now = time.monotonic()
+        if not force and self.checked_at is not None and now - self.checked_at < self.check_seconds:
+            return
+        with self.lock:
+            if not force and self.checked_at is not None and now - self.checked_at < self.check_seconds:
+                return
+            signature = self._file_signature()
+            with state_db.connection(self.db_path) as conn:
+                if signature is not None and signature != self._stored_signature(conn):
+                    self._sync_file(conn, signature)
+                version = self._stored_version(conn)
+                if force or version != self.version:
+                    self._load(conn)
+                    self.version = version
+            self.file_signature = signature
+            self.checked_at = now
+
+    def set_user(self, email_address, plan_tier=DEFAULT_PLAN_TIER, concurrency_quota=DEFAULT_CONCURRENCY_QUOTA):
+        """Registers a user, or updates their attributes, directly in the database."""
+        email_address = email_address.strip().lower()
+        with state_db.connection(self.db_path) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO registered_users (email, plan_tier, concurrency_quota, source, updated_at) "
+                "VALUES (?, ?, ?, 'db', ?) ON CONFLICT(email) DO UPDATE SET "
+                "plan_tier = excluded.plan_tier, concurrency_quota = excluded.concurrency_quota, "
+                "updated_at = excluded.updated_at",
+                (email_address, plan_tier, int(concurrency_quota), time.time())
+            )
+            self._bump_version(conn)
+            conn.execute("COMMIT")
+        self.refresh(force=True)
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return f"{stat.st_ino}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def _stored_signature(self, conn):
+        row = conn.execute("SELECT value FROM registry_meta WHERE key = 'file_signature'").fetchone()
+        return row["value"] if row else None
+
+    def _stored_version(self, conn):
+        row = conn.execute("SELECT value FROM registry_meta WHERE key = 'version'").fetchone()
+        return int(row["value"]) if row else 0
+
+    def _bump_version(self, conn):
+        conn.execute(
+            "INSERT INTO registry_meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+        )
+
+    def _sync_file(self, conn, signature):
+        try:
+            file_users = parse_users_file(self.path)
+        except OSError as e:
+            logging.error(f"❌ Could not read {self.path}: {e}")
+            return
+
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        # Another process may have synced the same version of the file meanwhile
+        if self._stored_signature(conn) == signature:
+            conn.execute("COMMIT")
+            return
+        existing = {row["email"]: row for row in conn.execute("SELECT * FROM registered_users")}
+        for email_address, attributes in file_users.items():
+            current = existing.get(email_address)
+            plan_tier = attributes["plan_tier"] or (current["plan_tier"] if current else DEFAULT_PLAN_TIER)
+            quota = attributes["concurrency_quota"]
+            if quota is None:
+                quota = current["concurrency_quota"] if current else DEFAULT_CONCURRENCY_QUOTA
+            conn.execute(
+                "INSERT INTO registered_users (email, plan_tier, concurrency_quota, source, updated_at) "
+                "VALUES (?, ?, ?, 'file', ?) ON CONFLICT(email) DO UPDATE SET "
+                "plan_tier = excluded.plan_tier, concurrency_quota = excluded.concurrency_quota, "
+                "source = 'file', updated_at = excluded.updated_at",
+                (email_address, plan_tier, quota, now)
+            )
+        removed = [email_address for email_address, row in existing.items()
+                   if row["source"] == "file" and email_address not in file_users]
+        conn.executemany("DELETE FROM registered_users WHERE email = ?", [(e,) for e in removed])
+        conn.execute(
+            "INSERT INTO registry_meta (key, value) VALUES ('file_signature', ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (signature,)
+        )
+        self._bump_version(conn)
+        conn.execute("COMMIT")
+        logging.info(f"👥 Registered users synced from {self.path}: {len(file_users)} listed, {len(removed)} removed")
+
+    def _load(self, conn):
+        self.users = {
+            row["email"]: {"plan_tier": row["plan_tier"], "concurrency_quota": row["concurrency_quota"]}
+            for row in conn.execute("SELECT email, plan_tier, concurrency_quota FROM registered_users")
+        }
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the process-wide registry, created on first use."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = UserRegistry()
+        return _registry